@@ -31,6 +31,8 @@ LABEL_COLOUR = "#25265E"
 load_dotenv()
 URL = getenv("URL")
 # URL = "http://127.0.0.1:8000"
+# Logins and account creation go to the auth server when it runs separately from the chat server
+AUTH_URL = getenv("AUTH_URL") or URL
 LOGIN_ENDPOINT = "/auth/token"
 CREATE_ACCOUNT_ENDPOINT = "/create_account"
 
@@ -45,7 +47,7 @@ MAX_CHANNELS = 12
 #   "channel": "username_1",
 #   "username": "user123",
 #   "content": "Hello, world!",
-#   "sent_at": "2023-07-25T12:34:56Z"
+#   "sent_at": 1690288496000000  (microseconds since the Unix epoch, UTC)
 # }
 
 # Format for text message as sent:
@@ -315,7 +317,7 @@ class Chattr:
                 "username": self.username.get().strip(),
                 "password": self.password.get().strip(),
             }
-            response = requests.post(f"{URL}{LOGIN_ENDPOINT}", data=payload)
+            response = requests.post(f"{AUTH_URL}{LOGIN_ENDPOINT}", data=payload)
             response.raise_for_status()
             return response.json()
 
@@ -363,7 +365,7 @@ class Chattr:
             self.entries["username_entry"].config(state="readonly")
             self.entries["password_entry"].config(state="readonly")
             response = requests.post(
-                f"{URL}{CREATE_ACCOUNT_ENDPOINT}", json=account_info
+                f"{AUTH_URL}{CREATE_ACCOUNT_ENDPOINT}", json=account_info
             )
 
             # If account is created successfully, let the user know, wait 2.5s, and then log in with those credentials
@@ -410,24 +412,25 @@ class Chattr:
         """MEssage listener loop to run while connection is active"""
         while self.connection_active:
             try:
-                message: dict = await asyncio.wait_for(
-                    self.client_websocket.receive_message(), timeout=1.0
+                messages: list[dict] = await asyncio.wait_for(
+                    self.client_websocket.receive_messages(), timeout=1.0
                 )
 
-                if message is not None:
+                for message in messages or []:
                     # "messages" can contain event information such as channel subscriptions, or message data. This filters based on keys present.
                     event_type = message.get("event")
                     if event_type == "channel_subscriptions":
                         new_channels = message.get("data")
                         if isinstance(new_channels, list):
+                            # Subscriptions are sent again after reconnecting, tabs that already exist are kept
+                            new_channels = [channel for channel in new_channels if channel not in self.nb_tabs]
                             self.channels.extend(new_channels)
                             self.build_channel_tabs(new_channels)
-                    elif event_type == "message history":
-                        for individual_message in message.get("data", []):
-                            try:
-                                self.process_received_message(individual_message)
-                            except:
-                                print(f"Unable to process message: {message}")
+                    elif event_type == "resume":
+                        for channel in message.get("gaps", []):
+                            self.window.after(0, self.clear_text_field, channel)
+                    elif event_type == "history":
+                        self.process_received_history(message)
                     else:
                         self.process_received_message(message)
             except asyncio.TimeoutError:
@@ -440,23 +443,35 @@ class Chattr:
                 print(f"Error receiving message: {e}")
                 await asyncio.sleep(5)
 
+    def process_received_history(self, history: dict):
+        """Format a frame of channel history and add it above the messages already displayed. History is sent newest frame first, so each frame goes on top of the last"""
+        channel = history.get("channel")
+        if channel not in self.nb_tabs or not history.get("messages"):
+            return
+        display_text = "".join(
+            self.format_message(message) for message in history["messages"]
+        )
+        self.window.after(0, self.prepend_text_field, channel, display_text)
+
     def process_received_message(self, message: dict):
         """Format the received message and send it to the method to update the display"""
+        display_text = self.format_message(message)
+        # Use after() method to safely update GUI from a different thread
+        self.window.after(0, self.update_text_field, message["channel"], display_text)
+
+    def format_message(self, message: dict) -> str:
+        """Format a message as a line of text for display"""
         message_username = message.get("username")
         # If you sent the message, display sender as "You", otherwise sender's username
         if message_username == self.username.get():
             message_username = "You"
         # Generate a string showing the message sent timestamp in HH:MM format for the local timezone of the client
         message_timestamp = (
-            datetime.datetime.fromisoformat(message["sent_at"])
+            datetime.datetime.fromtimestamp(message["sent_at"] / 1_000_000, datetime.timezone.utc)
             .astimezone()
             .strftime("%H:%M")
         )
-        display_text = (
-            f"{message_timestamp}, {message_username}: {message['content']}\n"
-        )
-        # Use after() method to safely update GUI from a different thread
-        self.window.after(0, self.update_text_field, message["channel"], display_text)
+        return f"{message_timestamp}, {message_username}: {message['content']}\n"
 
     def update_text_field(self, channel: str, text: str):
         self.nb_tabs[channel].config(state="normal")
@@ -464,6 +479,18 @@ class Chattr:
         self.nb_tabs[channel].config(state="disabled")
         self.nb_tabs[channel].yview(tk.END)  # Auto-scroll to the bottom
 
+    def clear_text_field(self, channel: str):
+        if channel not in self.nb_tabs:
+            return
+        self.nb_tabs[channel].config(state="normal")
+        self.nb_tabs[channel].delete("1.0", tk.END)
+        self.nb_tabs[channel].config(state="disabled")
+
+    def prepend_text_field(self, channel: str, text: str):
+        self.nb_tabs[channel].config(state="normal")
+        self.nb_tabs[channel].insert("1.0", text)
+        self.nb_tabs[channel].config(state="disabled")
+
     def create_notebook(self):
         """Create notebook object to hold channel tabs"""
         self.style = ttk.Style()
@@ -1,4 +1,5 @@
 import asyncio
+import json
 import websockets
 from logging import Logger
 from os import getenv
@@ -23,6 +24,23 @@ load_dotenv()
 WS_URL = "ws://127.0.0.1:8000"
 WS_URL = getenv("WS_URL")
 WEBSOCKET_ENDPOINT = "/ws"
+# Websocket subprotocol that asks the server for the Envelope protocol (message.proto, version 2)
+PROTOCOL_SUBPROTOCOL = "chattr.v2"
+PROTOCOL_VERSION = 2
+# Handshake header the last message seen in each channel is sent in when reconnecting, so the server only sends the messages missed in between
+RESUME_CURSOR_HEADER = "X-Resume-Cursor"
+
+# Numeric event type for each event name used in message dicts
+EVENT_TYPES = {
+    "message": message_pb2.EVENT_TYPE_MESSAGE,
+    "channel_subscriptions": message_pb2.EVENT_TYPE_CHANNEL_SUBSCRIPTIONS,
+    "add_channel": message_pb2.EVENT_TYPE_ADD_CHANNEL,
+    "leave_channel": message_pb2.EVENT_TYPE_LEAVE_CHANNEL,
+    "perf_test": message_pb2.EVENT_TYPE_PERF_TEST,
+    "history": message_pb2.EVENT_TYPE_HISTORY,
+    "resume": message_pb2.EVENT_TYPE_RESUME,
+}
+EVENT_NAMES = {event_type: name for name, event_type in EVENT_TYPES.items()}
 
 
 class MyWebSocket:
@@ -35,20 +53,34 @@ class MyWebSocket:
         self.auth_token: dict = auth_token
         self.username = username
         self.connected = False
+        # Names the server has told us its ids stand for on this connection
+        self.channel_ids: dict[str, int] = {}
+        self.channel_names: dict[int, str] = {}
+        self.usernames: dict[int, str] = {}
+        # Sequence number of the last message received in each channel, used to drop duplicates and spot gaps
+        self.channel_seqs: dict[str, int] = {}
+        # Id of the last message received in each channel, sent as the resume cursor when reconnecting
+        self.channel_last_ids: dict[str, int] = {}
 
     async def connect(self):
         """Establish the websocket connection"""
+        self.channel_ids.clear()
+        self.channel_names.clear()
+        self.usernames.clear()
         while not self.connected:
             try:
                 extra_headers = {
                     "Authorization": f"Bearer {self.auth_token.get('access_token', '')}"
                 }
+                if self.channel_last_ids:
+                    extra_headers[RESUME_CURSOR_HEADER] = json.dumps(self.channel_last_ids)
                 self.websocket = await websockets.connect(
                     self.websocket_url,
                     # ping_interval=20,
                     ping_timeout=None,
                     open_timeout=None,
                     extra_headers=extra_headers,
+                    subprotocols=[PROTOCOL_SUBPROTOCOL],
                 )
                 self.connected = True
             except websockets.exceptions.InvalidStatusCode as e:
@@ -71,11 +103,30 @@ class MyWebSocket:
                 await asyncio.sleep(5)
 
     def encode_message(self, message_data: dict) -> bytes:
-        """Serialize a dictionary into bytes via protobuf"""
+        """Serialize a dictionary into bytes via protobuf. The dict's "event" selects the envelope's event type and payload, the remaining keys are the payload's fields"""
         try:
-            message_object = ParseDict(message_data, message_pb2.ChatMessage())
+            payload_data = dict(message_data)
+            event_type = EVENT_TYPES[payload_data.pop("event")]
+            envelope = message_pb2.Envelope(version=PROTOCOL_VERSION, type=event_type)
+            if event_type == message_pb2.EVENT_TYPE_MESSAGE:
+                # Once the server has told us a channel's id, send that instead of its name
+                channel_id = self.channel_ids.get(payload_data.get("channel"))
+                if channel_id is not None:
+                    payload_data.pop("channel")
+                    payload_data["channel_id"] = channel_id
+                ParseDict(payload_data, envelope.chat)
+            elif event_type in (message_pb2.EVENT_TYPE_ADD_CHANNEL, message_pb2.EVENT_TYPE_LEAVE_CHANNEL):
+                ParseDict(payload_data, envelope.channel_action)
+            elif event_type == message_pb2.EVENT_TYPE_PERF_TEST:
+                ParseDict(payload_data, envelope.perf_test)
+            elif event_type == message_pb2.EVENT_TYPE_HISTORY:
+                channel_id = self.channel_ids.get(payload_data.get("channel"))
+                if channel_id is not None:
+                    payload_data.pop("channel")
+                    payload_data["channel_id"] = channel_id
+                ParseDict(payload_data, envelope.history_request)
 
-            return message_object.SerializeToString()
+            return envelope.SerializeToString()
         except EncodeError as e:
             self.logger.warning(f"encode_message() Protobuf EncodeError: {e}")
         except Exception as e:
@@ -83,17 +134,104 @@ class MyWebSocket:
                 f"Exception during encode_message(): {type(e).__name__}: {e}"
             )
 
-    def decode_message(self, message_bytes: bytes) -> dict:
-        """Decode bytes serialized message to a dictionary"""
-        try:
-            parsed_message: message_pb2.ChatMessage = message_pb2.ChatMessage()
-            parsed_message.ParseFromString(message_bytes)
+    def add_channel_id(self, channel: str, channel_id: int):
+        """Record the id the server uses for a channel"""
+        self.channel_ids[channel] = channel_id
+        self.channel_names[channel_id] = channel
+
+    def check_seq(self, channel: str, seq: int) -> bool:
+        """Record the sequence number of a message received in a channel. Returns False if the message has already been received. Gaps, from messages dropped while the connection was too slow or while it was down, are logged"""
+        last_seq = self.channel_seqs.get(channel)
+        if seq and last_seq is not None:
+            if seq <= last_seq:
+                return False
+            if seq > last_seq + 1:
+                self.logger.debug(
+                    f"{self.username}: missed {seq - last_seq - 1} messages in {channel}"
+                )
+        if seq:
+            self.channel_seqs[channel] = seq
+        return True
+
+    def record_last_id(self, channel: str, message_id: int):
+        """Record the id of a message received in a channel, if it's the latest seen there"""
+        if message_id > self.channel_last_ids.get(channel, 0):
+            self.channel_last_ids[channel] = message_id
 
-            message_dict = MessageToDict(
-                parsed_message, preserving_proto_field_name=True
+    def envelope_to_dict(self, envelope: message_pb2.Envelope) -> dict | None:
+        """Convert an envelope to a message dict, with its event name under "event" and its payload's fields alongside. Channel subscriptions are returned under "data", a history page under "messages" (oldest first) and "has_more", the answer to a resume cursor under "resumed" and "gaps", and ids are replaced with the names they stand for. Intern frames only update the names, and they and duplicate chat messages return None"""
+        payload_name = envelope.WhichOneof("payload")
+        if payload_name == "intern":
+            for entry in envelope.intern.channels:
+                self.add_channel_id(entry.name, entry.id)
+            for entry in envelope.intern.users:
+                self.usernames[entry.id] = entry.name
+            return None
+
+        message = {"event": EVENT_NAMES.get(envelope.type, "")}
+        if payload_name == "chat":
+            chat = envelope.chat
+            message["channel"] = chat.channel or self.channel_names.get(chat.channel_id, "")
+            message["content"] = chat.content
+            message["username"] = chat.username or self.usernames.get(chat.username_id, "")
+            message["sent_at"] = chat.sent_at_us
+            message["id"] = chat.message_id
+            message["seq"] = chat.seq
+            if not self.check_seq(message["channel"], chat.seq):
+                return None
+            self.record_last_id(message["channel"], chat.message_id)
+        elif payload_name == "channel_subscriptions":
+            subscriptions = envelope.channel_subscriptions
+            for channel, channel_id in zip(subscriptions.channels, subscriptions.channel_ids):
+                self.add_channel_id(channel, channel_id)
+            message["data"] = list(subscriptions.channels)
+        elif payload_name == "history":
+            history = envelope.history
+            message["channel"] = self.channel_names.get(history.channel_id, "")
+            message["messages"] = [
+                {
+                    "content": chat.content,
+                    "username": chat.username or self.usernames.get(chat.username_id, ""),
+                    "sent_at": chat.sent_at_us,
+                    "id": chat.message_id,
+                    "seq": chat.seq,
+                }
+                for chat in history.messages
+            ]
+            message["has_more"] = history.has_more
+            if message["messages"]:
+                self.record_last_id(message["channel"], message["messages"][-1]["id"])
+        elif payload_name == "resume":
+            resume = envelope.resume
+            message["resumed"] = [self.channel_names.get(channel_id, "") for channel_id in resume.resumed_channel_ids]
+            message["gaps"] = [self.channel_names.get(channel_id, "") for channel_id in resume.gap_channel_ids]
+            # Too much was missed in these channels to replay, so they start over from the history that follows
+            for channel in message["gaps"]:
+                self.channel_seqs.pop(channel, None)
+                self.channel_last_ids.pop(channel, None)
+        elif payload_name is not None:
+            message.update(
+                MessageToDict(getattr(envelope, payload_name), preserving_proto_field_name=True)
             )
+        return message
+
+    def decode_messages(self, message_bytes: bytes) -> list[dict]:
+        """Decode bytes serialized message to a list of dictionaries. The server may combine several messages into one batch envelope, which is unpacked here so each message is returned individually"""
+        try:
+            envelope: message_pb2.Envelope = message_pb2.Envelope()
+            envelope.ParseFromString(message_bytes)
+
+            if envelope.type == message_pb2.EVENT_TYPE_BATCH:
+                envelopes = envelope.batch.envelopes
+            else:
+                envelopes = [envelope]
 
-            return message_dict
+            messages = []
+            for batched_envelope in envelopes:
+                message = self.envelope_to_dict(batched_envelope)
+                if message is not None:
+                    messages.append(message)
+            return messages
         except Exception as e:
             raise DecodeError(e)
 
@@ -118,15 +256,15 @@ class MyWebSocket:
                 f"An error occurred while sending message: {type(e).__name__}: {e}"
             )
 
-    async def receive_message(self) -> dict:
-        """Receive messages from the WebSocket. Message will be deserialized before being returned"""
+    async def receive_messages(self) -> list[dict]:
+        """Receive the next frame from the WebSocket. Messages will be deserialized before being returned, a frame can contain more than one message"""
         if not self.connected:
             return
         try:
             message_bytes: bytes = await self.websocket.recv()
-            return self.decode_message(message_bytes)
+            return self.decode_messages(message_bytes)
         except DecodeError as e:
-            self.logger.warning(f"receive_message() Protobuf DecodeError: {e}")
+            self.logger.warning(f"receive_messages() Protobuf DecodeError: {e}")
         except websockets.exceptions.ConnectionClosedError as e:
             self.logger.debug(f"Connection closed unexpectedly: {e}. Reconnecting...")
             self.connected = False
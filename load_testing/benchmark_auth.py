@@ -0,0 +1,113 @@
+# Compares the account lookup behind every login and websocket connect, see get_current_user() in server/routers/auth.py:
+#  - full scan: read every row of the users table into a dict of all accounts and pick one out, as the server did previously
+#  - primary key: read the one account by username, with the account cache turned off
+#  - account cache: the account cache in front of the primary key lookup, once every account has been looked up
+#  - + token cache: also skipping JWT verification for tokens seen before, as on a reconnect
+# Each connect decodes the JWT and looks up its account, with CONCURRENCY connects in flight at a time.
+# A database of NUM_ACCOUNTS accounts is created for the benchmark under server/services/db_data and removed afterwards.
+# Run from the project root: python -m load_testing.benchmark_auth
+
+import asyncio
+import os
+import random
+import sqlite3
+import time
+
+# Set before the server modules are imported, as they read their settings on import
+os.environ["DB_NAME"] = "benchmark_auth.db"
+os.environ.setdefault("SECRET_KEY", "benchmark_auth")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("CRYPTCONTEXT_SCHEME", "argon2")
+
+from jose import jwt
+
+from server.routers.auth import ALGORITHM, VERIFYING_KEY, UserInDB, create_access_token, get_current_user, token_cache
+from server.services.async_db_manager import adb
+from server.services.db_manager import INSERT_USER_QUERY, db, pwd_context
+
+NUM_ACCOUNTS = 40000
+NUM_TESTS = 20000
+# The full scan reads every account on each connect, so it's run for fewer connects
+NUM_TESTS_FULL_SCAN = 200
+CONCURRENCY = 50
+
+
+def create_benchmark_accounts():
+    """Inserts NUM_ACCOUNTS accounts, all with the same password hash so they don't take long to create"""
+    password_hashed = pwd_context.hash("benchmark_password")
+    with sqlite3.connect(db.DB_FILEPATH) as conn:
+        # Left over if a previous run was interrupted
+        conn.execute("DELETE FROM users")
+        conn.executemany(
+            INSERT_USER_QUERY,
+            [
+                {"username": f"user_{i}", "password_hashed": password_hashed}
+                for i in range(NUM_ACCOUNTS)
+            ],
+        )
+
+
+def remove_benchmark_database():
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db.DB_FILEPATH + suffix):
+            os.remove(db.DB_FILEPATH + suffix)
+
+
+async def get_current_user_full_scan(token: str) -> UserInDB:
+    """get_current_user() as it was before the primary key lookup and account cache"""
+    payload = jwt.decode(token, VERIFYING_KEY, algorithms=[ALGORITHM])
+    accounts: dict = await adb.retrieve_existing_accounts()
+    return UserInDB(**accounts[payload["sub"]])
+
+
+async def run_connects(get_user, tokens: list[str]) -> float:
+    """Authenticates each token, CONCURRENCY at a time, and returns the connects per second"""
+    start = time.perf_counter()
+    for i in range(0, len(tokens), CONCURRENCY):
+        users = await asyncio.gather(*(get_user(token) for token in tokens[i : i + CONCURRENCY]))
+        assert all(user is not None for user in users)
+    return len(tokens) / (time.perf_counter() - start)
+
+
+async def main():
+    usernames = [f"user_{i}" for i in range(NUM_ACCOUNTS)]
+    tokens = [create_access_token({"sub": random.choice(usernames)}) for _ in range(NUM_TESTS)]
+
+    # Warm up the reader threads and SQLite's page cache
+    await run_connects(get_current_user_full_scan, tokens[:CONCURRENCY])
+
+    full_scan = await run_connects(get_current_user_full_scan, tokens[:NUM_TESTS_FULL_SCAN])
+
+    cache_size = adb.account_cache.max_size
+    token_cache_size = token_cache.max_size
+    adb.account_cache.max_size = 0
+    token_cache.max_size = 0
+    primary_key = await run_connects(get_current_user, tokens)
+
+    adb.account_cache.max_size = cache_size
+    await run_connects(get_current_user, [create_access_token({"sub": username}) for username in usernames])
+    adb.account_cache.hits = adb.account_cache.misses = 0
+    cached = await run_connects(get_current_user, tokens)
+
+    token_cache.max_size = token_cache_size
+    await run_connects(get_current_user, tokens)
+    token_cache.hits = token_cache.misses = 0
+    tokens_cached = await run_connects(get_current_user, tokens)
+
+    print(f"{NUM_ACCOUNTS} accounts, {CONCURRENCY} concurrent connects\n")
+    print(f"{'full scan':<16} {full_scan:>10,.0f} connects/s")
+    print(f"{'primary key':<16} {primary_key:>10,.0f} connects/s  ({primary_key / full_scan:,.0f}x)")
+    print(f"{'account cache':<16} {cached:>10,.0f} connects/s  ({cached / full_scan:,.0f}x)")
+    print(f"{'+ token cache':<16} {tokens_cached:>10,.0f} connects/s  ({tokens_cached / full_scan:,.0f}x)")
+    print(f"\nAccount cache: {len(adb.account_cache.accounts)} accounts, {adb.account_cache.hits} hits, {adb.account_cache.misses} misses")
+    print(f"Token cache: {token_cache.metrics()}")
+
+    await adb.close()
+
+
+if __name__ == "__main__":
+    try:
+        create_benchmark_accounts()
+        asyncio.run(main())
+    finally:
+        remove_benchmark_database()
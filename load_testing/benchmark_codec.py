@@ -0,0 +1,145 @@
+# Compares the hand-written Envelope encoders and decoders in server/services/codec.py against the generic
+# json_format functions (ParseDict / MessageToDict) on ChatMessage the server used previously, for each event type,
+# along with the size of the frame each one produces.
+# Run from the project root: python -m load_testing.benchmark_codec
+
+import time
+
+from google.protobuf.internal import api_implementation
+from google.protobuf.json_format import MessageToDict, ParseDict
+
+from server import message_pb2
+from server.services import codec
+from server.services.legacy_codec import envelope_to_legacy
+from server.services.name_interner import NameInterner
+
+print(f"This should be 'upb': {api_implementation.Type()=}\n")
+
+NUM_TESTS = 100000
+
+chat_message = {
+    "event": "message",
+    "channel": "test_4",
+    "content": "radio hammer apple seven orange",
+    "username": "username_123",
+    "sent_at": "2024-11-02T13:57:01.123456+00:00",
+}
+# The same time in microseconds since the Unix epoch, as the Envelope protocol sends it
+sent_at_us = 1730555821123456
+channel_subscriptions = {
+    "event": "channel_subscriptions",
+    "data": ["welcome", "test_1", "test_4", "test_7"],
+}
+perf_test = {
+    "event": "perf_test",
+    "perf_test_id": 120,
+    "cpu_load": [54.1, 12.3, 9.8, 4.2],
+    "memory_usage": 41.7,
+    "active_connections": 400,
+    "message_volume": 16500,
+    "mv_period": 1.002,
+    "mv_adjusted": 16421,
+}
+# Ids the server would send in place of the names above
+channel_names = NameInterner()
+usernames = NameInterner()
+channel_ids = {channel: channel_names.intern(channel) for channel in channel_subscriptions["data"]}
+username_id = usernames.intern(chat_message["username"])
+# (ChatMessage, Envelope) bytes a client sends for each event
+received = {
+    "message": (
+        message_pb2.ChatMessage(event="message", channel="test_4", content="radio hammer apple"),
+        message_pb2.Envelope(type=message_pb2.EVENT_TYPE_MESSAGE, chat=message_pb2.Chat(channel_id=channel_ids["test_4"], content="radio hammer apple")),
+    ),
+    "add_channel": (
+        message_pb2.ChatMessage(event="add_channel", channel="test_4"),
+        message_pb2.Envelope(type=message_pb2.EVENT_TYPE_ADD_CHANNEL, channel_action=message_pb2.ChannelAction(channel="test_4")),
+    ),
+    "leave_channel": (
+        message_pb2.ChatMessage(event="leave_channel", channel="test_4"),
+        message_pb2.Envelope(type=message_pb2.EVENT_TYPE_LEAVE_CHANNEL, channel_action=message_pb2.ChannelAction(channel="test_4")),
+    ),
+    "perf_test": (
+        message_pb2.ChatMessage(event="perf_test", perf_test_id=120),
+        message_pb2.Envelope(type=message_pb2.EVENT_TYPE_PERF_TEST, perf_test=message_pb2.PerfTest(perf_test_id=120)),
+    ),
+}
+for legacy, envelope in received.values():
+    envelope.version = codec.PROTOCOL_VERSION
+received = {
+    event: (legacy.SerializeToString(), envelope.SerializeToString())
+    for event, (legacy, envelope) in received.items()
+}
+
+
+def parse_dict(message: dict) -> bytes:
+    return ParseDict(message, message_pb2.ChatMessage()).SerializeToString()
+
+
+def message_to_dict(message_bytes: bytes) -> dict:
+    parsed_message = message_pb2.ChatMessage()
+    parsed_message.ParseFromString(message_bytes)
+    return MessageToDict(parsed_message, preserving_proto_field_name=True)
+
+
+def codec_decode(message_bytes: bytes):
+    # What the server reads from each event after dispatching on the event type
+    envelope = codec.parse_message(message_bytes)
+    event_type = envelope.type
+    if event_type == message_pb2.EVENT_TYPE_MESSAGE:
+        return channel_names.name(envelope.chat.channel_id), envelope.chat.content
+    elif event_type == message_pb2.EVENT_TYPE_PERF_TEST:
+        return envelope.perf_test.perf_test_id
+    return envelope.channel_action.channel
+
+
+cases = [
+    (
+        "encode message",
+        lambda: parse_dict(chat_message),
+        lambda: codec.encode_chat_message(
+            channel_ids[chat_message["channel"]], chat_message["content"], username_id, sent_at_us, 1204, 87
+        ),
+    ),
+    (
+        "encode channel_subscriptions",
+        lambda: parse_dict(channel_subscriptions),
+        lambda: codec.encode_channel_subscriptions(channel_ids),
+    ),
+    (
+        "encode perf_test",
+        lambda: parse_dict(perf_test),
+        lambda: codec.encode_perf_test(*list(perf_test.values())[1:]),
+    ),
+] + [
+    (
+        f"decode {event}",
+        lambda legacy_bytes=legacy_bytes: message_to_dict(legacy_bytes),
+        lambda envelope_bytes=envelope_bytes: codec_decode(envelope_bytes),
+    )
+    for event, (legacy_bytes, envelope_bytes) in received.items()
+]
+
+
+def run(func) -> float:
+    t0 = time.perf_counter()
+    for _ in range(NUM_TESTS):
+        func()
+    return (time.perf_counter() - t0) * 1000
+
+
+if __name__ == "__main__":
+    # The encoders must produce the same messages as ParseDict, once converted back to a ChatMessage
+    for name, json_format_func, codec_func in cases[:3]:
+        assert message_pb2.ChatMessage.FromString(json_format_func()) == message_pb2.ChatMessage.FromString(envelope_to_legacy(codec_func(), channel_names, usernames)), name
+
+    print(f"{'':<30}{'json_format':>14}{'codec':>12}{'speedup':>10}{'bytes':>14}")
+    for name, json_format_func, codec_func in cases:
+        if name.startswith("encode"):
+            sizes = f"{len(json_format_func())} -> {len(codec_func())}"
+        else:
+            legacy_bytes, envelope_bytes = received[name.split()[1]]
+            sizes = f"{len(legacy_bytes)} -> {len(envelope_bytes)}"
+        json_format_time = run(json_format_func)
+        codec_time = run(codec_func)
+        print(f"{name:<30}{json_format_time:>11,.0f} ms{codec_time:>9,.0f} ms{json_format_time / codec_time:>9.1f}x{sizes:>14}")
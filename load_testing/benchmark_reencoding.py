@@ -0,0 +1,82 @@
+# Compares the server's two ways of turning a chat message received from a client into the message that is broadcast:
+#  - dict: parse, convert to a dict, add username_id and sent_at_us, ParseDict and serialize again (PASS_THROUGH_ENCODING = False)
+#  - pass-through: parse to validate, then append the pre-encoded username_id and sent_at_us fields to the received bytes
+# Run from the project root: python -m load_testing.benchmark_reencoding
+# For the end to end comparison, run the load test once with PASS_THROUGH_ENCODING = True and once with False in the server's .env
+
+import time
+
+from google.protobuf.internal import api_implementation
+from google.protobuf.json_format import ParseDict
+
+from server import message_pb2
+from server.services.codec import (
+    append_server_fields,
+    encode_username_id_field,
+    is_pass_through_chat_message,
+)
+
+print(f"This should be 'upb': {api_implementation.Type()=}\n")
+
+NUM_TESTS = 200000
+USERNAME_ID = 123
+CHANNEL_ID = 4
+MESSAGE_ID = 1204
+SEQ = 87
+
+received_bytes = message_pb2.Envelope(
+    version=2,
+    type=message_pb2.EVENT_TYPE_MESSAGE,
+    chat=message_pb2.Chat(channel_id=CHANNEL_ID, content="radio hammer apple seven orange"),
+).SerializeToString()
+username_id_field = encode_username_id_field(USERNAME_ID)
+
+
+def timestamp() -> int:
+    return time.time_ns() // 1000
+
+
+def dict_path() -> bytes:
+    envelope = message_pb2.Envelope()
+    envelope.ParseFromString(received_bytes)
+    message = {
+        "version": envelope.version,
+        "type": envelope.type,
+        "chat": {
+            "channel_id": envelope.chat.channel_id,
+            "content": envelope.chat.content,
+            "sent_at_us": timestamp(),
+            "username_id": USERNAME_ID,
+            "message_id": MESSAGE_ID,
+            "seq": SEQ,
+        },
+    }
+    return ParseDict(message, message_pb2.Envelope()).SerializeToString()
+
+
+def pass_through_path() -> bytes:
+    envelope = message_pb2.Envelope()
+    envelope.ParseFromString(received_bytes)
+    if is_pass_through_chat_message(envelope, received_bytes):
+        return append_server_fields(received_bytes, username_id_field, timestamp(), MESSAGE_ID, SEQ)
+
+
+def run(name: str, func) -> float:
+    t0 = time.perf_counter()
+    for _ in range(NUM_TESTS):
+        func()
+    elapsed = (time.perf_counter() - t0) * 1000
+    print(f"{name:<14}{elapsed:>9,.0f} ms   {elapsed * 1000 / NUM_TESTS:.2f} us/message")
+    return elapsed
+
+
+if __name__ == "__main__":
+    # Both paths must produce a message that decodes to the same fields
+    dict_message = message_pb2.Envelope.FromString(dict_path())
+    pass_through_message = message_pb2.Envelope.FromString(pass_through_path())
+    dict_message.chat.sent_at_us = pass_through_message.chat.sent_at_us = 0
+    assert dict_message == pass_through_message
+
+    dict_time = run("dict:", dict_path)
+    pass_through_time = run("pass-through:", pass_through_path)
+    print(f"\nSpeedup: {dict_time / pass_through_time:.1f}x")
@@ -14,6 +14,8 @@ load_dotenv()
 
 URL = getenv("URL")
 # URL = "http://127.0.0.1:8000"
+# Logins and account creation go to the auth server when it runs separately from the chat server
+AUTH_URL = getenv("AUTH_URL") or URL
 WS_URL = getenv("WS_URL")
 # WS_URL = "ws://127.0.0.1:8000"
 LOGIN_ENDPOINT = "/auth/token"
@@ -43,7 +45,7 @@ def create_account_on_server(s: requests.Session, username: str, password: str):
         "password": password,
     }
 
-    response = s.post(f"{URL}{CREATE_ACCOUNT_ENDPOINT}", json=account_info)
+    response = s.post(f"{AUTH_URL}{CREATE_ACCOUNT_ENDPOINT}", json=account_info)
     response.raise_for_status()
 
 
@@ -69,7 +71,7 @@ async def get_auth_token(session: aiohttp.ClientSession, username, password) ->
         "username": username,
         "password": password,
     }
-    async with session.post(f"{URL}{LOGIN_ENDPOINT}", data=payload) as response:
+    async with session.post(f"{AUTH_URL}{LOGIN_ENDPOINT}", data=payload) as response:
         response.raise_for_status()
         return await response.json()
 
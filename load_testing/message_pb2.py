@@ -24,13 +24,37 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rmessage.proto\"\x9a\x02\n\x0b\x43hatMessage\x12\x0f\n\x07latency\x18\x01 \x01(\x02\x12\x14\n\x0cperf_test_id\x18\x02 \x01(\x05\x12\x10\n\x08\x63pu_load\x18\x03 \x03(\x02\x12\x14\n\x0cmemory_usage\x18\x04 \x01(\x02\x12\x1a\n\x12\x61\x63tive_connections\x18\x05 \x01(\x05\x12\x16\n\x0emessage_volume\x18\x06 \x01(\x05\x12\x11\n\tmv_period\x18\x07 \x01(\x02\x12\x13\n\x0bmv_adjusted\x18\x08 \x01(\x05\x12\r\n\x05\x65vent\x18\t \x01(\t\x12\x10\n\x08username\x18\n \x01(\t\x12\x0f\n\x07sent_at\x18\x0b \x01(\t\x12\x0f\n\x07\x63hannel\x18\x0c \x01(\t\x12\x0f\n\x07\x63ontent\x18\r \x01(\t\x12\x0c\n\x04\x64\x61ta\x18\x0e \x03(\tb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rmessage.proto\"\xb7\x02\n\x0b\x43hatMessage\x12\x0f\n\x07latency\x18\x01 \x01(\x02\x12\x14\n\x0cperf_test_id\x18\x02 \x01(\x05\x12\x10\n\x08\x63pu_load\x18\x03 \x03(\x02\x12\x14\n\x0cmemory_usage\x18\x04 \x01(\x02\x12\x1a\n\x12\x61\x63tive_connections\x18\x05 \x01(\x05\x12\x16\n\x0emessage_volume\x18\x06 \x01(\x05\x12\x11\n\tmv_period\x18\x07 \x01(\x02\x12\x13\n\x0bmv_adjusted\x18\x08 \x01(\x05\x12\r\n\x05\x65vent\x18\t \x01(\t\x12\x10\n\x08username\x18\n \x01(\t\x12\x0f\n\x07sent_at\x18\x0b \x01(\t\x12\x0f\n\x07\x63hannel\x18\x0c \x01(\t\x12\x0f\n\x07\x63ontent\x18\r \x01(\t\x12\x0c\n\x04\x64\x61ta\x18\x0e \x03(\t\x12\x1b\n\x05\x62\x61tch\x18\x0f \x03(\x0b\x32\x0c.ChatMessage\"\xf1\x02\n\x08\x45nvelope\x12\x0f\n\x07version\x18\x01 \x01(\r\x12\x18\n\x04type\x18\x02 \x01(\x0e\x32\n.EventType\x12\x15\n\x04\x63hat\x18\x03 \x01(\x0b\x32\x05.ChatH\x00\x12\x36\n\x15\x63hannel_subscriptions\x18\x04 \x01(\x0b\x32\x15.ChannelSubscriptionsH\x00\x12(\n\x0e\x63hannel_action\x18\x05 \x01(\x0b\x32\x0e.ChannelActionH\x00\x12\x1e\n\tperf_test\x18\x06 \x01(\x0b\x32\t.PerfTestH\x00\x12\x17\n\x05\x62\x61tch\x18\x07 \x01(\x0b\x32\x06.BatchH\x00\x12\x19\n\x06intern\x18\x08 \x01(\x0b\x32\x07.InternH\x00\x12*\n\x0fhistory_request\x18\t \x01(\x0b\x32\x0f.HistoryRequestH\x00\x12\x1b\n\x07history\x18\n \x01(\x0b\x32\x08.HistoryH\x00\x12\x19\n\x06resume\x18\x0b \x01(\x0b\x32\x07.ResumeH\x00\x42\t\n\x07payload\"\xa7\x01\n\x04\x43hat\x12\x0f\n\x07\x63hannel\x18\x01 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x02 \x01(\t\x12\x10\n\x08username\x18\x03 \x01(\t\x12\x12\n\nchannel_id\x18\x05 \x01(\r\x12\x13\n\x0busername_id\x18\x06 \x01(\r\x12\x12\n\nsent_at_us\x18\x07 \x01(\x03\x12\x12\n\nmessage_id\x18\x08 \x01(\x04\x12\x0b\n\x03seq\x18\t \x01(\x04J\x04\x08\x04\x10\x05R\x07sent_at\"=\n\x14\x43hannelSubscriptions\x12\x10\n\x08\x63hannels\x18\x01 \x03(\t\x12\x13\n\x0b\x63hannel_ids\x18\x02 \x03(\r\" \n\rChannelAction\x12\x0f\n\x07\x63hannel\x18\x01 \x01(\t\"\xa4\x01\n\x08PerfTest\x12\x14\n\x0cperf_test_id\x18\x01 \x01(\x05\x12\x10\n\x08\x63pu_load\x18\x02 \x03(\x02\x12\x14\n\x0cmemory_usage\x18\x03 \x01(\x02\x12\x1a\n\x12\x61\x63tive_connections\x18\x04 \x01(\x05\x12\x16\n\x0emessage_volume\x18\x05 \x01(\x05\x12\x11\n\tmv_period\x18\x06 \x01(\x02\x12\x13\n\x0bmv_adjusted\x18\x07 \x01(\x05\"%\n\x05\x42\x61tch\x12\x1c\n\tenvelopes\x18\x01 \x03(\x0b\x32\t.Envelope\"E\n\x06Intern\x12\x1e\n\x08\x63hannels\x18\x01 \x03(\x0b\x32\x0c.InternEntry\x12\x1b\n\x05users\x18\x02 \x03(\x0b\x32\x0c.InternEntry\"\'\n\x0bInternEntry\x12\n\n\x02id\x18\x01 \x01(\r\x12\x0c\n\x04name\x18\x02 \x01(\t\"i\n\x0eHistoryRequest\x12\x12\n\nchannel_id\x18\x01 \x01(\r\x12\x0f\n\x07\x63hannel\x18\x02 \x01(\t\x12\x11\n\tbefore_id\x18\x03 \x01(\x04\x12\x10\n\x08\x61\x66ter_id\x18\x04 \x01(\x04\x12\r\n\x05limit\x18\x05 \x01(\r\"H\n\x07History\x12\x12\n\nchannel_id\x18\x01 \x01(\r\x12\x17\n\x08messages\x18\x02 \x03(\x0b\x32\x05.Chat\x12\x10\n\x08has_more\x18\x03 \x01(\x08\">\n\x06Resume\x12\x1b\n\x13resumed_channel_ids\x18\x01 \x03(\r\x12\x17\n\x0fgap_channel_ids\x18\x02 \x03(\r*\x95\x02\n\tEventType\x12\x1a\n\x16\x45VENT_TYPE_UNSPECIFIED\x10\x00\x12\x16\n\x12\x45VENT_TYPE_MESSAGE\x10\x01\x12$\n EVENT_TYPE_CHANNEL_SUBSCRIPTIONS\x10\x02\x12\x1a\n\x16\x45VENT_TYPE_ADD_CHANNEL\x10\x03\x12\x1c\n\x18\x45VENT_TYPE_LEAVE_CHANNEL\x10\x04\x12\x18\n\x14\x45VENT_TYPE_PERF_TEST\x10\x05\x12\x14\n\x10\x45VENT_TYPE_BATCH\x10\x06\x12\x15\n\x11\x45VENT_TYPE_INTERN\x10\x07\x12\x16\n\x12\x45VENT_TYPE_HISTORY\x10\x08\x12\x15\n\x11\x45VENT_TYPE_RESUME\x10\tb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'message_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
+  _globals['_EVENTTYPE']._serialized_start=1534
+  _globals['_EVENTTYPE']._serialized_end=1811
   _globals['_CHATMESSAGE']._serialized_start=18
-  _globals['_CHATMESSAGE']._serialized_end=300
+  _globals['_CHATMESSAGE']._serialized_end=329
+  _globals['_ENVELOPE']._serialized_start=332
+  _globals['_ENVELOPE']._serialized_end=701
+  _globals['_CHAT']._serialized_start=704
+  _globals['_CHAT']._serialized_end=871
+  _globals['_CHANNELSUBSCRIPTIONS']._serialized_start=873
+  _globals['_CHANNELSUBSCRIPTIONS']._serialized_end=934
+  _globals['_CHANNELACTION']._serialized_start=936
+  _globals['_CHANNELACTION']._serialized_end=968
+  _globals['_PERFTEST']._serialized_start=971
+  _globals['_PERFTEST']._serialized_end=1135
+  _globals['_BATCH']._serialized_start=1137
+  _globals['_BATCH']._serialized_end=1174
+  _globals['_INTERN']._serialized_start=1176
+  _globals['_INTERN']._serialized_end=1245
+  _globals['_INTERNENTRY']._serialized_start=1247
+  _globals['_INTERNENTRY']._serialized_end=1286
+  _globals['_HISTORYREQUEST']._serialized_start=1288
+  _globals['_HISTORYREQUEST']._serialized_end=1393
+  _globals['_HISTORY']._serialized_start=1395
+  _globals['_HISTORY']._serialized_end=1467
+  _globals['_RESUME']._serialized_start=1469
+  _globals['_RESUME']._serialized_end=1531
 # @@protoc_insertion_point(module_scope)
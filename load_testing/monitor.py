@@ -66,16 +66,16 @@ class Monitor(User):
         self.logger.debug("Monitor listening for messages")
         while self.connection_active:
             try:
-                message = await self.client_websocket.receive_message()
-                self.logger.debug(f"Monitor received: {message=}")
-                if message is not None:
+                messages = await self.client_websocket.receive_messages()
+                self.logger.debug(f"Monitor received: {messages=}")
+                for message in messages or []:
                     event_type = message.get("event")
                     if event_type == "perf_test":
                         await self.handle_perf_response(message)
             except asyncio.CancelledError as e:
                 pass 
             except Exception as e:
-                self.logger.warning(message)
+                self.logger.warning(messages)
                 if self.connection_active:
                     self.logger.warning(f"Monitor listener Exception: {self.connection_active=}, {e}", exc_info=True)
                     # traceback.print_tb(e.__traceback__)
@@ -14,9 +14,13 @@ load_dotenv()
 
 URL = "http://127.0.0.1:8000"
 URL = getenv("URL")
+# Logins and account creation go to the auth server when it runs separately from the chat server
+AUTH_URL = getenv("AUTH_URL") or URL
 WS_URL = "ws://127.0.0.1:8000"
 WS_URL = getenv("WS_URL")
 LOGIN_ENDPOINT = "/auth/token"
+# Seconds to wait before retrying a failed login, unless the server says how long with Retry-After
+AUTH_RETRY_DELAY = 2
 
 MAX_MESSAGE_LENGTH = 10
 
@@ -84,24 +88,33 @@ class User:
         )
 
     async def get_auth_token(self) -> dict | None:
-        """Submits username and password to get a bearer token from the server, repeats if unsuccessful"""
-        try:
-            payload = {
-                "username": self.username,
-                "password": self.password,
-            }
-            async with aiohttp.request(
-                "POST", f"{URL}{LOGIN_ENDPOINT}", data=payload
-            ) as response:
-                response.raise_for_status()
-                self.logger.debug(f"{self.username}: Auth token received!")
-                return await response.json()
-        except Exception as e:
-            self.logger.info(
-                f"{self.username}: Auth token request failed, retrying: {e}"
-            )
-            await asyncio.sleep(2)
-            return await self.get_auth_token()
+        """Submits username and password to get a bearer token from the server, repeats if unsuccessful. When the server turns the login away with a Retry-After header, waits as long as it asks, plus some jitter so refused users don't all retry at once"""
+        payload = {
+            "username": self.username,
+            "password": self.password,
+        }
+        while True:
+            retry_delay = AUTH_RETRY_DELAY
+            try:
+                async with aiohttp.request(
+                    "POST", f"{AUTH_URL}{LOGIN_ENDPOINT}", data=payload
+                ) as response:
+                    if response.status in (429, 503) and "Retry-After" in response.headers:
+                        retry_delay = float(response.headers["Retry-After"])
+                        retry_delay += random.uniform(0, retry_delay)
+                        self.logger.debug(
+                            f"{self.username}: Login refused with {response.status}, retrying in {retry_delay:.1f}s"
+                        )
+                        await asyncio.sleep(retry_delay)
+                        continue
+                    response.raise_for_status()
+                    self.logger.debug(f"{self.username}: Auth token received!")
+                    return await response.json()
+            except Exception as e:
+                self.logger.info(
+                    f"{self.username}: Auth token request failed, retrying: {e}"
+                )
+            await asyncio.sleep(retry_delay)
 
     async def join_channel(self, channel_name):
         """Join the specified channel"""
@@ -199,8 +212,8 @@ class User:
     async def listen_for_messages(self):
         while self.connection_active:
             try:
-                message: dict = await self.client_websocket.receive_message()
-                if message is not None:
+                messages: list[dict] = await self.client_websocket.receive_messages()
+                for message in messages or []:
                     event_type = message.get("event")
                     if event_type == "channel_subscriptions":
                         new_channels = message.get("data")
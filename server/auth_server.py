@@ -0,0 +1,100 @@
+# Standalone server for logins and account creation, so the CPU cost of hashing passwords is kept out of the chat server's process.
+# It issues tokens signed with the private key (JWT_PRIVATE_KEY_FILE) over the same database as the chat server, which only holds the public key (JWT_PUBLIC_KEY_FILE) to verify them with.
+# Run from the server directory: uvicorn auth_server:app --port 8001
+
+import psutil
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Lets routers/auth.py read the private key, which no other process does
+os.environ["RUN_AS_AUTH_SERVER"] = "1"
+
+# Cores for the auth server, as a comma separated list. Defaults to every core but 0, which the chat server pins itself to
+AUTH_SERVER_CPUS = os.getenv("AUTH_SERVER_CPUS")
+
+p = psutil.Process(os.getpid())
+if AUTH_SERVER_CPUS:
+    p.cpu_affinity([int(cpu) for cpu in AUTH_SERVER_CPUS.split(",")])
+elif (os.cpu_count() or 1) > 1:
+    p.cpu_affinity(list(range(1, os.cpu_count())))
+
+import logging
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, status
+
+try:
+    from routers.auth import router as auth_router
+    from routers.auth import SERVES_LOGINS, auth_metrics, login_router
+except:
+    from server.routers.auth import router as auth_router
+    from server.routers.auth import SERVES_LOGINS, auth_metrics, login_router
+
+try:
+    from services.db_manager import db
+    from services.async_db_manager import adb
+    from services.password_hasher import password_hasher
+except:
+    from server.services.db_manager import db
+    from server.services.async_db_manager import adb
+    from server.services.password_hasher import password_hasher
+
+logger = logging.getLogger('Auth server')
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+formatter.datefmt = '%H:%M:%S'
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+if not SERVES_LOGINS:
+    raise RuntimeError("The auth server needs a key to sign tokens with, set SECRET_KEY or JWT_PRIVATE_KEY_FILE")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup logic
+    db.writer.start()
+    password_hasher.start()
+    logger.info(f"Auth server running on cores {p.cpu_affinity()}, {password_hasher.workers} password hasher processes")
+
+    yield
+
+    # Shutdown logic
+    await db.writer.stop()
+    await adb.close()
+    await password_hasher.close()
+    db.close_all()
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.include_router(auth_router)
+app.include_router(login_router)
+
+
+# Endpoint to get server health
+@app.get("/", status_code=status.HTTP_200_OK)
+async def server_health():
+    """Verify connection to database and return server health"""
+    db_status = await db.verify_connection_and_tables()
+    if db_status.get("status"):
+        return {"status": "ready"}
+
+    return {"status": db_status["details"]}
+
+
+# Endpoint to ping server
+@app.get("/ping", status_code=status.HTTP_200_OK)
+async def ping():
+    """Get a static response from server"""
+    return {"status": "alive"}
+
+
+@app.get("/metrics/auth")
+async def auth_metrics_endpoint():
+    """Logins admitted and refused, how often account lookups are served from the cache, and load on the password hasher processes"""
+    return auth_metrics()
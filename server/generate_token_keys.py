@@ -0,0 +1,45 @@
+# Generates the RSA key pair the auth server signs tokens with (JWT_PRIVATE_KEY_FILE) and the chat server verifies them with (JWT_PUBLIC_KEY_FILE), for ALGORITHM = RS256.
+# Only the auth server should be given the private key.
+# Run from the server directory: python generate_token_keys.py [private_key_file] [public_key_file]
+
+import sys
+from os import makedirs, path
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+PRIVATE_KEY_FILE = "services/db_data/jwt_private.pem"
+PUBLIC_KEY_FILE = "services/db_data/jwt_public.pem"
+KEY_SIZE = 2048
+
+
+def generate_token_keys(private_key_file: str, public_key_file: str):
+    """
+    Generates an RSA key pair and writes both keys as PEM files.
+
+    Args:
+        private_key_file (str): Where to write the private key.
+        public_key_file (str): Where to write the public key.
+    """
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=KEY_SIZE)
+    private_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+
+    for filepath, pem in ((private_key_file, private_pem), (public_key_file, public_pem)):
+        makedirs(path.dirname(filepath) or ".", exist_ok=True)
+        with open(filepath, "wb") as f:
+            f.write(pem)
+        print(f"Wrote {filepath}")
+
+
+if __name__ == "__main__":
+    private_key_file = sys.argv[1] if len(sys.argv) > 1 else PRIVATE_KEY_FILE
+    public_key_file = sys.argv[2] if len(sys.argv) > 2 else PUBLIC_KEY_FILE
+    generate_token_keys(private_key_file, public_key_file)
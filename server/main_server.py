@@ -12,27 +12,34 @@ from pprint import pprint
 import platform
 
 from fastapi import (
+    Depends,
     FastAPI,
+    Query,
     WebSocket,
     WebSocketDisconnect,
     HTTPException,
     status,
 )
-from pydantic import BaseModel, Field
 
 try:
     from routers.auth import router as auth_router
-    from routers.auth import get_current_active_user, get_current_user
+    from routers.auth import SERVES_LOGINS, User, auth_metrics, get_current_active_user, get_current_user, login_router
 except:
     from server.routers.auth import router as auth_router
-    from server.routers.auth import get_current_active_user, get_current_user
+    from server.routers.auth import SERVES_LOGINS, User, auth_metrics, get_current_active_user, get_current_user, login_router
 
 try:
     from services.db_manager import db
+    from services.async_db_manager import adb
     from services.connection_manager import ConnectionManager
+    from services.password_hasher import password_hasher
+    from services.websocket_frames import RawTransportMiddleware
 except:
     from server.services.db_manager import db
+    from server.services.async_db_manager import adb
     from server.services.connection_manager import ConnectionManager
+    from server.services.password_hasher import password_hasher
+    from server.services.websocket_frames import RawTransportMiddleware
 
 os_name = platform.platform()
 if "Windows" in os_name:
@@ -54,26 +61,46 @@ async def lifespan(app: FastAPI):
     loop = asyncio.get_event_loop()
     # loop_type = "uvloop" if "uvloop" in str(type(loop)).lower() else type(loop).__name__
     print(f"Current event loop: {str(type(loop))}")
+    db.writer.start()
+    if SERVES_LOGINS:
+        password_hasher.start()
+    else:
+        logger.info("Tokens are verified with the public key only, logins are served by the auth server")
+    connection_man.journal.start()
+    connection_man.subscription_journal.start()
+    connection_man.message_flush.start()
+    connection_man.subscription_flush.start()
 
     yield
 
     # Shutdown logic
-    if connection_man.listener_task:
-        connection_man.listener_task.cancel()
-        try:
-            await connection_man.listener_task
-        except asyncio.CancelledError:
-            pass
+    await connection_man.message_flush.stop()
+    await connection_man.subscription_flush.stop()
     # Close all active WebSocket connections
     for connection in connection_man.active_connections.values():
+        connection["outbound"].stop()
         await connection["ws"].close()
     connection_man.active_connections.clear()
+    # Write any cached messages and subscription changes, then wait for the writer thread to commit everything queued. Anything that fails to write stays in the journals for the next start
+    await connection_man.message_flush.flush_now()
+    await connection_man.subscription_flush.flush_now()
+    await db.writer.stop()
+    await connection_man.journal.close()
+    await connection_man.subscription_journal.close()
+    await adb.close()
+    await password_hasher.close()
     db.close_all()
 
 
 app = FastAPI(lifespan=lifespan)
 
+# Lets outbound queues write pre-built websocket frames directly to the connection's transport
+app.add_middleware(RawTransportMiddleware)
+
 app.include_router(auth_router)
+# Without the key to sign tokens with, logins and account creation are left to the auth server, see auth_server.py
+if SERVES_LOGINS:
+    app.include_router(login_router)
 
 # Endpoint to get server health
 @app.get("/", status_code=status.HTTP_200_OK)
@@ -140,18 +167,39 @@ async def check_loop():
         }
 
 
-connection_man = ConnectionManager(logger, db)
+connection_man = ConnectionManager(logger, db, adb)
+
+
+@app.get("/metrics/flush")
+async def flush_metrics():
+    """Sizes and durations of the database flushes of cached messages and subscription changes"""
+    return {
+        "messages": connection_man.message_flush.metrics(),
+        "subscriptions": connection_man.subscription_flush.metrics(),
+    }
 
 
-class AccountCreate(BaseModel):
-    username: str = Field(..., min_length=3, max_length=50)
-    password: str = Field(..., min_length=6, max_length=255)
+@app.get("/metrics/auth")
+async def auth_metrics_endpoint():
+    """Logins admitted and refused, how often tokens and account lookups are served from their caches, and load on the password hasher processes"""
+    return auth_metrics()
 
 
-@app.post("/create_account", status_code=status.HTTP_201_CREATED)
-async def create_account_endpoint(account: AccountCreate):
-    """Endpoint to create an account"""
-    return db.create_account(account.username, account.password)
+@app.get("/history/{channel}")
+async def channel_history(
+    channel: str,
+    before_id: int | None = Query(None, ge=1),
+    after_id: int | None = Query(None, ge=0),
+    limit: int = Query(0, ge=0),
+    current_user: User = Depends(get_current_active_user),
+):
+    """Endpoint to get a page of a channel's message history, oldest first. With before_id the page ends just before that message (the latest messages if omitted), with after_id it starts just after it"""
+    if not await connection_man.is_subscribed(current_user.username, channel):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Not subscribed to channel"
+        )
+    messages, has_more = await connection_man.get_channel_history(channel, before_id, after_id, limit)
+    return {"channel": channel, "messages": messages, "has_more": has_more}
 
 
 @app.websocket("/ws")
@@ -186,15 +234,16 @@ async def websocket_endpoint(websocket: WebSocket):
                     pass
                 else:
                     logger.warning(f"Websocket endpoint {type(e).__name__}: {e}")
-                await connection_man.disconnect(active_user.username)
+                await connection_man.disconnect(active_user.username, websocket)
+                return
             try:
                 await connection_man.handle_incoming_message(message, active_user.username)
             except Exception as e:
                 print(f"Exception during 'while True' loop of main_server websocket endpoint: {type(e).__name__}: {e}")
-                await connection_man.disconnect(active_user.username)
+                await connection_man.disconnect(active_user.username, websocket)
     except WebSocketDisconnect:
-        await connection_man.disconnect(active_user.username)
+        await connection_man.disconnect(active_user.username, websocket)
     except asyncio.CancelledError:
-        await connection_man.disconnect(active_user.username)
+        await connection_man.disconnect(active_user.username, websocket)
     except Exception as e:
         logger.warning(f"Websocket endpoint Exception: {type(e).__name__}: {e}", exc_info=True)
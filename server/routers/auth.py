@@ -1,26 +1,73 @@
-from os import getenv
+import math
+from os import getenv, path
 from datetime import datetime, timedelta, timezone
 
-from fastapi import Depends, HTTPException, status, APIRouter
+from fastapi import Depends, HTTPException, Request, status, APIRouter
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from jose import JWTError, ExpiredSignatureError, jwt
-from passlib.context import CryptContext
 from dotenv import load_dotenv
 
 try:
-    from services.db_manager import db
+    from services.async_db_manager import adb
+    from services.password_hasher import password_hasher
+    from services.token_bucket import TokenBuckets
+    from services.token_cache import TokenCache
 except:
-    from server.services.db_manager import db
+    from server.services.async_db_manager import adb
+    from server.services.password_hasher import password_hasher
+    from server.services.token_bucket import TokenBuckets
+    from server.services.token_cache import TokenCache
 
 
 load_dotenv()
 
 SECRET_KEY = getenv("SECRET_KEY")
 ALGORITHM = getenv("ALGORITHM")
+# PEM files for asymmetric algorithms such as RS256, relative to the server directory. Only the process serving logins, normally the auth server (auth_server.py), needs the private key. See generate_token_keys.py
+JWT_PRIVATE_KEY_FILE = getenv("JWT_PRIVATE_KEY_FILE")
+JWT_PUBLIC_KEY_FILE = getenv("JWT_PUBLIC_KEY_FILE")
+# Set by auth_server.py before it imports this module. The private key is only read in the auth server's process, even if JWT_PRIVATE_KEY_FILE is set for the chat server too
+RUN_AS_AUTH_SERVER = getenv("RUN_AS_AUTH_SERVER") == "1"
 ACCESS_TOKEN_EXPIRE_MINUTES = 600
 ROUTER_PREFIX = "/auth"
-CRYPTCONTEXT_SCHEME = getenv("CRYPTCONTEXT_SCHEME")
+# Logins each client IP address may make per second, 0 for no limit, and the most it may make at once after being idle
+LOGIN_RATE_PER_SOURCE = float(getenv("LOGIN_RATE_PER_SOURCE", 10))
+LOGIN_BURST_PER_SOURCE = float(getenv("LOGIN_BURST_PER_SOURCE", 20))
+# Most client IP addresses whose login rate is tracked at once
+LOGIN_MAX_SOURCES = int(getenv("LOGIN_MAX_SOURCES", 10000))
+# Most verified access tokens cached, so reconnects with the same token skip signature verification, 0 to cache none
+TOKEN_CACHE_SIZE = int(getenv("TOKEN_CACHE_SIZE", 50000))
+
+SERVER_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+def read_key_file(filepath: str | None) -> str | None:
+    """
+    Read a PEM key file.
+
+    Args:
+        filepath (str | None): Path to the file, relative to the server directory unless absolute.
+
+    Returns:
+        str | None: The key, or None if no file is configured.
+    """
+    if not filepath:
+        return None
+    with open(path.join(SERVER_DIR, filepath)) as f:
+        return f.read()
+
+
+# HS* algorithms sign and verify tokens with SECRET_KEY. Others sign with the private key and verify with the public key, so a process can verify tokens without being able to issue them
+if (ALGORITHM or "").startswith("HS"):
+    SIGNING_KEY: str | None = SECRET_KEY
+    VERIFYING_KEY: str | None = SECRET_KEY
+else:
+    SIGNING_KEY = read_key_file(JWT_PRIVATE_KEY_FILE) if RUN_AS_AUTH_SERVER else None
+    VERIFYING_KEY = read_key_file(JWT_PUBLIC_KEY_FILE)
+
+# Whether this process can issue tokens, and so serve logins and account creation
+SERVES_LOGINS = SIGNING_KEY is not None
 
 
 class Token(BaseModel):
@@ -41,14 +88,20 @@ class UserInDB(User):
     password_hashed: str
 
 
-pwd_context = CryptContext(schemes=[CRYPTCONTEXT_SCHEME], deprecated="auto")
+class AccountCreate(BaseModel):
+    username: str = Field(..., min_length=3, max_length=50)
+    password: str = Field(..., min_length=6, max_length=255)
+
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{ROUTER_PREFIX}/token")
 
+login_buckets = TokenBuckets(LOGIN_RATE_PER_SOURCE, LOGIN_BURST_PER_SOURCE, LOGIN_MAX_SOURCES)
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
 
-def verify_password(plaintext_password: str, password_hashed: str):
+
+async def verify_password(plaintext_password: str, password_hashed: str):
     """
-    Verify that a plaintext password matches its hashed version.
+    Verify that a plaintext password matches its hashed version, on a password hasher process.
 
     Args:
         plaintext_password (str): The plaintext password to verify.
@@ -56,24 +109,30 @@ def verify_password(plaintext_password: str, password_hashed: str):
 
     Returns:
         bool: True if the password matches, False otherwise.
+
+    Raises:
+        HTTPException: 503 if the password hasher is too busy to take the request.
     """
-    return pwd_context.verify(plaintext_password, password_hashed)
+    return await password_hasher.verify(plaintext_password, password_hashed)
 
 
-def get_password_hash(plaintext_password: str):
+async def get_password_hash(plaintext_password: str):
     """
-    Hash a plaintext password using the configured hashing algorithm.
+    Hash a plaintext password using the configured hashing algorithm, on a password hasher process.
 
     Args:
         plaintext_password (str): The plaintext password to hash.
 
     Returns:
         str: The hashed password.
+
+    Raises:
+        HTTPException: 503 if the password hasher is too busy to take the request.
     """
-    return pwd_context.hash(plaintext_password)
+    return await password_hasher.hash(plaintext_password)
 
 
-def get_user(username: str):
+async def get_user(username: str):
     """
     Retrieve a user from the database by username.
 
@@ -83,13 +142,12 @@ def get_user(username: str):
     Returns:
         UserInDB: The user object if found, None otherwise.
     """
-    accounts: dict = db.retrieve_existing_accounts()
-    if username in accounts:
-        user_data = accounts[username]
+    user_data: dict | None = await adb.retrieve_account(username)
+    if user_data is not None:
         return UserInDB(**user_data)
 
 
-def authenticate_user(username: str, password: str):
+async def authenticate_user(username: str, password: str):
     """
     Authenticate a user by verifying their credentials.
 
@@ -100,10 +158,10 @@ def authenticate_user(username: str, password: str):
     Returns:
         UserInDB: The authenticated user object if successful, False otherwise.
     """
-    user: UserInDB = get_user(username)
+    user: UserInDB = await get_user(username)
     if not user:
         return False
-    if not verify_password(password, user.password_hashed):
+    if not await verify_password(password, user.password_hashed):
         return False
 
     return user
@@ -119,6 +177,9 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 
     Returns:
         str: The encoded JWT.
+
+    Raises:
+        RuntimeError: If this process has no key to sign tokens with.
     """
     to_encode: dict = data.copy()
 
@@ -130,31 +191,30 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 
     to_encode["exp"] = expire
 
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    if SIGNING_KEY is None:
+        raise RuntimeError("No key to sign tokens with, set JWT_PRIVATE_KEY_FILE or serve logins from the auth server")
+
+    encoded_jwt = jwt.encode(to_encode, SIGNING_KEY, algorithm=ALGORITHM)
 
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInDB:
+def decode_access_token(token: str, credential_exception: HTTPException) -> TokenData:
     """
-    Retrieve the current user based on the provided JWT token.
+    Verify a JWT token's signature and expiry, and add it to the token cache.
 
     Args:
-        token (str): The OAuth2 token provided in the request.
+        token (str): The encoded token.
+        credential_exception (HTTPException): Raised if the token is invalid.
 
     Raises:
-        HTTPException: If the token is invalid, expired, or the user cannot be found.
+        HTTPException: If the token is invalid or expired.
 
     Returns:
-        UserInDB: The current authenticated user.
+        TokenData: The username the token was issued to.
     """
-    credential_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, VERIFYING_KEY, algorithms=[ALGORITHM])
 
         username: str = payload.get("sub")
         if username is None:
@@ -172,7 +232,38 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInDB:
     except JWTError:
         raise credential_exception
 
-    user: UserInDB = get_user(username=token_data.username)
+    # Tokens without an expiry are valid until the secret key changes, so aren't cached
+    if isinstance(payload.get("exp"), (int, float)):
+        token_cache.put(token, username, payload["exp"])
+
+    return token_data
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInDB:
+    """
+    Retrieve the current user based on the provided JWT token. Tokens verified before are found in the token cache, and only decoded again once they expire.
+
+    Args:
+        token (str): The OAuth2 token provided in the request.
+
+    Raises:
+        HTTPException: If the token is invalid, expired, or the user cannot be found.
+
+    Returns:
+        UserInDB: The current authenticated user.
+    """
+    credential_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    username: str | None = token_cache.get(token)
+    if username is not None:
+        token_data = TokenData(username=username)
+    else:
+        token_data = decode_access_token(token, credential_exception)
+
+    user: UserInDB = await get_user(username=token_data.username)
 
     if user is None:
         raise credential_exception
@@ -203,10 +294,33 @@ async def get_current_active_user(
     return current_user
 
 
+async def admit_login(request: Request) -> None:
+    """
+    Admission control for logins, run before the credentials are looked at. Each client IP address has a token bucket limiting how often it may log in, and logins are refused while the password hasher's queue is full, so a login storm is turned away quickly rather than queueing behind argon2.
+
+    Args:
+        request (Request): The login request.
+
+    Raises:
+        HTTPException: 429 if the client has used up its logins for now, or 503 if the password hasher is too busy, with a Retry-After header either way.
+    """
+    source: str = request.client.host if request.client else "unknown"
+    wait: float = login_buckets.take(source)
+    if wait:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, try again shortly",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+        )
+    password_hasher.admit()
+
+
 router = APIRouter(prefix=ROUTER_PREFIX)
+# Endpoints that hash passwords and issue tokens, included by whichever process serves logins
+login_router = APIRouter()
 
 
-@router.post("/token", response_model=Token)
+@login_router.post(f"{ROUTER_PREFIX}/token", response_model=Token, dependencies=[Depends(admit_login)])
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
 ) -> dict:
@@ -217,12 +331,12 @@ async def login_for_access_token(
         form_data (OAuth2PasswordRequestForm): The login form data containing username and password.
 
     Raises:
-        HTTPException: If the credentials are invalid.
+        HTTPException: If the credentials are invalid, or the login is refused by `admit_login()`.
 
     Returns:
         dict: A dictionary containing the access token and token type.
     """
-    user: UserInDB = authenticate_user(form_data.username, form_data.password)
+    user: UserInDB = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -237,6 +351,47 @@ async def login_for_access_token(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+@login_router.post("/create_account", status_code=status.HTTP_201_CREATED)
+async def create_account_endpoint(account: AccountCreate) -> dict:
+    """
+    Create an account.
+
+    Args:
+        account (AccountCreate): The username and password.
+
+    Raises:
+        HTTPException: If the username already exists, the password hasher is too busy, or the account can't be created.
+
+    Returns:
+        dict: Success message on account creation.
+    """
+    return await adb.create_account(account.username, account.password)
+
+
+def auth_metrics() -> dict:
+    """
+    Collect the auth path's metrics, for the servers' /metrics/auth endpoints.
+
+    Returns:
+        dict: Logins admitted and refused, how often tokens and account lookups are served from their caches, and load on the password hasher processes.
+    """
+    return {
+        "serves_logins": SERVES_LOGINS,
+        "login_admission": {
+            "sources": len(login_buckets.buckets),
+            "admitted": login_buckets.admitted,
+            "refused": login_buckets.refused,
+        },
+        "token_cache": token_cache.metrics(),
+        "password_hasher": password_hasher.metrics(),
+        "account_cache": {
+            "cached_accounts": len(adb.account_cache.accounts),
+            "hits": adb.account_cache.hits,
+            "misses": adb.account_cache.misses,
+        },
+    }
+
+
 @router.get("/")
 def ping() -> str:
     """
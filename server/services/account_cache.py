@@ -0,0 +1,84 @@
+import time
+from collections import OrderedDict
+
+
+class AccountCache:
+    """
+    Bounded cache of accounts read from the `users` table, so the account lookup on every login and websocket connect doesn't go to SQLite each time.
+
+    Accounts are kept in least recently used order and the least recently used is dropped once `max_size` are cached. Each entry expires `ttl` seconds after it was read, which bounds how long a change made outside this process, such as an account disabled directly in the database, can go unnoticed. Changes made through the server call `invalidate()`.
+
+    Only accounts that exist are cached, so an account created by another process can log in straight away.
+
+    A read that started before an invalidation could otherwise cache the account as it was before the change, so `put()` takes the `version` read before the lookup started, and ignores the account if anything was invalidated since.
+
+    Attributes:
+        max_size (int): Maximum number of accounts cached, 0 to cache none.
+        ttl (float): Seconds an account is cached for.
+        accounts (OrderedDict): Maps usernames to the time the entry expires and the account, least recently used first.
+        version (int): Incremented by every invalidation.
+        hits (int): Lookups served from the cache.
+        misses (int): Lookups that had to be read from the database.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+        Initializes an empty AccountCache.
+
+        Args:
+            max_size (int): Maximum number of accounts cached, 0 to cache none.
+            ttl (float): Seconds an account is cached for.
+        """
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self.accounts: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.version: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, username: str) -> dict | None:
+        """
+        Args:
+            username (str): The username of the account.
+
+        Returns:
+            dict | None: The cached account, or None if it isn't cached or has expired.
+        """
+        entry: tuple[float, dict] | None = self.accounts.get(username)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, account = entry
+        if time.monotonic() >= expires:
+            del self.accounts[username]
+            self.misses += 1
+            return None
+        self.accounts.move_to_end(username)
+        self.hits += 1
+        return account
+
+    def put(self, account: dict, version: int):
+        """
+        Caches an account read from the database, dropping the least recently used account if the cache is full.
+
+        Args:
+            account (dict): The account, with a "username" key.
+            version (int): The cache's `version` from before the account was read.
+        """
+        if self.max_size <= 0 or version != self.version:
+            return
+        username: str = account["username"]
+        self.accounts[username] = (time.monotonic() + self.ttl, account)
+        self.accounts.move_to_end(username)
+        while len(self.accounts) > self.max_size:
+            self.accounts.popitem(last=False)
+
+    def invalidate(self, username: str):
+        """
+        Drops an account from the cache after it has changed, so the next lookup reads it from the database.
+
+        Args:
+            username (str): The username of the account.
+        """
+        self.version += 1
+        self.accounts.pop(username, None)
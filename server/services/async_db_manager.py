@@ -0,0 +1,205 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from typing import Any, Callable
+
+from dotenv import load_dotenv
+from fastapi import status, HTTPException
+
+try:
+    from services.account_cache import AccountCache
+    from services.db_manager import DatabaseManager, db
+    from services.password_hasher import password_hasher
+except:
+    from server.services.account_cache import AccountCache
+    from server.services.db_manager import DatabaseManager, db
+    from server.services.password_hasher import password_hasher
+
+load_dotenv()
+
+# Number of threads, each with its own read-only connection, that reads run on
+DB_READERS = int(getenv("DB_READERS", 4))
+# Number of accounts cached for the lookup on every login and websocket connect, and the seconds each is cached for
+ACCOUNT_CACHE_SIZE = int(getenv("ACCOUNT_CACHE_SIZE", 50000))
+ACCOUNT_CACHE_TTL = float(getenv("ACCOUNT_CACHE_TTL", 60))
+
+
+class AsyncDatabaseManager:
+    """
+    Async API over DatabaseManager for use from the event loop, so that connect storms and channel changes don't hold up message fan-out while SQLite works.
+
+    Reads run on a small pool of threads, each with its own read-only connection. In WAL mode these can all read at once, including while a write is being committed. Writes are routed to the single DatabaseWriter thread, which avoids SQLite's write lock contention and lets writes from many connections share one commit.
+
+    Attributes:
+        db (DatabaseManager): The database manager whose reads and writer thread are used.
+        readers (ThreadPoolExecutor): Threads that reads run on.
+        reader_connections (list): Read-only connections opened by the reader threads, closed by `close()`.
+        account_cache (AccountCache): Accounts recently looked up by `retrieve_account()`.
+    """
+
+    def __init__(self, db: DatabaseManager, max_readers: int = DB_READERS):
+        """
+        Initializes the AsyncDatabaseManager. Reader threads are started as they are needed.
+
+        Args:
+            db (DatabaseManager): The database manager to wrap.
+            max_readers (int): Number of reader threads.
+        """
+        self.db: DatabaseManager = db
+        self.readers: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=max_readers,
+            thread_name_prefix="db-reader",
+            initializer=self.open_reader_connection,
+        )
+        self.reader_connections: list[sqlite3.Connection] = []
+        self.account_cache: AccountCache = AccountCache(ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL)
+
+    def open_reader_connection(self):
+        """
+        Runs once on each reader thread as it starts, giving it a read-only connection that DatabaseManager's read methods then use.
+        """
+        self.reader_connections.append(self.db.open_read_only_connection())
+
+    async def read(self, function: Callable[..., Any], *args) -> Any:
+        """
+        Runs a blocking DatabaseManager read method on a reader thread.
+
+        Args:
+            function (Callable): The method to run.
+            *args: Arguments to call it with.
+
+        Returns:
+            Any: The method's return value.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.readers, function, *args)
+
+    async def close(self):
+        """
+        Waits for any reads in progress, then stops the reader threads and closes their connections.
+        """
+        await asyncio.to_thread(self.readers.shutdown, wait=True)
+        for connection in self.reader_connections:
+            connection.close()
+        self.reader_connections.clear()
+
+    async def retrieve_channels(self, username: str) -> set:
+        """
+        Fetches the channels a user is subscribed to.
+
+        Args:
+            username (str): The username of the user.
+
+        Returns:
+            set: A set of channel names.
+        """
+        return await self.read(self.db.retrieve_channels, username)
+
+    async def retrieve_channel_history(
+        self, channel: str, before_id: int | None = None, after_id: int | None = None, limit: int = 50
+    ) -> list[dict]:
+        """
+        Fetches one page of a channel's messages by message id, see `DatabaseManager.retrieve_channel_history()`.
+
+        Args:
+            channel (str): The channel name.
+            before_id (int | None): Return the messages just before this id.
+            after_id (int | None): Return the messages just after this id.
+            limit (int): Maximum number of messages to return.
+
+        Returns:
+            list[dict]: The messages, oldest first.
+        """
+        return await self.read(self.db.retrieve_channel_history, channel, before_id, after_id, limit)
+
+    async def retrieve_existing_accounts(self) -> dict:
+        """
+        Fetches all accounts from the `users` table.
+
+        Returns:
+            dict: A dictionary of accounts where keys are usernames, and values are account details.
+        """
+        return await self.read(self.db.retrieve_existing_accounts)
+
+    async def retrieve_account(self, username: str) -> dict | None:
+        """
+        Fetches one account by username, from the account cache if it's there, otherwise by primary key from the `users` table.
+
+        Args:
+            username (str): The username of the account.
+
+        Returns:
+            dict | None: The account's "username", "password_hashed" and "disabled" values, or None if there is no such account.
+        """
+        account: dict | None = self.account_cache.get(username)
+        if account is not None:
+            return account
+        version: int = self.account_cache.version
+        account = await self.read(self.db.retrieve_account, username)
+        if account is not None:
+            self.account_cache.put(account, version)
+        return account
+
+    async def apply_subscription_changes(self, changes: list[dict]) -> None:
+        """
+        Writes a batch of subscription changes in one transaction on the writer thread.
+
+        Args:
+            changes (list[dict]): Changes with "username", "channel" and "subscribed" (bool) keys, at most one per user and channel.
+
+        Raises:
+            sqlite3.Error: If the write fails, in which case none of the changes were written.
+        """
+        await self.db.writer.submit(lambda cur: self.db.apply_subscription_changes(cur, changes))
+
+    async def create_account(self, username: str, password: str) -> dict:
+        """
+        Creates a new user account. The password is hashed on a password hasher process, and the account inserted by the writer thread.
+
+        Args:
+            username (str): The desired username.
+            password (str): The plaintext password.
+
+        Returns:
+            dict: Success message on account creation.
+
+        Raises:
+            HTTPException: If the username already exists, the password hasher is too busy, or the account can't be created.
+        """
+        username = username.strip()
+        username_exists_error = HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Username already exists",
+        )
+
+        # Checked before hashing, so attempts to create an existing account don't cost a hash
+        if await self.read(
+            self.db.select_query,
+            "SELECT username FROM users WHERE username = :username",
+            {"username": username},
+        ):
+            raise username_exists_error
+
+        password_hashed = await password_hasher.hash(password)
+        try:
+            await self.db.writer.submit(
+                lambda cur: self.db.insert_account(cur, username, password_hashed)
+            )
+        except sqlite3.IntegrityError:
+            # Created by another request since the check above
+            raise username_exists_error
+        except Exception as e:
+            print(f"Error in create_account({username=}): \n{e}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail={"status": "Internal server error"},
+            )
+        finally:
+            # Accounts that don't exist aren't cached, but drop anything cached for the username so the next lookup reads the new account
+            self.account_cache.invalidate(username)
+
+        return {"status": "account created"}
+
+
+# Create instance to be imported
+adb = AsyncDatabaseManager(db)
@@ -0,0 +1,416 @@
+from google.protobuf.unknown_fields import UnknownFieldSet
+
+try:
+    import message_pb2
+except:
+    from server import message_pb2
+
+# Version of the Envelope protocol, and the websocket subprotocol a client offers to use it. Clients that don't offer it use the ChatMessage protocol, see services/legacy_codec.py
+PROTOCOL_VERSION = 2
+PROTOCOL_SUBPROTOCOL = "chattr.v2"
+
+# Reused for every message encoded or parsed on the server, rather than creating a new object each time. Nothing awaits between filling one of these and serializing it or copying its values out, so they are never shared between two messages
+_outgoing = message_pb2.Envelope()
+_incoming = message_pb2.Envelope()
+
+# Protobuf wire types
+WIRE_TYPE_VARINT = 0
+WIRE_TYPE_LENGTH_DELIMITED = 2
+
+# Fields a client is allowed to set on a chat message for it to be forwarded as received
+CLIENT_ENVELOPE_FIELDS = {"version", "type", "chat"}
+CLIENT_CHAT_FIELDS = {"channel_id", "content"}
+
+
+def encode_varint(value: int) -> bytes:
+    """
+    Encodes a non-negative integer as a protobuf varint.
+
+    Args:
+        value (int): The integer to encode.
+
+    Returns:
+        bytes: The encoded varint.
+    """
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_field_tag(field_number: int, wire_type: int = WIRE_TYPE_LENGTH_DELIMITED) -> bytes:
+    """
+    Encodes the tag of a protobuf field.
+
+    Args:
+        field_number (int): The field number from message.proto.
+        wire_type (int): The field's wire type, length-delimited by default.
+
+    Returns:
+        bytes: The encoded tag.
+    """
+    return encode_varint((field_number << 3) | wire_type)
+
+
+def encode_varint_field(field_number: int, value: int) -> bytes:
+    """
+    Encodes an unsigned integer protobuf field.
+
+    Args:
+        field_number (int): The field number from message.proto.
+        value (int): The non-negative value.
+
+    Returns:
+        bytes: Tag and varint encoded value.
+    """
+    return encode_field_tag(field_number, WIRE_TYPE_VARINT) + encode_varint(value)
+
+
+def encode_length_delimited_field(field_number: int, value: bytes) -> bytes:
+    """
+    Encodes a length-delimited (string, bytes or embedded message) protobuf field.
+
+    Args:
+        field_number (int): The field number from message.proto.
+        value (bytes): The encoded field value.
+
+    Returns:
+        bytes: Tag, length and value.
+    """
+    return encode_field_tag(field_number) + encode_varint(len(value)) + value
+
+
+def encode_string_field(field_number: int, value: str) -> bytes:
+    """
+    Encodes a protobuf string field.
+
+    Args:
+        field_number (int): The field number from message.proto.
+        value (str): The string value.
+
+    Returns:
+        bytes: Tag, length and UTF-8 encoded value.
+    """
+    return encode_length_delimited_field(field_number, value.encode())
+
+
+# Serialized `version` and `type` fields of a batch envelope, and the tags that precede its `batch` payload and each envelope embedded in it
+BATCH_ENVELOPE_PREFIX: bytes = message_pb2.Envelope(
+    version=PROTOCOL_VERSION, type=message_pb2.EVENT_TYPE_BATCH
+).SerializeToString()
+BATCH_FIELD_TAG: bytes = encode_field_tag(message_pb2.Envelope.BATCH_FIELD_NUMBER)
+BATCH_ENVELOPES_TAG: bytes = encode_field_tag(message_pb2.Batch.ENVELOPES_FIELD_NUMBER)
+# Tag that precedes the `chat` payload of an envelope
+CHAT_FIELD_TAG: bytes = encode_field_tag(message_pb2.Envelope.CHAT_FIELD_NUMBER)
+
+
+def encode_batch(messages: list[bytes]) -> bytes:
+    """
+    Wraps already serialized envelopes in a single batch envelope. Protobuf allows embedded messages to be written as tag + length + bytes, so the envelopes are copied in as they are rather than parsed and serialized again.
+
+    Args:
+        messages (list[bytes]): Serialized envelopes.
+
+    Returns:
+        bytes: The serialized batch envelope.
+    """
+    parts = []
+    for message_bytes in messages:
+        parts.append(BATCH_ENVELOPES_TAG)
+        parts.append(encode_varint(len(message_bytes)))
+        parts.append(message_bytes)
+    batch = b"".join(parts)
+    return b"".join((BATCH_ENVELOPE_PREFIX, BATCH_FIELD_TAG, encode_varint(len(batch)), batch))
+
+
+def encode_username_id_field(username_id: int) -> bytes:
+    """
+    Encodes the chat payload's `username_id` field, so it can be computed once per connection and appended to every chat message the user sends.
+
+    Args:
+        username_id (int): The interned id of the sender's username.
+
+    Returns:
+        bytes: The encoded field.
+    """
+    return encode_varint_field(message_pb2.Chat.USERNAME_ID_FIELD_NUMBER, username_id)
+
+
+def is_pass_through_chat_message(envelope: message_pb2.Envelope, message_bytes: bytes) -> bool:
+    """
+    Checks that a chat message received from a client can be forwarded byte for byte. It must only set the fields a client is allowed to send, have no unknown fields, and be canonically encoded with no repeated fields, which is the case when its serialized size matches the received size. Unknown fields are kept by the parser and counted in the serialized size, so they are checked for separately.
+
+    Args:
+        envelope (message_pb2.Envelope): The parsed envelope.
+        message_bytes (bytes): The bytes it was parsed from.
+
+    Returns:
+        bool: True if the received bytes can be reused as they are.
+    """
+    if envelope.ByteSize() != len(message_bytes):
+        return False
+    if len(UnknownFieldSet(envelope)) or len(UnknownFieldSet(envelope.chat)):
+        return False
+    return all(
+        field.name in CLIENT_ENVELOPE_FIELDS for field, _ in envelope.ListFields()
+    ) and all(
+        field.name in CLIENT_CHAT_FIELDS for field, _ in envelope.chat.ListFields()
+    )
+
+
+def append_server_fields(
+    message_bytes: bytes, username_id_field: bytes, sent_at_us: int, message_id: int, seq: int
+) -> bytes:
+    """
+    Adds the server generated `username_id`, `sent_at_us`, `message_id` and `seq` fields to the chat payload of a message received from a client.
+
+    When an embedded message field appears more than once on the wire, protobuf merges the occurrences, so appending a second `chat` payload holding just these fields gives the same result as decoding, updating and serializing again.
+
+    Args:
+        message_bytes (bytes): The envelope as received from the client, already validated by `is_pass_through_chat_message()`.
+        username_id_field (bytes): The sender's username id, encoded by `encode_username_id_field()`.
+        sent_at_us (int): The time the server received the message, in microseconds since the Unix epoch.
+        message_id (int): The id the server assigned to the message.
+        seq (int): The message's sequence number within its channel.
+
+    Returns:
+        bytes: The serialized envelope to broadcast.
+    """
+    server_fields = b"".join(
+        (
+            username_id_field,
+            encode_varint_field(message_pb2.Chat.SENT_AT_US_FIELD_NUMBER, sent_at_us),
+            encode_varint_field(message_pb2.Chat.MESSAGE_ID_FIELD_NUMBER, message_id),
+            encode_varint_field(message_pb2.Chat.SEQ_FIELD_NUMBER, seq),
+        )
+    )
+    return b"".join(
+        (message_bytes, CHAT_FIELD_TAG, encode_varint(len(server_fields)), server_fields)
+    )
+
+
+def encode_chat_message(
+    channel_id: int, content: str, username_id: int, sent_at_us: int, message_id: int, seq: int
+) -> bytes:
+    """
+    Encodes a chat message to broadcast.
+
+    Args:
+        channel_id (int): The interned id of the channel the message was sent to.
+        content (str): The message text.
+        username_id (int): The interned id of the sender's username.
+        sent_at_us (int): The time the server received the message, in microseconds since the Unix epoch.
+        message_id (int): The id the server assigned to the message.
+        seq (int): The message's sequence number within its channel.
+
+    Returns:
+        bytes: The serialized envelope.
+    """
+    _outgoing.Clear()
+    _outgoing.version = PROTOCOL_VERSION
+    _outgoing.type = message_pb2.EVENT_TYPE_MESSAGE
+    chat = _outgoing.chat
+    chat.channel_id = channel_id
+    chat.content = content
+    chat.username_id = username_id
+    chat.sent_at_us = sent_at_us
+    chat.message_id = message_id
+    chat.seq = seq
+    return _outgoing.SerializeToString()
+
+
+def encode_channel_subscriptions(channels: dict[str, int]) -> bytes:
+    """
+    Encodes the list of channels a user is subscribed to, along with the id used for each channel in later frames.
+
+    Args:
+        channels (dict): Maps each channel name to its interned id.
+
+    Returns:
+        bytes: The serialized envelope.
+    """
+    _outgoing.Clear()
+    _outgoing.version = PROTOCOL_VERSION
+    _outgoing.type = message_pb2.EVENT_TYPE_CHANNEL_SUBSCRIPTIONS
+    _outgoing.channel_subscriptions.channels.extend(channels.keys())
+    _outgoing.channel_subscriptions.channel_ids.extend(channels.values())
+    return _outgoing.SerializeToString()
+
+
+def encode_intern(channels: dict[str, int] | None = None, users: dict[str, int] | None = None) -> bytes:
+    """
+    Encodes a control frame telling the client the names that ids stand for.
+
+    Args:
+        channels (dict | None): Maps channel names to their interned ids.
+        users (dict | None): Maps usernames to their interned ids.
+
+    Returns:
+        bytes: The serialized envelope.
+    """
+    _outgoing.Clear()
+    _outgoing.version = PROTOCOL_VERSION
+    _outgoing.type = message_pb2.EVENT_TYPE_INTERN
+    intern = _outgoing.intern
+    intern.SetInParent()
+    for name, name_id in (channels or {}).items():
+        intern.channels.add(id=name_id, name=name)
+    for name, name_id in (users or {}).items():
+        intern.users.add(id=name_id, name=name)
+    return _outgoing.SerializeToString()
+
+
+def encode_resume(resumed_channel_ids: list[int], gap_channel_ids: list[int]) -> bytes:
+    """
+    Encodes the answer to a client's resume cursor.
+
+    Args:
+        resumed_channel_ids (list[int]): Interned ids of the channels whose missed messages follow.
+        gap_channel_ids (list[int]): Interned ids of the channels that missed too many messages to replay.
+
+    Returns:
+        bytes: The serialized envelope.
+    """
+    _outgoing.Clear()
+    _outgoing.version = PROTOCOL_VERSION
+    _outgoing.type = message_pb2.EVENT_TYPE_RESUME
+    resume = _outgoing.resume
+    resume.SetInParent()
+    resume.resumed_channel_ids.extend(resumed_channel_ids)
+    resume.gap_channel_ids.extend(gap_channel_ids)
+    return _outgoing.SerializeToString()
+
+
+# Serialized `version` and `type` fields of a history envelope, and the tags that precede its `history` payload and each message in it
+HISTORY_ENVELOPE_PREFIX: bytes = message_pb2.Envelope(
+    version=PROTOCOL_VERSION, type=message_pb2.EVENT_TYPE_HISTORY
+).SerializeToString()
+HISTORY_FIELD_TAG: bytes = encode_field_tag(message_pb2.Envelope.HISTORY_FIELD_NUMBER)
+HISTORY_MESSAGES_TAG: bytes = encode_field_tag(message_pb2.History.MESSAGES_FIELD_NUMBER)
+HISTORY_HAS_MORE_FIELD: bytes = encode_varint_field(message_pb2.History.HAS_MORE_FIELD_NUMBER, 1)
+# Longest possible varint for the length of a history payload under 4 GiB
+MAX_LENGTH_VARINT_SIZE = 5
+
+_history_chat = message_pb2.Chat()
+
+
+def encode_history_frames(
+    channel_id: int, messages: list[dict], has_more: bool, newest_first: bool, max_frame_bytes: int
+) -> list[bytes]:
+    """
+    Encodes a page of a channel's message history as one or more history envelopes, each no larger than max_frame_bytes. Each message is serialized once and its actual size used to decide where to split, then the envelopes are assembled from the serialized messages as in `encode_batch()`.
+
+    The frames follow the direction the page was read in: when paging back through older messages the newest messages come first, so a client can show them straight away. Messages within a frame are always oldest first. Every frame but the last has `has_more` set, as more of the page follows, and the last carries the page's own `has_more`.
+
+    Args:
+        channel_id (int): The interned id of the channel.
+        messages (list[dict]): The messages, oldest first, each with "id", "seq", "username_id", "content" and "sent_at" (microseconds since the Unix epoch) keys.
+        has_more (bool): Whether there are further messages in the direction requested.
+        newest_first (bool): True when paging back through older messages, False when paging forward.
+        max_frame_bytes (int): Maximum size of each serialized envelope. A single message larger than this is sent in a frame of its own.
+
+    Returns:
+        list[bytes]: The serialized envelopes, in the order to send them. A page with no messages is still sent as one frame.
+    """
+    channel_id_field: bytes = encode_varint_field(message_pb2.History.CHANNEL_ID_FIELD_NUMBER, channel_id)
+    budget: int = (
+        max_frame_bytes
+        - len(HISTORY_ENVELOPE_PREFIX)
+        - len(HISTORY_FIELD_TAG)
+        - MAX_LENGTH_VARINT_SIZE
+        - len(channel_id_field)
+        - len(HISTORY_HAS_MORE_FIELD)
+    )
+
+    entries: list[bytes] = []
+    for message in messages:
+        _history_chat.Clear()
+        _history_chat.content = message["content"]
+        _history_chat.username_id = message["username_id"]
+        _history_chat.sent_at_us = message["sent_at"]
+        _history_chat.message_id = message["id"]
+        _history_chat.seq = message["seq"]
+        chat_bytes: bytes = _history_chat.SerializeToString()
+        entries.append(b"".join((HISTORY_MESSAGES_TAG, encode_varint(len(chat_bytes)), chat_bytes)))
+
+    chunks: list[list[bytes]] = []
+    chunk: list[bytes] = []
+    chunk_size = 0
+    for entry in reversed(entries) if newest_first else entries:
+        if chunk and chunk_size + len(entry) > budget:
+            chunks.append(chunk)
+            chunk = []
+            chunk_size = 0
+        chunk.append(entry)
+        chunk_size += len(entry)
+    chunks.append(chunk)
+
+    frames: list[bytes] = []
+    for index, chunk in enumerate(chunks):
+        if newest_first:
+            chunk.reverse()
+        chunk_has_more: bool = has_more if index == len(chunks) - 1 else True
+        history: bytes = b"".join(
+            (channel_id_field, *chunk, HISTORY_HAS_MORE_FIELD if chunk_has_more else b"")
+        )
+        frames.append(
+            b"".join((HISTORY_ENVELOPE_PREFIX, HISTORY_FIELD_TAG, encode_varint(len(history)), history))
+        )
+    return frames
+
+
+def encode_perf_test(
+    perf_test_id: int,
+    cpu_load: list[float],
+    memory_usage: float,
+    active_connections: int,
+    message_volume: int,
+    mv_period: float,
+    mv_adjusted: int,
+) -> bytes:
+    """
+    Encodes the response to a performance test ping.
+
+    Args:
+        perf_test_id (int): The id of the ping being answered.
+        cpu_load (list[float]): Load of each CPU core as a percentage.
+        memory_usage (float): Memory usage as a percentage.
+        active_connections (int): Number of connected users.
+        message_volume (int): Messages sent since the last ping.
+        mv_period (float): Seconds since the last ping.
+        mv_adjusted (int): Exponential moving average of messages sent per second.
+
+    Returns:
+        bytes: The serialized envelope.
+    """
+    _outgoing.Clear()
+    _outgoing.version = PROTOCOL_VERSION
+    _outgoing.type = message_pb2.EVENT_TYPE_PERF_TEST
+    perf_test = _outgoing.perf_test
+    perf_test.perf_test_id = perf_test_id
+    perf_test.cpu_load.extend(cpu_load)
+    perf_test.memory_usage = memory_usage
+    perf_test.active_connections = active_connections
+    perf_test.message_volume = message_volume
+    perf_test.mv_period = mv_period
+    perf_test.mv_adjusted = mv_adjusted
+    return _outgoing.SerializeToString()
+
+
+def parse_message(message_bytes: bytes) -> message_pb2.Envelope:
+    """
+    Parses a binary envelope received from a client. The returned object is reused by the next call, so any values needed later must be copied out before then.
+
+    Args:
+        message_bytes (bytes): The binary message data.
+
+    Returns:
+        message_pb2.Envelope: The parsed envelope. Dispatch on its `type` and read the matching payload.
+
+    Raises:
+        DecodeError: If the message can't be parsed.
+    """
+    _incoming.ParseFromString(message_bytes)
+    return _incoming
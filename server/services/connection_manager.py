@@ -1,28 +1,87 @@
 import time
 import asyncio
 import datetime
+import json
 from logging import Logger
 import cProfile
 import os
 from os import getenv
 
 from pathlib import Path
-from fastapi import WebSocket
-from fastapi.websockets import WebSocketDisconnect
+from fastapi import WebSocket, status
 from dotenv import load_dotenv
 import psutil
 
-from google.protobuf.message import EncodeError, DecodeError
-from google.protobuf.json_format import MessageToDict, ParseDict
+from google.protobuf.message import DecodeError
 from google.protobuf.internal import api_implementation
 
 print(f"Protobuf using C++ serialization: {api_implementation.Type() == 'upb'}")
 
 try:
     from services.db_manager import DatabaseManager
+    from services.async_db_manager import AsyncDatabaseManager
+    from services.flush_scheduler import FlushScheduler
+    from services.outbound_queue import OutboundQueue, SlowConsumerPolicy
+    from services.codec import (
+        PROTOCOL_SUBPROTOCOL,
+        PROTOCOL_VERSION,
+        append_server_fields,
+        encode_channel_subscriptions,
+        encode_chat_message,
+        encode_history_frames,
+        encode_intern,
+        encode_perf_test,
+        encode_resume,
+        encode_username_id_field,
+        is_pass_through_chat_message,
+        parse_message,
+    )
+    from services.legacy_codec import (
+        LEGACY_PROTOCOL_VERSION,
+        envelope_to_legacy,
+        legacy_to_envelope,
+    )
+    from services.message_journal import (
+        MessageJournal,
+        decode_subscription_record,
+        encode_subscription_record,
+    )
+    from services.name_interner import NameInterner
+    from services.recent_messages import RecentMessages, parse_channel_sizes
+    from services.websocket_frames import encode_frame
     import message_pb2
 except:
     from server.services.db_manager import DatabaseManager
+    from server.services.async_db_manager import AsyncDatabaseManager
+    from server.services.flush_scheduler import FlushScheduler
+    from server.services.outbound_queue import OutboundQueue, SlowConsumerPolicy
+    from server.services.codec import (
+        PROTOCOL_SUBPROTOCOL,
+        PROTOCOL_VERSION,
+        append_server_fields,
+        encode_channel_subscriptions,
+        encode_chat_message,
+        encode_history_frames,
+        encode_intern,
+        encode_perf_test,
+        encode_resume,
+        encode_username_id_field,
+        is_pass_through_chat_message,
+        parse_message,
+    )
+    from server.services.legacy_codec import (
+        LEGACY_PROTOCOL_VERSION,
+        envelope_to_legacy,
+        legacy_to_envelope,
+    )
+    from server.services.message_journal import (
+        MessageJournal,
+        decode_subscription_record,
+        encode_subscription_record,
+    )
+    from server.services.name_interner import NameInterner
+    from server.services.recent_messages import RecentMessages, parse_channel_sizes
+    from server.services.websocket_frames import encode_frame
     from server import message_pb2
 
 
@@ -34,8 +93,45 @@ if env_path.exists():
 # REDIS_QUEUE = getenv("REDIS_QUEUE")
 MAX_RECONNECT_ATTEMPTS = int(getenv("MAX_RECONNECT_ATTEMPTS"))
 RECONNECT_DELAY = getenv("RECONNECT_DELAY")
-CACHED_MESSAGE_UPLOAD_TIMER = int(getenv("CACHED_MESSAGE_UPLOAD_TIMER"))
+# Most seconds a cached message waits before the cache is uploaded to the database
+CACHED_MESSAGE_UPLOAD_TIMER = float(getenv("CACHED_MESSAGE_UPLOAD_TIMER"))
+# The cache is uploaded sooner once it holds this many messages or bytes of encoded messages, 0 for no limit
+MESSAGE_FLUSH_MAX_ROWS = int(getenv("MESSAGE_FLUSH_MAX_ROWS", 500))
+MESSAGE_FLUSH_MAX_BYTES = int(getenv("MESSAGE_FLUSH_MAX_BYTES", 256 * 1024))
 USE_CPROFILE = getenv("USE_CPROFILE") == "True"
+# Backlog thresholds for a single connection, past which it is treated as a slow consumer and SLOW_CONSUMER_POLICY is applied
+OUTBOUND_QUEUE_SIZE = int(getenv("OUTBOUND_QUEUE_SIZE", 1000))
+OUTBOUND_QUEUE_MAX_BYTES = int(getenv("OUTBOUND_QUEUE_MAX_BYTES", 1024 * 1024))
+# One of "drop_oldest", "coalesce" or "disconnect"
+SLOW_CONSUMER_POLICY = SlowConsumerPolicy(getenv("SLOW_CONSUMER_POLICY", "drop_oldest"))
+SLOW_CONSUMER_CLOSE_CODE = int(getenv("SLOW_CONSUMER_CLOSE_CODE", status.WS_1013_TRY_AGAIN_LATER))
+# Milliseconds each connection's writer collects messages for before sending them as one batch frame
+BATCH_FLUSH_WINDOW_MS = float(getenv("BATCH_FLUSH_WINDOW_MS", 5))
+# Broadcast chat messages by appending the server's fields to the bytes received from the client, rather than decoding to a dict and encoding again. Set to False to compare against the old path under load
+PASS_THROUGH_ENCODING = getenv("PASS_THROUGH_ENCODING", "True") == "True"
+# Directory of the journal that cached messages are written to until they are in the database, by default next to the database file
+MESSAGE_JOURNAL_DIR = getenv("MESSAGE_JOURNAL_DIR")
+# Milliseconds between fsyncs of the message journal, 0 to fsync every message
+MESSAGE_JOURNAL_FSYNC_INTERVAL_MS = float(getenv("MESSAGE_JOURNAL_FSYNC_INTERVAL_MS", 1000))
+# Most seconds a channel join or leave waits before pending changes are written to the database, or sooner once this many are pending. They are also written when a user with pending changes disconnects
+SUBSCRIPTION_FLUSH_INTERVAL = float(getenv("SUBSCRIPTION_FLUSH_INTERVAL", 5))
+SUBSCRIPTION_FLUSH_MAX_ROWS = int(getenv("SUBSCRIPTION_FLUSH_MAX_ROWS", 1000))
+# Number of messages in a page of channel history when the client doesn't ask for a size, and the most it can ask for
+HISTORY_PAGE_SIZE = int(getenv("HISTORY_PAGE_SIZE", 50))
+HISTORY_MAX_PAGE_SIZE = int(getenv("HISTORY_MAX_PAGE_SIZE", 200))
+# Number of each channel's latest messages sent to a client when it connects or joins the channel, 0 to send none
+HISTORY_ON_CONNECT = int(getenv("HISTORY_ON_CONNECT", 100))
+# Maximum size in bytes of each history frame. Must stay under the 1 MiB message size limit of clients
+HISTORY_MAX_FRAME_BYTES = int(getenv("HISTORY_MAX_FRAME_BYTES", 256 * 1024))
+# Number of each channel's latest messages kept in memory to serve history from, and sizes for particular channels as "channel:size,channel:size"
+RECENT_MESSAGES_PER_CHANNEL = int(getenv("RECENT_MESSAGES_PER_CHANNEL", 200))
+RECENT_MESSAGES_CHANNEL_SIZES = parse_channel_sizes(getenv("RECENT_MESSAGES_CHANNEL_SIZES"))
+# Approximate memory in MiB the recent messages of all channels may use, past which the channels used least recently are dropped
+RECENT_MESSAGES_MAX_MB = float(getenv("RECENT_MESSAGES_MAX_MB", 64))
+# Handshake header a reconnecting client sends its resume cursor in, a JSON object of channel names to the id of the last message it saw in each
+RESUME_CURSOR_HEADER = "X-Resume-Cursor"
+# Most messages replayed to a reconnecting client in each channel. Past this the client is told the gap is too large and sent the channel's latest history instead. Should stay well under OUTBOUND_QUEUE_SIZE
+RESUME_MAX_MESSAGES = int(getenv("RESUME_MAX_MESSAGES", 500))
 
 
 class ConnectionManager:
@@ -45,34 +141,101 @@ class ConnectionManager:
     Attributes:
         logger (Logger): Logger instance for debugging and error reporting.
         db (DatabaseManager): Handles database interactions.
-        listener_task (asyncio.Task): Background task for handling cached messages.
-        active_connections (dict): Tracks active WebSocket connections and their subscribed channels.
-        channel_subscribers (dict): Maps channels to their active subscribers.
+        adb (AsyncDatabaseManager): Reads and writes the database without blocking the event loop.
+        active_connections (dict): Tracks active WebSocket connections, their outbound queues, and their subscribed channels.
+        channel_subscribers (dict): Maps channels to the outbound queues of their active subscribers.
+        channel_names (NameInterner): Ids sent in place of channel names.
+        usernames (NameInterner): Ids sent in place of usernames.
+        next_message_id (int): Id the next chat message will be assigned. Ids carry on from the highest id in the database.
+        recent_messages (RecentMessages): The latest messages of each channel, that most history is served from.
+        channel_seqs (dict): Sequence number of the last message assigned in each channel, loaded from the database at startup.
         message_cache (list): Stores messages temporarily before uploading to the database.
-        time_last_message_backup (int): Timestamp of the last message cache upload.
+        uploading_messages (list): Messages taken from message_cache by the upload in progress, until they have been committed.
+        upload_lock (asyncio.Lock): Held while the message cache is being uploaded.
+        journal (MessageJournal): Copy on disk of the messages in message_cache, replayed into the database on startup.
+        message_flush (FlushScheduler): Uploads message_cache once enough messages are cached or the oldest has waited CACHED_MESSAGE_UPLOAD_TIMER seconds.
+        subscription_changes (dict): Channel joins and leaves not yet written to the database, {"username": {"channel": subscribed}}.
+        flushing_subscription_changes (dict): Changes being written by `flush_subscription_changes()`, in the same format.
+        subscription_flush_lock (asyncio.Lock): Held while subscription changes are being written.
+        subscription_journal (MessageJournal): Copy on disk of the subscription changes, replayed into the database on startup.
+        subscription_flush (FlushScheduler): Writes subscription_changes once enough are pending or the oldest has waited SUBSCRIPTION_FLUSH_INTERVAL seconds.
         load_testing (bool): Indicates if the server is under load testing.
         ema_window (int): Window size for exponential moving average calculations.
         alpha (float): Smoothing factor for exponential moving average.
         run_profiling (bool): Whether cProfile is enabled for performance profiling.
         pr (cProfile.Profile | None): cProfile instance for profiling.
     """
-    def __init__(self, logger:Logger, db: DatabaseManager):
+    def __init__(self, logger:Logger, db: DatabaseManager, adb: AsyncDatabaseManager):
         """
         Initializes the ConnectionManager.
 
         Args:
             logger (Logger): Logger instance.
             db (DatabaseManager): Database manager for handling database operations.
+            adb (AsyncDatabaseManager): Async database manager used while handling connections.
         """
         self.logger: Logger = logger
         self.db: DatabaseManager = db
-        self.listener_task = None
-        # Dict of active connections, {"username":{"ws": websocket, "channels": {"welcome", "hello", etc}}
-        self.active_connections: dict[str, dict[WebSocket, set]] = {}
-        # Dict of channels with pointers to the websockets of active subscribers {"channel":{"username": websocket"}}
-        self.channel_subscribers: dict[str, dict] = {}
+        self.adb: AsyncDatabaseManager = adb
+        # Dict of active connections, {"username":{"ws": websocket, "outbound": OutboundQueue, "protocol_version": int, "username_id": int, "username_id_field": bytes, "channels": {"welcome", "hello", etc}}
+        self.active_connections: dict[str, dict] = {}
+        # Dict of channels with pointers to the outbound queues of active subscribers {"channel":{"username": OutboundQueue}}
+        self.channel_subscribers: dict[str, dict[str, OutboundQueue]] = {}
+        self.channel_names: NameInterner = NameInterner()
+        self.usernames: NameInterner = NameInterner()
         self.message_cache: list[dict] = []
-        self.time_last_message_backup: int = round(time.time())
+        self.uploading_messages: list[dict] = []
+        self.upload_lock: asyncio.Lock = asyncio.Lock()
+        journal_dir: str = MESSAGE_JOURNAL_DIR or os.path.join(os.path.dirname(self.db.DB_FILEPATH), "journal")
+        self.journal: MessageJournal = MessageJournal(
+            journal_dir, MESSAGE_JOURNAL_FSYNC_INTERVAL_MS / 1000, logger
+        )
+        self.replay_journal()
+        # Loaded once here, so assigning a sequence number never waits on the database
+        self.channel_seqs: dict[str, int] = self.db.retrieve_channel_seqs()
+        for message in self.message_cache:
+            self.channel_seqs[message["channel"]] = max(self.channel_seqs.get(message["channel"], 0), message["seq"])
+        self.message_flush: FlushScheduler = FlushScheduler(
+            "Message cache",
+            self.upload_cached_messages,
+            logger,
+            MESSAGE_FLUSH_MAX_ROWS,
+            MESSAGE_FLUSH_MAX_BYTES,
+            CACHED_MESSAGE_UPLOAD_TIMER,
+        )
+        # Replayed messages that couldn't be written to the database are retried by the first upload
+        if self.message_cache:
+            self.message_flush.add(len(self.message_cache))
+        self.subscription_changes: dict[str, dict[str, bool]] = {}
+        self.flushing_subscription_changes: dict[str, dict[str, bool]] = {}
+        self.subscription_flush_lock: asyncio.Lock = asyncio.Lock()
+        self.subscription_journal: MessageJournal = MessageJournal(
+            os.path.join(journal_dir, "subscriptions"),
+            MESSAGE_JOURNAL_FSYNC_INTERVAL_MS / 1000,
+            logger,
+            encode_subscription_record,
+            decode_subscription_record,
+        )
+        self.replay_subscription_journal()
+        self.subscription_flush: FlushScheduler = FlushScheduler(
+            "Subscription changes",
+            self.flush_subscription_changes,
+            logger,
+            SUBSCRIPTION_FLUSH_MAX_ROWS,
+            0,
+            SUBSCRIPTION_FLUSH_INTERVAL,
+        )
+        if self.subscription_changes:
+            self.subscription_flush.add(len(self.subscription_change_list(self.subscription_changes)))
+        self.recent_messages: RecentMessages = RecentMessages(
+            RECENT_MESSAGES_PER_CHANNEL,
+            RECENT_MESSAGES_CHANNEL_SIZES,
+            int(RECENT_MESSAGES_MAX_MB * 1024 * 1024),
+        )
+        self.warm_recent_messages()
+        self.next_message_id: int = max(
+            [self.db.retrieve_max_message_id()] + [message["id"] for message in self.message_cache]
+        ) + 1
         self.load_testing: bool = False
         self.message_volume = 0
         self.message_volume_timer = None
@@ -82,21 +245,115 @@ class ConnectionManager:
         self.pr: cProfile.Profile | None = None
         
 
+    def warm_recent_messages(self):
+        """
+        Fills the recent message buffers with the latest messages of each channel, including any replayed from the journal that couldn't be written to the database.
+        """
+        messages: list[dict] = self.db.retrieve_recent_messages(self.recent_messages.max_channel_size)
+        self.recent_messages.warm(messages)
+        for message in self.message_cache:
+            self.recent_messages.append(message)
+        self.logger.info(
+            f"Recent messages loaded: {len(self.recent_messages.channels)} channels, ~{self.recent_messages.total_bytes / 1024 / 1024:.1f} MiB"
+        )
+
+    def replay_journal(self):
+        """
+        Writes messages left in the journal by a previous run to the database, before any new messages are assigned ids. Messages that were already written are skipped. If the insert fails, the messages are put in the message cache to be retried by the first upload.
+        """
+        messages: list[dict] = self.journal.replay()
+        if not messages:
+            self.journal.discard(self.journal.segment_number - 1)
+            return
+        try:
+            inserted: int = self.db.replay_messages(messages)
+            self.journal.discard(self.journal.segment_number - 1)
+            self.logger.info(
+                f"Replayed message journal: {len(messages)} messages, {inserted} not yet in the database"
+            )
+        except Exception as e:
+            self.logger.warning(
+                f"Failed to replay {len(messages)} journaled messages, keeping them for the next upload: {type(e).__name__}: {e}"
+            )
+            self.message_cache.extend(messages)
+
+    def replay_subscription_journal(self):
+        """
+        Writes channel joins and leaves left in the subscription journal by a previous run to the database. If the write fails, they are kept as pending changes to be retried by the first flush.
+        """
+        records: list[dict] = self.subscription_journal.replay()
+        if not records:
+            self.subscription_journal.discard(self.subscription_journal.segment_number - 1)
+            return
+        # Later changes to the same subscription replace earlier ones
+        changes: dict[str, dict[str, bool]] = {}
+        for record in records:
+            changes.setdefault(record["username"], {})[record["channel"]] = record["subscribed"]
+        try:
+            self.db.replay_subscription_changes(self.subscription_change_list(changes))
+            self.subscription_journal.discard(self.subscription_journal.segment_number - 1)
+            self.logger.info(f"Replayed subscription journal: {len(records)} changes")
+        except Exception as e:
+            self.logger.warning(
+                f"Failed to replay {len(records)} journaled subscription changes, keeping them for the next flush: {type(e).__name__}: {e}"
+            )
+            self.subscription_changes = changes
+
     async def connect(self, websocket: WebSocket, username: str):
         """
-        Establishes a WebSocket connection and subscribes the user to their channels.
+        Establishes a WebSocket connection and subscribes the user to their channels. Clients that offer the PROTOCOL_SUBPROTOCOL websocket subprotocol use the Envelope protocol, all others the legacy ChatMessage protocol.
+
+        A client reconnecting with a resume cursor in the RESUME_CURSOR_HEADER header is sent only the messages it missed in the channels in the cursor, rather than their latest history.
 
         Args:
             websocket (WebSocket): The WebSocket connection instance.
             username (str): The username of the connecting client.
         """
-        await websocket.accept()
-        channels: set = self.db.retrieve_channels(username)
-        self.active_connections[username] = {"ws": websocket, "channels": channels}
+        if PROTOCOL_SUBPROTOCOL in websocket.scope.get("subprotocols", []):
+            protocol_version = PROTOCOL_VERSION
+            await websocket.accept(subprotocol=PROTOCOL_SUBPROTOCOL)
+        else:
+            protocol_version = LEGACY_PROTOCOL_VERSION
+            await websocket.accept()
+        channels: set = await self.adb.retrieve_channels(username)
+        self.apply_pending_subscription_changes(username, channels)
+        missed_messages: dict[str, list[dict] | None] | None = None
+        if protocol_version == PROTOCOL_VERSION and RESUME_CURSOR_HEADER in websocket.headers:
+            resume_cursor: dict[str, int] = self.parse_resume_cursor(websocket.headers[RESUME_CURSOR_HEADER])
+            resume_read_id: int = self.next_message_id
+            missed_messages = await self.read_missed_messages(channels, resume_cursor)
+        # Nothing below awaits until the client is subscribed and its missed messages are queued, so none are sent live before them or fall between the two
+        outbound = OutboundQueue(
+            websocket,
+            username,
+            self.logger,
+            self.close_outbound,
+            OUTBOUND_QUEUE_SIZE,
+            OUTBOUND_QUEUE_MAX_BYTES,
+            SLOW_CONSUMER_POLICY,
+            SLOW_CONSUMER_CLOSE_CODE,
+            BATCH_FLUSH_WINDOW_MS / 1000,
+            protocol_version=protocol_version,
+        )
+        outbound.start()
+        # A user reconnecting before their old connection has been cleaned up replaces it, so its writer task and socket aren't left running
+        replaced: WebSocket | None = self.remove_connection(username)
+        if replaced is not None:
+            self.logger.debug(f"Replaced existing connection: {username}")
+            asyncio.create_task(self.close_websocket(replaced, status.WS_1000_NORMAL_CLOSURE))
+        username_id: int = self.usernames.intern(username)
+        self.active_connections[username] = {
+            "ws": websocket,
+            "outbound": outbound,
+            "protocol_version": protocol_version,
+            "username_id": username_id,
+            "username_id_field": encode_username_id_field(username_id),
+            "channels": channels,
+        }
         for channel in channels:
             if channel not in self.channel_subscribers:
                 self.channel_subscribers[channel] = {}
-            self.channel_subscribers[channel][username] = websocket
+            self.channel_subscribers[channel][username] = outbound
         if username == "monitor":
             if self.run_profiling:
                 self.start_profiling()
@@ -108,101 +365,273 @@ class ConnectionManager:
             self.ema_message_volume = 0
             
         else:
-            await self.send_channel_subscriptions(websocket, channels)
-            # Channel message history is currently disabled
-            # await self.send_channel_history(websocket, channels)
-
-        # Starts the message listener once at least one user is connected.
-        if not self.listener_task or self.listener_task.done():
-            self.listener_task = asyncio.create_task(self.start_listener())
-            self.logger.info("First connection opened, starting listener")
+            self.send_channel_subscriptions(outbound, channels)
+            history_channels: set = channels
+            if missed_messages is not None:
+                resumed: set = self.send_missed_messages(
+                    outbound, missed_messages, resume_cursor, resume_read_id
+                )
+                history_channels = channels - resumed
+            self.start_channel_history(outbound, history_channels)
 
         self.logger.info(f"Active connections: {len(self.active_connections)}")
 
-    async def send_channel_subscriptions(self, websocket: WebSocket, channels: set):
+    def send_channel_subscriptions(self, outbound: OutboundQueue, channels: set):
         """
-        Sends a list of the user's channel subscriptions.
+        Queues a list of the user's channel subscriptions to be sent. The message also tells the client the id of each channel, which chat messages carry from then on.
 
         Args:
-            websocket (WebSocket): The WebSocket instance to send the message to.
+            outbound (OutboundQueue): The outbound queue of the connection to send the message to.
             channels (set): Set of channel names the user is subscribed to.
         """
+        channel_ids: dict[str, int] = {
+            channel: self.channel_names.intern(channel) for channel in channels
+        }
+        if self.queue_message(outbound, encode_channel_subscriptions(channel_ids)):
+            outbound.known_channels.update(channel_ids.values())
 
-        message_data: dict = {"event": "channel_subscriptions", "data": list(channels)}
-        message_bytes: bytes = self.encode_message(message_data)
-        await self.send_bytes_message(websocket, message_bytes)
+    def announce_user(self, outbound: OutboundQueue, username_id: int):
+        """
+        Queues an intern frame telling the client which username an id stands for, ahead of the first message that refers to it.
 
-    async def send_bytes_message(self, websocket: WebSocket, message_bytes: bytes):
+        Args:
+            outbound (OutboundQueue): The outbound queue of the connection to send the message to.
+            username_id (int): The interned username id.
         """
-        Sends a binary message over the WebSocket.
+        username: str | None = self.usernames.name(username_id)
+        if username is not None and outbound.put(encode_intern(users={username: username_id})):
+            outbound.known_users.add(username_id)
+
+    def queue_message(self, outbound: OutboundQueue, message_bytes: bytes) -> bool:
+        """
+        Queues an encoded envelope for a single connection, converting it to a ChatMessage first if the client uses the legacy protocol.
 
         Args:
-            websocket (WebSocket): The WebSocket connection to send the message to.
-            message_bytes (bytes): The binary message data.
+            outbound (OutboundQueue): The outbound queue of the connection to send the message to.
+            message_bytes (bytes): The serialized envelope.
+
+        Returns:
+            bool: True if the message was queued, False otherwise.
         """
-        if message_bytes is not None:
-            await websocket.send_bytes(message_bytes)
+        if outbound.protocol_version == LEGACY_PROTOCOL_VERSION:
+            message_bytes = envelope_to_legacy(message_bytes, self.channel_names, self.usernames)
+        return outbound.put(message_bytes)
 
-    def encode_message(self, message_data: dict) -> bytes:
+    def parse_resume_cursor(self, value: str) -> dict[str, int]:
         """
-        Encodes a message into a binary format using protobuf.
+        Parses the resume cursor a reconnecting client sends. An invalid cursor is ignored, and the client treated as connecting afresh.
 
         Args:
-            message_data (dict): The message data to encode.
+            value (str): The header value, a JSON object of channel names to the id of the last message the client saw in each.
 
         Returns:
-            bytes: The encoded message.
+            dict[str, int]: The valid entries of the cursor.
         """
         try:
-            message_object = ParseDict(message_data, message_pb2.ChatMessage())
+            cursor = json.loads(value)
+        except json.JSONDecodeError as e:
+            self.logger.debug(f"Invalid resume cursor: {e}")
+            return {}
+        if not isinstance(cursor, dict):
+            return {}
+        return {
+            channel: message_id
+            for channel, message_id in cursor.items()
+            if isinstance(message_id, int) and not isinstance(message_id, bool) and message_id >= 0
+        }
+
+    async def read_missed_messages(
+        self, channels: set, resume_cursor: dict[str, int]
+    ) -> dict[str, list[dict] | None]:
+        """
+        Reads the messages a reconnecting client missed in each of its channels in the resume cursor, from the recent messages in memory where they cover the gap and from the database otherwise. Messages sent while the reads are in progress are picked up by `send_missed_messages()`.
 
-            return message_object.SerializeToString()
-        except EncodeError as e:
-            self.logger.warning(f"encode_message() Protobuf EncodeError: {e}")
-        except Exception as e:
-            self.logger.warning(f"Exception during encode_message(): {type(e).__name__}: {e}")
+        Args:
+            channels (set): The channels the user is subscribed to.
+            resume_cursor (dict[str, int]): Maps channel names to the id of the last message the client saw in each.
+
+        Returns:
+            dict: Maps each channel in both to its missed messages, oldest first, or to None if more than RESUME_MAX_MESSAGES were missed.
+        """
+        missed_messages: dict[str, list[dict] | None] = {}
+        for channel, last_seen_id in resume_cursor.items():
+            if channel not in channels:
+                continue
+            missed: list[dict] = []
+            after_id: int = last_seen_id
+            while True:
+                messages, has_more = await self.get_channel_history(
+                    channel, after_id=after_id, limit=HISTORY_MAX_PAGE_SIZE
+                )
+                missed.extend(messages)
+                if len(missed) > RESUME_MAX_MESSAGES or not has_more or not messages:
+                    break
+                after_id = messages[-1]["id"]
+            missed_messages[channel] = missed if len(missed) <= RESUME_MAX_MESSAGES else None
+        return missed_messages
+
+    def send_missed_messages(
+        self,
+        outbound: OutboundQueue,
+        missed_messages: dict[str, list[dict] | None],
+        resume_cursor: dict[str, int],
+        resume_read_id: int,
+    ) -> set:
+        """
+        Queues the answer to a client's resume cursor, followed by the messages it missed as ordinary chat messages. Must be called in the same step of the event loop that subscribes the client, so it gets every message sent after those read by `read_missed_messages()` live. Any sent while they were being read are taken from the recent messages in memory, and if they don't cover them the channel is treated as having too large a gap.
 
-    #! This is still written for orjson, needs updating to use with protobuf if required
-    # async def send_channel_history(self, websocket: WebSocket, channels: set):
-    #     """Send the message history for all subscribed channels to the client"""
-    #     message_history: list = self.db.retrieve_message_history(channels)
+        Args:
+            outbound (OutboundQueue): The outbound queue of the reconnecting client.
+            missed_messages (dict): The channels' missed messages, as returned by `read_missed_messages()`.
+            resume_cursor (dict[str, int]): Maps channel names to the id of the last message the client saw in each.
+            resume_read_id (int): The id the next message would have been assigned when `read_missed_messages()` started.
 
-    #     # If any messages are in the cache, add the to the message history to send to newly logged in accounts
-    #     if self.message_cache:
-    #         for message in self.message_cache:
-    #             if message.get("channel") in channels:
-    #                 message_history.extend(message)
+        Returns:
+            set: The channels whose missed messages were sent, which don't need their latest history sent.
+        """
+        resumed: dict[str, list[dict]] = {}
+        gaps: list[str] = []
+        for channel, missed in missed_messages.items():
+            if missed is not None and self.next_message_id != resume_read_id:
+                after_id: int = missed[-1]["id"] if missed else resume_cursor[channel]
+                recent: tuple[list[dict], bool] | None = self.recent_messages.page(
+                    channel, None, after_id, RESUME_MAX_MESSAGES - len(missed)
+                )
+                if recent is None or recent[1]:
+                    missed = None
+                else:
+                    missed = missed + recent[0]
+            if missed is None:
+                gaps.append(channel)
+            else:
+                resumed[channel] = missed
+
+        channel_ids: dict[str, int] = {
+            channel: self.channel_names.intern(channel) for channel in (*resumed, *gaps)
+        }
+        if not outbound.put(
+            encode_resume(
+                [channel_ids[channel] for channel in resumed], [channel_ids[channel] for channel in gaps]
+            )
+        ):
+            return set()
+
+        new_users: dict[str, int] = {}
+        for messages in resumed.values():
+            for message in messages:
+                username_id: int = self.usernames.intern(message["username"])
+                message["username_id"] = username_id
+                if username_id not in outbound.known_users:
+                    new_users[message["username"]] = username_id
+        if new_users and outbound.put(encode_intern(users=new_users)):
+            outbound.known_users.update(new_users.values())
+        for channel, messages in resumed.items():
+            for message in messages:
+                outbound.put(
+                    encode_chat_message(
+                        channel_ids[channel],
+                        message["content"],
+                        message["username_id"],
+                        message["sent_at"],
+                        message["id"],
+                        message["seq"],
+                    ),
+                    channel,
+                )
+        return set(resumed)
 
-    #     # history_message = {"event": "message history", "data": message_history}
+    def start_channel_history(self, outbound: OutboundQueue, channels: set):
+        """
+        Starts streaming the latest messages of the given channels to a client in the background, so the connection is ready for live messages straight away. Only clients using the Envelope protocol are sent history, as ChatMessage has no history message.
 
-    #     # # await websocket.send_bytes(orjson.dumps(history_message))
-    #     # await self.websocket_send_bytes(websocket, history_message)
+        Args:
+            outbound (OutboundQueue): The outbound queue of the connection to send the history to.
+            channels (set): Set of channel names to send the history of.
+        """
+        if not HISTORY_ON_CONNECT or not channels or outbound.protocol_version != PROTOCOL_VERSION:
+            return
+        # Every message with a lower id was broadcast before the client subscribed, and every later one is delivered live, so the history and live messages don't overlap
+        before_id: int = self.next_message_id
+        asyncio.create_task(self.send_channel_history(outbound, channels, before_id))
 
+    async def send_channel_history(self, outbound: OutboundQueue, channels: set, before_id: int):
+        """
+        Streams up to HISTORY_ON_CONNECT of the latest messages of each channel to a client, newest first. Pages are read from the database one at a time and split into frames by their serialized size, and each frame waits for room in the outbound queue so a long history doesn't crowd out live messages or trip the slow consumer policy.
 
-    #     # Message history can exceed the maximum size for a websocket message (1MB), so the section below checks the size and breaks it down into multiple messages if it exceeds this limit. Currently not very performant as it serializes each message twice
-    #     #! Size count is broken by using orjson or protobuf
-    #     history_message = {"event": "message history", "data": []}
-    #     max_size = 1024 * 900  # 1 MB size limit for websocket message, with an allowance for getsizeof inaccurate estimate
+        Args:
+            outbound (OutboundQueue): The outbound queue of the connection to send the history to.
+            channels (set): Set of channel names to send the history of.
+            before_id (int): Only messages with a lower id are sent.
+        """
+        try:
+            for channel in list(channels):
+                async for messages, has_more in self.iter_channel_history(channel, before_id, HISTORY_ON_CONNECT):
+                    if not await self.send_history_page(outbound, channel, messages, has_more, True):
+                        return
+        except Exception as e:
+            self.logger.warning(f"Exception sending channel history to {outbound.username}: {type(e).__name__}: {e}")
 
-    #     current_size = 0
+    async def iter_channel_history(self, channel: str, before_id: int, max_messages: int):
+        """
+        Pages back through a channel's messages, newest page first, until max_messages have been read or there are none left.
 
-    #     for message in message_history:
-    #         message_size = getsizeof(orjson.dumps(message))
+        Args:
+            channel (str): The channel name.
+            before_id (int): Only messages with a lower id are read.
+            max_messages (int): Maximum number of messages to read in total.
 
-    #         if current_size + message_size > max_size:
-    #             # await websocket.send_bytes(orjson.dumps(history_message))
-    #             await self.encode_send_message(websocket, message_history)
-    #             # Reset for the next chunk
-    #             history_message["data"] = []
-    #             current_size = 0
+        Yields:
+            tuple: A page of messages oldest first, and whether there are older messages.
+        """
+        remaining: int = max_messages
+        while remaining > 0:
+            messages, has_more = await self.get_channel_history(
+                channel, before_id, limit=min(remaining, HISTORY_MAX_PAGE_SIZE)
+            )
+            if not messages:
+                return
+            remaining -= len(messages)
+            yield messages, has_more
+            if not has_more:
+                return
+            before_id = messages[0]["id"]
+
+    async def send_history_page(
+        self, outbound: OutboundQueue, channel: str, messages: list[dict], has_more: bool, newest_first: bool
+    ) -> bool:
+        """
+        Sends a page of a channel's history, split into frames under HISTORY_MAX_FRAME_BYTES. The usernames in the page that the client hasn't been told the ids of are sent first in one intern frame. Yields to the event loop between frames.
 
-    #         history_message["data"].append(message)
-    #         current_size += message_size
+        Args:
+            outbound (OutboundQueue): The outbound queue of the connection to send the page to.
+            channel (str): The channel name.
+            messages (list[dict]): The messages, oldest first.
+            has_more (bool): Whether there are further messages in the direction requested.
+            newest_first (bool): True when paging back through older messages, False when paging forward.
 
-    #     # Send any remaining messages
-    #     if history_message["data"]:
-    #         # await websocket.send_bytes(orjson.dumps(history_message))
-    #         await self.encode_send_message(websocket, message_history)
+        Returns:
+            bool: True if the page was queued, False if the connection was closed.
+        """
+        new_users: dict[str, int] = {}
+        for message in messages:
+            username_id: int = self.usernames.intern(message["username"])
+            message["username_id"] = username_id
+            if username_id not in outbound.known_users:
+                new_users[message["username"]] = username_id
+        if new_users and outbound.put(encode_intern(users=new_users)):
+            outbound.known_users.update(new_users.values())
+        channel_id: int = self.channel_names.intern(channel)
+        if channel_id not in outbound.known_channels and outbound.put(
+            encode_intern(channels={channel: channel_id})
+        ):
+            outbound.known_channels.add(channel_id)
+
+        for frame in encode_history_frames(channel_id, messages, has_more, newest_first, HISTORY_MAX_FRAME_BYTES):
+            await outbound.wait_for_room(len(frame))
+            if not self.queue_message(outbound, frame):
+                return False
+            await asyncio.sleep(0)
+        return True
 
     async def leave_channel(self, username: str, channel: str):
         """
@@ -212,11 +641,12 @@ class ConnectionManager:
             username (str): The username of the user leaving the channel.
             channel (str): The name of the channel to leave.
         """
-        self.db.remove_channel(username, channel)
+        # Only the in-memory state is changed here, the database is updated by the next subscription flush
+        self.record_subscription_change(username, channel, False)
         # Check channel is present in list of active users and channel subscriptions, and remove it
         if channel in self.active_connections[username]["channels"]:
             self.active_connections[username]["channels"].remove(channel)
-        if username in self.channel_subscribers[channel]:
+        if username in self.channel_subscribers.get(channel, {}):
             self.channel_subscribers[channel].pop(username)
 
     async def add_channel(self, username, channel: str):
@@ -227,29 +657,112 @@ class ConnectionManager:
             username (str): The username of the user.
             channel (str): The name of the channel to subscribe to.
         """
-        # Add channel to username's channel list in database
-        self.db.add_channel(username, channel)
+        # Only the in-memory state is changed here, the database is updated by the next subscription flush
+        self.record_subscription_change(username, channel, True)
         # Add channel to active_connections and channel_subscribers
         self.active_connections[username]["channels"].add(channel)
         if channel not in self.channel_subscribers:
             self.channel_subscribers[channel] = {}
-        self.channel_subscribers[channel][username] = self.active_connections[username][
-            "ws"
-        ]
-        await self.send_channel_subscriptions(
-            self.active_connections[username]["ws"], {channel}
+        outbound: OutboundQueue = self.active_connections[username]["outbound"]
+        self.channel_subscribers[channel][username] = outbound
+        self.send_channel_subscriptions(outbound, {channel})
+        self.start_channel_history(outbound, {channel})
+
+    def record_subscription_change(self, username: str, channel: str, subscribed: bool):
+        """
+        Records a channel join or leave to be written to the database by the next flush. It is journaled first, so it isn't lost if the server stops before then.
+
+        Args:
+            username (str): The username of the user.
+            channel (str): The channel joined or left.
+            subscribed (bool): True if the user joined the channel, False if they left it.
+        """
+        self.subscription_journal.append(
+            {"username": username, "channel": channel, "subscribed": subscribed}
         )
-        # await self.send_channel_history(
-        #     self.active_connections[username]["ws"], {channel}
-        # )
+        self.subscription_changes.setdefault(username, {})[channel] = subscribed
+        self.subscription_flush.add()
+
+    def apply_pending_subscription_changes(self, username: str, channels: set):
+        """
+        Brings a user's channels read from the database up to date with the changes that haven't been written to it yet.
+
+        Args:
+            username (str): The username of the user.
+            channels (set): The user's channels as stored in the database, updated in place.
+        """
+        for changes in (
+            self.flushing_subscription_changes.get(username),
+            self.subscription_changes.get(username),
+        ):
+            for channel, subscribed in (changes or {}).items():
+                if subscribed:
+                    channels.add(channel)
+                else:
+                    channels.discard(channel)
+
+    @staticmethod
+    def subscription_change_list(changes: dict[str, dict[str, bool]]) -> list[dict]:
+        """
+        Flattens pending subscription changes into the rows the database writes.
+
+        Args:
+            changes (dict): Changes in the format of `subscription_changes`.
+
+        Returns:
+            list[dict]: Changes with "username", "channel" and "subscribed" keys.
+        """
+        return [
+            {"username": username, "channel": channel, "subscribed": subscribed}
+            for username, user_changes in changes.items()
+            for channel, subscribed in user_changes.items()
+        ]
+
+    async def flush_subscription_changes(self) -> bool:
+        """
+        Writes all pending channel joins and leaves to the database in one transaction on the writer thread. Changes made in the meantime are kept for the next flush. If the write fails, the changes are kept too, behind any newer change to the same subscription.
 
-    async def disconnect(self, username: str):
+        Returns:
+            bool: False if the write failed.
+        """
+        async with self.subscription_flush_lock:
+            if not self.subscription_changes:
+                return True
+            self.flushing_subscription_changes = self.subscription_changes
+            self.subscription_changes = {}
+            sealed_segment: int = await self.subscription_journal.rotate()
+            try:
+                await self.adb.apply_subscription_changes(
+                    self.subscription_change_list(self.flushing_subscription_changes)
+                )
+            except Exception as e:
+                self.logger.warning(
+                    f"Failed to write subscription changes for {len(self.flushing_subscription_changes)} users, keeping them for the next flush: {type(e).__name__}: {e}"
+                )
+                for username, user_changes in self.flushing_subscription_changes.items():
+                    pending: dict[str, bool] = self.subscription_changes.setdefault(username, {})
+                    for channel, subscribed in user_changes.items():
+                        pending.setdefault(channel, subscribed)
+                return False
+            finally:
+                self.flushing_subscription_changes = {}
+            self.subscription_journal.discard(sealed_segment)
+            return True
+
+    async def disconnect(self, username: str, websocket: WebSocket | None = None, code: int = status.WS_1000_NORMAL_CLOSURE):
         """
         Handles user disconnection, unsubscribing them from channels and closing the connection. If user is Monitor, stop monitoring.
 
         Args:
             username (str): The username of the disconnecting user.
+            websocket (WebSocket | None): The connection being disconnected. Nothing is done if the user has since reconnected on another websocket, so that the old connection's handler doesn't tear down the new session. None to disconnect whichever connection the user has.
+            code (int): Websocket close code to close the connection with.
         """
+        connection: dict | None = self.active_connections.get(username)
+        if websocket is not None and connection is not None and connection["ws"] is not websocket:
+            self.logger.debug(f"Ignored disconnect of replaced connection: {username}")
+            return
+
         if username == "monitor":
             self.load_testing = False
             self.logger.info("Stopped load testing")
@@ -259,146 +772,133 @@ class ConnectionManager:
             if self.run_profiling:
                 self.stop_profiling()
 
-        try:
-            if username in self.active_connections:
-                websocket: WebSocket =  self.active_connections[username].get("ws")
-                for channel in self.active_connections[username].get("channels", []):
-                    self.channel_subscribers.get(channel, {}).pop(username, None)
-                    if not self.channel_subscribers.get(channel):
-                        self.channel_subscribers.pop(channel, None)
-                self.active_connections.pop(username, None)
-                await websocket.close()
-        except RuntimeError:
-            pass
-        except Exception as e:
-            self.logger.warning(f"Exception during disconnect: {type(e).__name__}: {e}")
+        websocket: WebSocket | None = self.remove_connection(username)
+        if websocket is not None:
+            await self.close_websocket(websocket, code)
 
-        # Disable listener if there are no active connections
-        if not self.active_connections and self.listener_task:
-            self.listener_task.cancel()
-            self.listener_task = None
-            if self.message_cache:
-                self.logger.info(
-                    f"Upload cache triggered by disconnect, {len(self.active_connections) = }, {len(self.message_cache) = }, {len(self.active_connections) = }"
-                )
-                await self.upload_cached_messages()
-            self.logger.info("No active connections, stopping listener. Message cache uploaded")
+        if username in self.subscription_changes:
+            await self.subscription_flush.flush_now()
 
-    async def broadcast(self, message: dict):
-        """
-        Sends a message to all clients subscribed to a specific channel.
+        # Nothing is left waiting for the timer once the last user has gone
+        if not self.active_connections and self.message_cache:
+            self.logger.info(f"Upload cache triggered by last disconnect, {len(self.message_cache) = }")
+            await self.message_flush.flush_now()
 
-        Args:
-            message (dict): The message data to broadcast.
+    def remove_connection(self, username: str) -> WebSocket | None:
         """
-        channel = message.get("channel")
-        closed_connections = []
-        tasks = []
-
-        message_bytes: bytes = self.encode_message(message)
-        # Iterate over users and websockets subscribed to the channel
-        for user, websocket in self.channel_subscribers.get(channel, {}).items():
-            # Append the send_message task to the list of tasks
-            tasks.append(self.send_message(user, websocket, message_bytes, closed_connections))
-        
-        # Gather and await the results of the tasks
-        await asyncio.gather(*tasks, return_exceptions=True)
-        
-        # Handle closed connections
-        if closed_connections:
-            disconnect_tasks = []
-            self.logger.debug(f"Closed connections: {closed_connections}")
-            for user in closed_connections:
-                disconnect_tasks.append(self.disconnect(user))
-        
-            # Gather and await the results of the tasks
-            await asyncio.gather(*disconnect_tasks, return_exceptions=True)
+        Stops a user's outbound queue and removes their connection from active_connections and from the subscribers of their channels.
 
+        Args:
+            username (str): The username of the user.
 
-    async def send_message(self, user: str, websocket: WebSocket, message_bytes: bytes, closed_connections: list):
+        Returns:
+            WebSocket | None: The connection's websocket, still to be closed, or None if the user wasn't connected.
         """
-        Sends a message to a specific user.
+        connection: dict | None = self.active_connections.pop(username, None)
+        if connection is None:
+            return None
+        outbound: OutboundQueue = connection["outbound"]
+        outbound.stop()
+        for channel in connection["channels"]:
+            subscribers: dict[str, OutboundQueue] | None = self.channel_subscribers.get(channel)
+            if subscribers is not None and subscribers.get(username) is outbound:
+                del subscribers[username]
+                if not subscribers:
+                    del self.channel_subscribers[channel]
+        return connection["ws"]
+
+    async def close_websocket(self, websocket: WebSocket, code: int):
+        """
+        Closes a websocket, ignoring the error raised if it has already been closed.
 
         Args:
-            user (str): The username of the recipient.
-            websocket (WebSocket): The WebSocket connection for the user.
-            message_bytes (bytes): The binary message data.
-            closed_connections (list): List of users with closed connections.
+            websocket (WebSocket): The websocket to close.
+            code (int): Websocket close code to close it with.
         """
-        if user not in self.active_connections:
-            return
         try:
-            await self.send_bytes_message(websocket, message_bytes)
-            if self.load_testing:
-                self.message_volume += 1
-                if self.message_volume_timer is None:
-                    self.message_volume_timer = time.perf_counter()
-        except WebSocketDisconnect:
-            closed_connections.append(user)
+            await websocket.close(code)
+        except RuntimeError:
+            pass
         except Exception as e:
-            if str(e) == 'Cannot call "send" once a close message has been sent.':
-                closed_connections.append(user)
-            else:
-                self.logger.warning(f"Exception sending message, closing connection: {user in self.active_connections=} {type(e).__name__}: {e}", exc_info=True)
-                closed_connections.append(user)
+            self.logger.warning(f"Exception during disconnect: {type(e).__name__}: {e}")
 
-    def decode_message(self, message_bytes: bytes) -> dict:
+    async def broadcast(self, channel: str, message_bytes: bytes, username_id: int = 0):
         """
-        Decodes a binary message using protobuf.
+        Queues an encoded envelope for every client subscribed to a specific channel. The websocket frame is built once, and each subscriber's writer task sends the same bytes independently. The ChatMessage version for legacy clients is only built if one of them is subscribed, and is also shared.
 
-        Args:
-            message_bytes (bytes): The binary message data.
+        Subscribers that haven't been told the sender's username id are sent an intern frame first.
 
-        Returns:
-            dict: The decoded message data.
+        Args:
+            channel (str): The channel the message was sent to.
+            message_bytes (bytes): The serialized envelope.
+            username_id (int): The interned id of the sender's username referenced by the message, 0 if none.
         """
-        try:
-            parsed_message = message_pb2.ChatMessage()
-            parsed_message.ParseFromString(message_bytes)
-
-            if parsed_message.event == "perf_test":
-                return {
-                    "event": "perf_test",
-                    "perf_test_id": parsed_message.perf_test_id
-                    }
-
-            message_dict = {
-                "event": parsed_message.event,
-                "channel": parsed_message.channel,
-                }
-
-            if message_dict.get("event") == "message":
-                message_dict["content"] = parsed_message.content
-                # Timestamp is generated by server for UTC and converted to an ISO 8601 format string for database compatibility
-                message_dict["sent_at"] = self.db.adapt_datetime_iso(
-                        datetime.datetime.now(datetime.timezone.utc)
-                    )
-            return message_dict
-        except Exception as e:
-            raise DecodeError(e)
+        if message_bytes is None:
+            return
+        frame: bytes = encode_frame(message_bytes)
+        legacy_bytes: bytes | None = None
+        legacy_frame: bytes | None = None
+
+        queued = 0
+        # Iterate over the outbound queues of users subscribed to the channel
+        for outbound in self.channel_subscribers.get(channel, {}).values():
+            if outbound.protocol_version == PROTOCOL_VERSION:
+                if username_id and username_id not in outbound.known_users:
+                    self.announce_user(outbound, username_id)
+                if outbound.put(message_bytes, channel, frame):
+                    queued += 1
+                continue
+            if legacy_bytes is None:
+                legacy_bytes = envelope_to_legacy(message_bytes, self.channel_names, self.usernames)
+                legacy_frame = encode_frame(legacy_bytes)
+            if outbound.put(legacy_bytes, channel, legacy_frame):
+                queued += 1
+
+        if self.load_testing:
+            self.message_volume += queued
+            if self.message_volume_timer is None:
+                self.message_volume_timer = time.perf_counter()
+
+    async def close_outbound(self, outbound: OutboundQueue):
+        """
+        Disconnects the user an outbound queue belongs to, once its connection has failed or been closed by the slow consumer policy. Ignored if the user has since reconnected with a new connection.
 
+        Args:
+            outbound (OutboundQueue): The outbound queue that has closed.
+        """
+        connection: dict | None = self.active_connections.get(outbound.username)
+        if connection and connection["outbound"] is outbound:
+            self.logger.debug(
+                f"Closed connection: {outbound.username}, {outbound.close_code = }, {outbound.dropped_messages = }"
+            )
+            await self.disconnect(outbound.username, connection["ws"], outbound.close_code)
 
     async def handle_incoming_message(self, message_bytes: bytes, username: str):
         """
-        Processes an incoming message and handles the appropriate action.
+        Processes an incoming message and handles the appropriate action, dispatching on the envelope's numeric event type. Messages from legacy clients are converted to an envelope first.
 
         Args:
             message_bytes (bytes): The binary message data.
             username (str): The username of the sender.
         """
         try:
-            message: dict = self.decode_message(message_bytes)
-            message["username"] = username
-            if message.get("event") == "message":
-                await self.broadcast(message)
-                self.message_cache.append(message)
-                # TODO Add graceful error handling for batch inserts / fails
-            elif message.get("event") == "leave_channel":
-                await self.leave_channel(username, message.get("channel"))
-            elif message.get("event") == "add_channel":
-                await self.add_channel(username, message.get("channel"))
-            elif message.get("event") == "perf_test":
-                await self.handle_perf_ping(message)
+            connection: dict = self.active_connections[username]
+            if connection["protocol_version"] == LEGACY_PROTOCOL_VERSION:
+                message_bytes = legacy_to_envelope(message_bytes)
+            envelope = parse_message(message_bytes)
+            event_type: int = envelope.type
+            if event_type == message_pb2.EVENT_TYPE_MESSAGE:
+                await self.handle_chat_message(envelope, message_bytes, connection, username)
+            elif event_type == message_pb2.EVENT_TYPE_PERF_TEST:
+                await self.handle_perf_ping(username, envelope.perf_test.perf_test_id)
+            elif event_type == message_pb2.EVENT_TYPE_ADD_CHANNEL:
+                await self.add_channel(username, envelope.channel_action.channel)
+            elif event_type == message_pb2.EVENT_TYPE_LEAVE_CHANNEL:
+                await self.leave_channel(username, envelope.channel_action.channel)
+            elif event_type == message_pb2.EVENT_TYPE_HISTORY:
+                await self.handle_history_request(envelope.history_request, connection)
+            else:
+                raise DecodeError(f"Unknown event type: {event_type}")
         except DecodeError as e:
             self.logger.warning(f"handle_incoming_message() Protobuf DecodeError: {e}")
         except KeyError:
@@ -407,55 +907,201 @@ class ConnectionManager:
             self.logger.warning(f"Exception during handle_incoming_message(): {type(e).__name__}: {e}")
 
 
-    async def start_listener(self):
+    async def handle_chat_message(self, envelope: message_pb2.Envelope, message_bytes: bytes, connection: dict, username: str):
+        """
+        Assigns a chat message its id and channel sequence number, broadcasts it and caches it for upload. The server's `username_id`, `sent_at_us`, `message_id` and `seq` fields are appended to the bytes received from the client, so the message is not encoded again. Messages that set fields a client shouldn't, or aren't canonically encoded, are rebuilt from the parsed fields instead, as are all messages if PASS_THROUGH_ENCODING is disabled. Messages for a channel the sender isn't subscribed to are ignored.
+
+        Args:
+            envelope (message_pb2.Envelope): The parsed envelope.
+            message_bytes (bytes): The serialized envelope as received.
+            connection (dict): The sender's entry in active_connections.
+            username (str): The username of the sender.
+        """
+        chat: message_pb2.Chat = envelope.chat
+        # Clients refer to the channel by id once they've been told it, otherwise by name
+        if chat.channel_id:
+            channel_id: int = chat.channel_id
+            channel: str | None = self.channel_names.name(channel_id)
+            if channel is None:
+                raise DecodeError(f"Unknown channel id: {channel_id}")
+        else:
+            channel = chat.channel
+            channel_id = 0
+        if channel not in connection["channels"]:
+            self.logger.debug(f"Message sent to unsubscribed channel {channel!r}")
+            return
+        if not channel_id:
+            channel_id = self.channel_names.intern(channel)
+        # Timestamp is generated by the server as microseconds since the Unix epoch (UTC), and only converted to a date and time for display
+        sent_at_us: int = time.time_ns() // 1000
+        # The message's identity is fixed here, rather than when it is written to the database
+        message_id: int = self.next_message_id
+        self.next_message_id += 1
+        seq: int = self.next_channel_seq(channel)
+        message: dict = {
+            "event": "message",
+            "id": message_id,
+            "seq": seq,
+            "channel": channel,
+            "content": chat.content,
+            "sent_at": sent_at_us,
+            "username": username,
+        }
+        if PASS_THROUGH_ENCODING and is_pass_through_chat_message(envelope, message_bytes):
+            outbound_bytes = append_server_fields(
+                message_bytes, connection["username_id_field"], sent_at_us, message_id, seq
+            )
+        else:
+            outbound_bytes = encode_chat_message(
+                channel_id, message["content"], connection["username_id"], sent_at_us, message_id, seq
+            )
+
+        # Journaled before broadcast, so a message any client has seen is never lost if the server stops before uploading it
+        self.journal.append(message)
+        self.message_cache.append(message)
+        self.recent_messages.append(message)
+        self.message_flush.add(1, len(outbound_bytes))
+        await self.broadcast(channel, outbound_bytes, connection["username_id"])
+
+    async def handle_history_request(self, request: message_pb2.HistoryRequest, connection: dict):
         """
-        Starts a background task to monitor and handle cached messages.
+        Sends a client a page of history from one of its channels.
+
+        Args:
+            request (message_pb2.HistoryRequest): The parsed request.
+            connection (dict): The requesting client's entry in active_connections.
         """
-        while True:
-            num_messages: int = len(self.message_cache)
-            current_time: int = round(time.time())
+        # Copied out before awaiting, as the parsed envelope is reused for the next message received
+        if request.channel_id:
+            channel: str | None = self.channel_names.name(request.channel_id)
+            if channel is None:
+                raise DecodeError(f"Unknown channel id: {request.channel_id}")
+        else:
+            channel = request.channel
+        before_id: int | None = request.before_id or None
+        after_id: int | None = request.after_id or None
+        limit: int = request.limit
+        if channel not in connection["channels"]:
+            self.logger.debug(f"History requested for unsubscribed channel {channel!r}")
+            return
 
-            # If there are no messages in the cache, reset the time of last cache upload to now and sleep for 1 second. This means the timer will only start once new messaging activity has begun
-            if not num_messages:
-                self.time_last_message_backup = current_time
-                await asyncio.sleep(1)
-                continue
+        messages, has_more = await self.get_channel_history(channel, before_id, after_id, limit)
+
+        await self.send_history_page(connection["outbound"], channel, messages, has_more, after_id is None)
+
+    async def is_subscribed(self, username: str, channel: str) -> bool:
+        """
+        Checks whether a user is subscribed to a channel, whether or not they are connected.
 
-            time_since_last_message_upload: int = (
-                current_time - self.time_last_message_backup
+        Args:
+            username (str): The username of the user.
+            channel (str): The channel name.
+
+        Returns:
+            bool: True if the user is subscribed.
+        """
+        connection: dict | None = self.active_connections.get(username)
+        if connection is not None:
+            return channel in connection["channels"]
+        channels: set = await self.adb.retrieve_channels(username)
+        self.apply_pending_subscription_changes(username, channels)
+        return channel in channels
+
+    async def get_channel_history(
+        self, channel: str, before_id: int | None = None, after_id: int | None = None, limit: int = 0
+    ) -> tuple[list[dict], bool]:
+        """
+        Fetches one page of a channel's messages by message id, including messages that are still waiting to be uploaded to the database. Served from the recent messages in memory when they hold the whole page, otherwise read from the database.
+
+        Args:
+            channel (str): The channel name.
+            before_id (int | None): Return the messages just before this id. If neither bound is given, the latest messages are returned.
+            after_id (int | None): Return the messages just after this id, with before_id still applied as an upper bound.
+            limit (int): Maximum number of messages to return, capped at HISTORY_MAX_PAGE_SIZE. 0 for HISTORY_PAGE_SIZE.
+
+        Returns:
+            tuple: The messages oldest first, each with "id", "seq", "username", "channel", "content" and "sent_at" keys, and whether there are further messages in the direction requested.
+        """
+        limit = min(limit or HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE)
+        recent: tuple[list[dict], bool] | None = self.recent_messages.page(channel, before_id, after_id, limit)
+        if recent is not None:
+            return recent
+
+        lower: int = after_id or 0
+        upper: int | None = before_id
+        # Taken before the database read, so messages committed while it runs are still included. Any also returned by the read are merged by id
+        pending: list[dict] = [
+            message
+            for messages in (self.uploading_messages, self.message_cache)
+            for message in messages
+            if message["channel"] == channel
+            and message["id"] > lower
+            and (upper is None or message["id"] < upper)
+        ]
+        # One more than the page size is fetched to tell whether there are more
+        stored: list[dict] = await self.adb.retrieve_channel_history(channel, before_id, after_id, limit + 1)
+
+        merged: dict[int, dict] = {message["id"]: message for message in stored}
+        for message in pending:
+            merged.setdefault(
+                message["id"], {key: value for key, value in message.items() if key != "event"}
             )
-            # If the number of stored messages is >= current active connections, or if there are any messages and the last upload was more than CACHED_MESSAGE_UPLOAD_TIMER seconds ago, do the batch upload immediately
-            if num_messages >= max(len(self.active_connections), 5) or (
-                time_since_last_message_upload > CACHED_MESSAGE_UPLOAD_TIMER
-                and num_messages
-            ):
-                self.logger.info(
-                    f"Upload cache triggered by cache size: {num_messages = }, {time_since_last_message_upload = }, {len(self.active_connections) = })"
-                )
-                await self.upload_cached_messages()
-            await asyncio.sleep(1)
+        page: list[dict] = [merged[message_id] for message_id in sorted(merged)]
+        has_more: bool = len(page) > limit
+        page = page[:limit] if after_id is not None else page[-limit:]
+        return page, has_more
+
+    def next_channel_seq(self, channel: str) -> int:
+        """
+        Assigns the next sequence number in a channel.
 
-    async def upload_cached_messages(self):
+        Args:
+            channel (str): The channel name.
+
+        Returns:
+            int: The sequence number for a new message in the channel.
         """
-        Uploads cached messages to the database in batch mode.
+        seq: int = self.channel_seqs.get(channel, 0) + 1
+        self.channel_seqs[channel] = seq
+        return seq
+
+    async def upload_cached_messages(self) -> bool:
         """
-        if self.db.batch_insert_messages(self.message_cache):
-            self.message_cache.clear()
-            self.time_last_message_backup = round(time.time())
-        else:
-            # TODO log error on failure to avoid losing cached messages
-            pass
+        Uploads cached messages to the database in batch mode, when `message_flush` decides it's time. The insert runs on the database writer thread, so the event loop keeps serving connections while it commits. Messages arriving in the meantime go into a new cache and journal segment, and if the insert fails the uploaded messages are put back at the front to be retried by the next upload. Their journal segments are only deleted once an upload including them has committed.
 
-    async def handle_perf_ping(self, message: dict):
+        Returns:
+            bool: False if the insert failed.
+        """
+        # Uploads run one at a time, so a segment is never discarded while an earlier upload's messages in it are still being written
+        async with self.upload_lock:
+            messages: list[dict] = self.message_cache
+            if not messages:
+                return True
+            self.message_cache = []
+            self.uploading_messages = messages
+            sealed_segment: int = await self.journal.rotate()
+            try:
+                await self.db.insert_messages(messages)
+            except Exception as e:
+                self.logger.warning(
+                    f"Failed to upload {len(messages)} cached messages, keeping them for the next upload: {type(e).__name__}: {e}"
+                )
+                self.message_cache[:0] = messages
+                return False
+            finally:
+                self.uploading_messages = []
+            self.journal.discard(sealed_segment)
+            return True
+
+    async def handle_perf_ping(self, username: str, perf_test_id: int):
         """
         Handles performance test pings and sends back performance metrics.
 
         Args:
-            message (dict): The performance test message data.
+            username (str): The username of the sender, normally "monitor".
+            perf_test_id (int): The id of the ping, returned in the response.
         """
         try:
-            username = message.get("username")
-            perf_test_id = message.get("perf_test_id")
             active_connections = len(self.active_connections)
             cpu_load = psutil.cpu_percent(interval=None, percpu=True)
             memory_usage = psutil.virtual_memory().percent
@@ -469,23 +1115,20 @@ class ConnectionManager:
                 self.alpha * (self.message_volume/mv_time_interval) + (1 - self.alpha) * self.ema_message_volume
             )
 
-            response_message = {
-                "event": "perf_test",
-                "perf_test_id" : perf_test_id,
-                "cpu_load" : cpu_load,
-                "memory_usage" : memory_usage,
-                "active_connections" : active_connections,
-                "message_volume": self.message_volume,
-                "mv_period": time.perf_counter() - self.message_volume_timer,
-                "mv_adjusted": round(self.ema_message_volume)
-            }
-            websocket: WebSocket = self.active_connections.get(username).get("ws")
+            message_bytes: bytes = encode_perf_test(
+                perf_test_id,
+                cpu_load,
+                memory_usage,
+                active_connections,
+                self.message_volume,
+                time.perf_counter() - self.message_volume_timer,
+                round(self.ema_message_volume),
+            )
+            outbound: OutboundQueue = self.active_connections.get(username).get("outbound")
             self.message_volume = 0
             self.message_volume_timer = time.perf_counter()
-            self.logger.debug(f"Sending perf response: {response_message}")
-            # await websocket.send_bytes(orjson.dumps(response_message))
-            message_bytes = self.encode_message(response_message)
-            await self.send_bytes_message(websocket, message_bytes)
+            self.logger.debug(f"Sending perf response: {perf_test_id = }, {active_connections = }")
+            self.queue_message(outbound, message_bytes)
         except Exception as e:
             self.logger.warning(f"Error sending perf response: {e}")
 
@@ -1,18 +1,86 @@
 from os import getenv, path
 import sqlite3
-import json
 from threading import local
 from contextlib import contextmanager
 import datetime
+import asyncio
 
 from dotenv import load_dotenv
 from fastapi import status, HTTPException
 from passlib.context import CryptContext
 
+try:
+    from services.db_writer import DatabaseWriter
+except:
+    from server.services.db_writer import DatabaseWriter
+
 load_dotenv()
 
 CRYPTCONTEXT_SCHEME = getenv("CRYPTCONTEXT_SCHEME")
 DB_NAME = getenv("DB_NAME")
+# Pragmas for the writer thread's connection (mmap_size and cache_size also apply to read connections), and the maximum number of write operations committed in one transaction
+DB_SYNCHRONOUS = getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_MMAP_SIZE = int(getenv("DB_MMAP_SIZE", 64 * 1024 * 1024))
+DB_CACHE_SIZE = int(getenv("DB_CACHE_SIZE", -16000))
+DB_WRITER_MAX_BATCH = int(getenv("DB_WRITER_MAX_BATCH", 256))
+
+# Version of the database schema, stored in SQLite's user_version pragma. Databases created by older versions are upgraded by DatabaseManager.migrate()
+SCHEMA_VERSION = 4
+
+UNIX_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Largest value SQLite stores in an INTEGER column
+MAX_SQLITE_INTEGER = 2**63 - 1
+
+# The messages table and its indexes at the current schema version. Message ids and per-channel sequence numbers are assigned by the server, see ConnectionManager.handle_chat_message()
+CREATE_MESSAGES_TABLE = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    channel TEXT,
+    content TEXT,
+    sent_at INTEGER,
+    seq INTEGER NOT NULL,
+    FOREIGN KEY (username) REFERENCES users(username)
+);"""
+
+CREATE_MESSAGES_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_messages_channel_sent_at ON messages(channel, sent_at);",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_channel_seq ON messages(channel, seq);",
+    "CREATE INDEX IF NOT EXISTS idx_messages_channel_id ON messages(channel, id);",
+]
+
+# The users table, and the subscriptions table holding one row for each channel a user is subscribed to, at the current schema version. The subscriptions table's primary key finds a user's channels and its index a channel's members
+CREATE_USERS_TABLE = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY UNIQUE NOT NULL,
+    password_hashed TEXT NOT NULL,
+    disabled BOOLEAN DEFAULT 0,
+    creation_date DATETIME DEFAULT CURRENT_TIMESTAMP
+);"""
+
+CREATE_SUBSCRIPTIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS subscriptions (
+    username TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    PRIMARY KEY (username, channel),
+    FOREIGN KEY (username) REFERENCES users(username)
+) WITHOUT ROWID;"""
+
+CREATE_SUBSCRIPTIONS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_subscriptions_channel ON subscriptions(channel, username);",
+]
+
+# Channels every new account is subscribed to
+DEFAULT_CHANNELS = ["welcome"]
+
+INSERT_USER_QUERY = "INSERT INTO users (username, password_hashed) VALUES (:username, :password_hashed)"
+INSERT_SUBSCRIPTION_QUERY = "INSERT OR IGNORE INTO subscriptions (username, channel) VALUES (:username, :channel)"
+DELETE_SUBSCRIPTION_QUERY = "DELETE FROM subscriptions WHERE username = :username AND channel = :channel"
+
+INSERT_MESSAGES_QUERY = "INSERT INTO messages (id, username, channel, content, sent_at, seq) VALUES (:id, :username, :channel, :content, :sent_at, :seq)"
+# Used when replaying the message journal, which can hold messages that were written to the database before the server stopped
+REPLAY_MESSAGES_QUERY = "INSERT OR IGNORE INTO messages (id, username, channel, content, sent_at, seq) VALUES (:id, :username, :channel, :content, :sent_at, :seq)"
 
 
 pwd_context = CryptContext(schemes=[CRYPTCONTEXT_SCHEME], deprecated="auto")
@@ -35,6 +103,7 @@ class DatabaseManager:
             DB_NAME (str): Name of the database file, retrieved from environment variables.
             DB_FILEPATH (str): Absolute path to the database file.
             _local (threading.local): Thread-local storage for SQLite connections.
+            writer (DatabaseWriter): Writer thread that message inserts are sent to, started by the server on startup.
 
         Automatically initializes the database schema if it does not exist.
         """
@@ -44,6 +113,13 @@ class DatabaseManager:
         self.DB_FILEPATH = self.create_db_filepath()
         self._local = local()
         self.init_database()
+        self.writer = DatabaseWriter(
+            self.DB_FILEPATH,
+            DB_SYNCHRONOUS,
+            DB_MMAP_SIZE,
+            DB_CACHE_SIZE,
+            DB_WRITER_MAX_BATCH,
+        )
 
     @contextmanager
     def get_connection(self):
@@ -64,6 +140,21 @@ class DatabaseManager:
         finally:
             pass  # We'll keep the connection open for reuse
 
+    def open_read_only_connection(self) -> sqlite3.Connection:
+        """
+        Opens a read-only connection and makes it the calling thread's connection, so the read methods can run on that thread without being able to write. Used by the reader threads of AsyncDatabaseManager.
+
+        Returns:
+            sqlite3.Connection: The connection, which can be closed from another thread once the calling thread has finished with it.
+        """
+        conn = sqlite3.connect(
+            f"file:{self.DB_FILEPATH}?mode=ro", uri=True, check_same_thread=False
+        )
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size = {DB_CACHE_SIZE}")
+        self._local.conn = conn
+        return conn
+
     @contextmanager
     def get_cursor(self):
         """
@@ -84,40 +175,176 @@ class DatabaseManager:
                 cursor.close()
 
     def init_database(self) -> None:
-        """Initializes the database schema by creating the required tables and indexes.
+        """Initializes the database schema by creating the required tables and indexes, or upgrades an existing database to the current schema.
 
         Creates:
             - `users` table: Stores user data.
-            - `messages` table: Stores chat messages.
-            - `idx_messages_channel` index: Speeds up queries on the `messages` table by channel."""
-        
-        create_users_table = """
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY UNIQUE NOT NULL,
-            password_hashed TEXT NOT NULL,
-            disabled BOOLEAN DEFAULT 0,
-            channels TEXT,
-            creation_date DATETIME DEFAULT CURRENT_TIMESTAMP
-        );"""
-
-        create_messages_table = """
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT,
-            channel TEXT,
-            content TEXT,
-            sent_at TEXT,
-            FOREIGN KEY (username) REFERENCES users(username)
-        );"""
-
-        create_index_messages = "CREATE INDEX IF NOT EXISTS idx_messages_channel ON messages(channel);"
+            - `subscriptions` table: Stores the channels each user is subscribed to, one row per user and channel.
+            - `idx_subscriptions_channel` index: Finds the members of a channel.
+            - `messages` table: Stores chat messages, with `sent_at` in microseconds since the Unix epoch.
+            - `idx_messages_channel_sent_at` index: Speeds up queries on the `messages` table by channel and time range.
+            - `idx_messages_channel_seq` index: Keeps sequence numbers unique per channel, and speeds up queries by channel and sequence number.
+            - `idx_messages_channel_id` index: Serves pages of a channel's history by message id, see `retrieve_channel_history()`."""
 
         with self.get_cursor() as cur:
-            cur.execute(create_users_table)
-            cur.execute(create_messages_table)
-            cur.execute(create_index_messages)
+            # WAL mode is stored in the database file, and lets reads continue while the writer thread commits
+            cur.execute("PRAGMA journal_mode = WAL")
+            # Taken before the schema is read, so a second process opening the database at the same time, such as the auth server (see auth_server.py), waits for this one to create it rather than seeing it half created
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("PRAGMA user_version")
+            schema_version: int = cur.fetchone()[0]
+            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'")
+            new_database: bool = cur.fetchone() is None
+
+            if new_database:
+                cur.execute(CREATE_USERS_TABLE)
+                cur.execute(CREATE_SUBSCRIPTIONS_TABLE)
+                for create_index in CREATE_SUBSCRIPTIONS_INDEXES:
+                    cur.execute(create_index)
+                cur.execute(CREATE_MESSAGES_TABLE)
+                for create_index in CREATE_MESSAGES_INDEXES:
+                    cur.execute(create_index)
+                cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
             cur.connection.commit()
 
+            if not new_database and schema_version < SCHEMA_VERSION:
+                self.migrate(cur, schema_version)
+
+    def migrate(self, cur: sqlite3.Cursor, schema_version: int) -> None:
+        """
+        Upgrades the database schema one version at a time, each in its own transaction, until it reaches SCHEMA_VERSION. Each migration uses the table definition of the version it migrates to, not the current one.
+
+        Args:
+            cur (sqlite3.Cursor): Cursor on the connection to migrate.
+            schema_version (int): The database's current schema version.
+
+        Raises:
+            sqlite3.Error: If a migration fails, after rolling it back.
+        """
+        migrations = {
+            0: self.migrate_sent_at_to_integer,
+            1: self.migrate_server_assigned_ids,
+            2: self.migrate_channels_to_subscriptions,
+            3: self.migrate_channel_id_index,
+        }
+        for version in range(schema_version, SCHEMA_VERSION):
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+                # Another process opening the database at the same time may have run this migration already
+                cur.execute("PRAGMA user_version")
+                if cur.fetchone()[0] > version:
+                    cur.connection.commit()
+                    continue
+                migrations[version](cur)
+                cur.execute(f"PRAGMA user_version = {version + 1}")
+                cur.connection.commit()
+                print(f"Migrated database schema to version {version + 1}")
+            except Exception as e:
+                cur.connection.rollback()
+                print(f"Error migrating database schema from version {version}: \n{e}")
+                raise
+
+    def migrate_sent_at_to_integer(self, cur: sqlite3.Cursor) -> None:
+        """
+        Schema version 0 to 1: converts `messages.sent_at` from ISO 8601 strings to microseconds since the Unix epoch. SQLite can't change a column's type, so the table is rebuilt with an INTEGER column, and the (channel) index is replaced by one on (channel, sent_at).
+
+        Args:
+            cur (sqlite3.Cursor): Cursor on the connection to migrate, inside a transaction.
+        """
+        cur.connection.create_function(
+            "iso_to_microseconds", 1, self.iso_to_microseconds, deterministic=True
+        )
+        cur.execute("ALTER TABLE messages RENAME TO messages_old")
+        cur.execute("DROP INDEX IF EXISTS idx_messages_channel")
+        cur.execute(
+            """
+            CREATE TABLE messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT,
+                channel TEXT,
+                content TEXT,
+                sent_at INTEGER,
+                FOREIGN KEY (username) REFERENCES users(username)
+            );"""
+        )
+        cur.execute(
+            """
+            INSERT INTO messages (id, username, channel, content, sent_at)
+            SELECT id, username, channel, content, iso_to_microseconds(sent_at) FROM messages_old
+            """
+        )
+        cur.execute("DROP TABLE messages_old")
+        cur.execute("CREATE INDEX idx_messages_channel_sent_at ON messages(channel, sent_at);")
+
+    def migrate_server_assigned_ids(self, cur: sqlite3.Cursor) -> None:
+        """
+        Schema version 1 to 2: adds the per-channel `seq` column, numbering existing messages in each channel in id order, and drops AUTOINCREMENT from `id` now that the server assigns ids. The table is rebuilt, as SQLite can't change a primary key.
+
+        Args:
+            cur (sqlite3.Cursor): Cursor on the connection to migrate, inside a transaction.
+        """
+        cur.execute("ALTER TABLE messages RENAME TO messages_old")
+        cur.execute("DROP INDEX IF EXISTS idx_messages_channel_sent_at")
+        cur.execute(
+            """
+            CREATE TABLE messages (
+                id INTEGER PRIMARY KEY,
+                username TEXT,
+                channel TEXT,
+                content TEXT,
+                sent_at INTEGER,
+                seq INTEGER NOT NULL,
+                FOREIGN KEY (username) REFERENCES users(username)
+            );"""
+        )
+        cur.execute(
+            """
+            INSERT INTO messages (id, username, channel, content, sent_at, seq)
+            SELECT id, username, channel, content, sent_at,
+                ROW_NUMBER() OVER (PARTITION BY channel ORDER BY id)
+            FROM messages_old
+            """
+        )
+        cur.execute("DROP TABLE messages_old")
+        cur.execute("CREATE INDEX idx_messages_channel_sent_at ON messages(channel, sent_at);")
+        cur.execute("CREATE UNIQUE INDEX idx_messages_channel_seq ON messages(channel, seq);")
+
+    def migrate_channels_to_subscriptions(self, cur: sqlite3.Cursor) -> None:
+        """
+        Schema version 2 to 3: moves each user's channels from the JSON array in `users.channels` to a row per channel in the new `subscriptions` table, then drops the column. Values that aren't a valid JSON array are treated as no channels.
+
+        Args:
+            cur (sqlite3.Cursor): Cursor on the connection to migrate, inside a transaction.
+        """
+        cur.execute(
+            """
+            CREATE TABLE subscriptions (
+                username TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                PRIMARY KEY (username, channel),
+                FOREIGN KEY (username) REFERENCES users(username)
+            ) WITHOUT ROWID;"""
+        )
+        cur.execute("CREATE INDEX idx_subscriptions_channel ON subscriptions(channel, username);")
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO subscriptions (username, channel)
+            SELECT users.username, channel.value
+            FROM users, json_each(users.channels) AS channel
+            WHERE json_valid(users.channels) AND json_type(users.channels) = 'array' AND channel.type = 'text'
+            """
+        )
+        cur.execute("ALTER TABLE users DROP COLUMN channels")
+
+    def migrate_channel_id_index(self, cur: sqlite3.Cursor) -> None:
+        """
+        Schema version 3 to 4: adds the (channel, id) index used to page through a channel's history.
+
+        Args:
+            cur (sqlite3.Cursor): Cursor on the connection to migrate, inside a transaction.
+        """
+        cur.execute("CREATE INDEX idx_messages_channel_id ON messages(channel, id);")
+
     def insert_query(self, query: str, values: dict) -> None:
         """
         Executes an INSERT SQL query.
@@ -166,10 +393,12 @@ class DatabaseManager:
 
         Args:
             messages (list[dict]): List of message dictionaries. Each dictionary must contain:
+                - id (int, assigned by the server)
+                - seq (int, assigned by the server)
                 - username (str)
                 - channel (str)
                 - content (str)
-                - sent_at (str, ISO 8601 format)
+                - sent_at (int, microseconds since the Unix epoch)
 
         Raises:
             Exception: Prints the error and rolls back the transaction on failure.
@@ -177,7 +406,7 @@ class DatabaseManager:
 
         with self.get_cursor() as cur:
             try:
-                batch_insert_query = "INSERT INTO messages (username, channel, content, sent_at) VALUES (:username, :channel, :content, :sent_at)"
+                batch_insert_query = INSERT_MESSAGES_QUERY
                 cur.executemany(batch_insert_query, messages)
                 cur.connection.commit()
                 return True
@@ -188,6 +417,43 @@ class DatabaseManager:
                 )
                 return None
 
+    def replay_messages(self, messages: list[dict]) -> int:
+        """
+        Inserts messages recovered from the message journal on startup, skipping any that are already in the database. Runs before the writer thread starts.
+
+        Args:
+            messages (list[dict]): List of message dictionaries, in the format described in `batch_insert_messages()`.
+
+        Returns:
+            int: The number of messages inserted.
+
+        Raises:
+            sqlite3.Error: If the insert fails, after rolling it back.
+        """
+        with self.get_cursor() as cur:
+            try:
+                cur.executemany(REPLAY_MESSAGES_QUERY, messages)
+                inserted: int = cur.rowcount
+                cur.connection.commit()
+                return inserted
+            except Exception:
+                cur.connection.rollback()
+                raise
+
+    def insert_messages(self, messages: list[dict]) -> asyncio.Future:
+        """
+        Queues a batch of messages to be inserted by the writer thread, without blocking the event loop. Must be called from the event loop thread.
+
+        Args:
+            messages (list[dict]): List of message dictionaries, in the format described in `batch_insert_messages()`.
+
+        Returns:
+            asyncio.Future: Resolves to the number of rows inserted once committed, or raises the exception the insert failed with, in which case none of the messages were written.
+        """
+        return self.writer.submit(
+            lambda cur: cur.executemany(INSERT_MESSAGES_QUERY, messages).rowcount
+        )
+
     def retrieve_existing_usernames(self) -> set:
         """
         Fetches all usernames from the `users` table.
@@ -232,14 +498,13 @@ class DatabaseManager:
         password_hashed = pwd_context.hash(password)
         try:
             # Create account in database
-            create_account_query = "INSERT INTO users (username, password_hashed, channels) VALUES (:username, :password_hashed, :channels)"
-            create_account_values = {
-                "username": username,
-                "password_hashed": password_hashed,
-                "channels": json.dumps(["welcome"]),
-            }
-
-            self.insert_query(create_account_query, create_account_values)
+            with self.get_cursor() as cur:
+                try:
+                    self.insert_account(cur, username, password_hashed)
+                    cur.connection.commit()
+                except Exception:
+                    cur.connection.rollback()
+                    raise
 
             return {"status": "account created"}
         except Exception as e:
@@ -248,6 +513,25 @@ class DatabaseManager:
                 status_code=500, detail={"status": "Internal server error"}
             )
 
+    @staticmethod
+    def insert_account(cur: sqlite3.Cursor, username: str, password_hashed: str) -> None:
+        """
+        Inserts a new user and subscribes them to the default channels. Does not commit.
+
+        Args:
+            cur (sqlite3.Cursor): Cursor to insert with.
+            username (str): The username.
+            password_hashed (str): The hashed password.
+
+        Raises:
+            sqlite3.IntegrityError: If the username already exists.
+        """
+        cur.execute(INSERT_USER_QUERY, {"username": username, "password_hashed": password_hashed})
+        cur.executemany(
+            INSERT_SUBSCRIPTION_QUERY,
+            [{"username": username, "channel": channel} for channel in DEFAULT_CHANNELS],
+        )
+
     def retrieve_existing_accounts(self) -> dict:
         """
         Fetches all accounts from the `users` table.
@@ -269,6 +553,30 @@ class DatabaseManager:
         }
         return accounts
 
+    def retrieve_account(self, username: str) -> dict | None:
+        """
+        Fetches one account from the `users` table by its primary key.
+
+        Args:
+            username (str): The username of the account.
+
+        Returns:
+            dict | None: The account's "username", "password_hashed" and "disabled" values, or None if there is no such account.
+        """
+
+        users = self.select_query(
+            "SELECT username, password_hashed, disabled FROM users WHERE username = :username",
+            {"username": username},
+        )
+        if not users:
+            return None
+        user = users[0]
+        return {
+            "username": user[0],
+            "password_hashed": user[1],
+            "disabled": bool(user[2]),
+        }
+
     def retrieve_channels(self, username: str) -> set:
         """
         Fetches the channels a user is subscribed to.
@@ -280,12 +588,29 @@ class DatabaseManager:
             set: A set of channel names.
         """
 
-        query = "SELECT channels FROM users WHERE username = :username"
+        query = "SELECT channel FROM subscriptions WHERE username = :username"
         values = {"username": username}
-        channels_raw = self.select_query(query, values)
-        channels_str: str = channels_raw[0][0] if channels_raw[0][0] else "[]"
-        channels = set(json.loads(channels_str))
-        return channels
+        return set(channel[0] for channel in self.select_query(query, values))
+
+    def retrieve_max_message_id(self) -> int:
+        """
+        Fetches the highest message id stored, so the server can continue numbering messages after it.
+
+        Returns:
+            int: The highest message id, or 0 if there are no messages.
+        """
+        rows = self.select_query("SELECT MAX(id) FROM messages")
+        return (rows[0][0] or 0) if rows else 0
+
+    def retrieve_channel_seqs(self) -> dict[str, int]:
+        """
+        Fetches the sequence number of the last message stored in each channel, so the server can continue numbering each channel's messages after it.
+
+        Returns:
+            dict[str, int]: The highest sequence number in each channel that has messages.
+        """
+        rows = self.select_query("SELECT channel, MAX(seq) FROM messages GROUP BY channel")
+        return {channel: seq for channel, seq in rows}
 
     def retrieve_message_history(self, channels: set) -> list[dict]:
         """
@@ -296,25 +621,114 @@ class DatabaseManager:
 
         Returns:
             list[dict]: List of message dictionaries, each containing:
+                - id (int)
+                - seq (int)
                 - username (str)
                 - channel (str)
                 - content (str)
-                - sent_at (str)
+                - sent_at (int, microseconds since the Unix epoch)
         """
         placeholders = ",".join(["?" for _ in channels])
-        query = f"SELECT username, channel, content, sent_at FROM messages WHERE channel in ({placeholders})"
+        query = f"SELECT id, seq, username, channel, content, sent_at FROM messages WHERE channel in ({placeholders})"
         message_history_raw = self.select_query(query, list(channels))
 
         return [
             {
-                "username": message[0],
-                "channel": message[1],
-                "content": message[2],
-                "sent_at": message[3],
+                "id": message[0],
+                "seq": message[1],
+                "username": message[2],
+                "channel": message[3],
+                "content": message[4],
+                "sent_at": message[5],
             }
             for message in message_history_raw
         ]
 
+    def retrieve_channel_history(
+        self, channel: str, before_id: int | None = None, after_id: int | None = None, limit: int = 50
+    ) -> list[dict]:
+        """
+        Fetches one page of a channel's messages by message id (keyset pagination). Each page is a seek into the (channel, id) index followed by at most `limit` primary key lookups, so it costs the same however many messages the table holds and however far back the page is.
+
+        Args:
+            channel (str): The channel name.
+            before_id (int | None): Return the messages just before this id. If neither bound is given, the latest messages are returned.
+            after_id (int | None): Return the messages just after this id. Takes precedence over before_id as the direction to page in, with before_id still applied as an upper bound.
+            limit (int): Maximum number of messages to return.
+
+        Returns:
+            list[dict]: The messages, oldest first, in the format described in `retrieve_message_history()`.
+        """
+        # Missing bounds are replaced by ones no id falls outside of, so both are always a range on the index
+        values = {
+            "channel": channel,
+            "after_id": after_id if after_id is not None else 0,
+            "before_id": before_id if before_id is not None else MAX_SQLITE_INTEGER,
+            "limit": limit,
+        }
+        order = "ASC" if after_id is not None else "DESC"
+        query = f"""
+            SELECT id, seq, username, channel, content, sent_at FROM messages
+            WHERE channel = :channel AND id > :after_id AND id < :before_id
+            ORDER BY id {order} LIMIT :limit
+        """
+        rows = self.select_query(query, values)
+        if order == "DESC":
+            rows.reverse()
+
+        return [
+            {
+                "id": message[0],
+                "seq": message[1],
+                "username": message[2],
+                "channel": message[3],
+                "content": message[4],
+                "sent_at": message[5],
+            }
+            for message in rows
+        ]
+
+    def retrieve_recent_messages(self, per_channel: int) -> list[dict]:
+        """
+        Fetches the latest messages of every channel in one query, to fill the in-memory recent message buffers when the server starts.
+
+        For each channel, the id of its per_channel'th latest message is found by a seek into the (channel, id) index, and the messages from there on are read as a range of it. A ROW_NUMBER() window over the channel would give the same rows, but has to number every message in the table first, which takes seconds on a large one.
+
+        Args:
+            per_channel (int): Maximum number of messages to return for each channel.
+
+        Returns:
+            list[dict]: The messages grouped by channel, oldest first within each channel, in the format described in `retrieve_message_history()`.
+        """
+        if per_channel <= 0:
+            return []
+        # CROSS JOIN keeps the channels as the outer loop, so each channel is one range on the index
+        query = """
+            SELECT m.id, m.seq, m.username, m.channel, m.content, m.sent_at
+            FROM (SELECT DISTINCT channel FROM messages) AS channels
+            CROSS JOIN messages AS m ON m.channel = channels.channel AND m.id >= COALESCE(
+                (
+                    SELECT id FROM messages WHERE channel = channels.channel
+                    ORDER BY id DESC LIMIT 1 OFFSET :per_channel - 1
+                ),
+                0
+            )
+            ORDER BY m.channel, m.id
+        """
+        rows = self.select_query(query, {"per_channel": per_channel})
+
+        return [
+            {
+                "id": message[0],
+                "seq": message[1],
+                "username": message[2],
+                "channel": message[3],
+                "content": message[4],
+                "sent_at": message[5],
+            }
+            for message in rows
+        ]
+
     def add_channel(self, username: str, channel: str) -> None:
         """
         Adds a channel to the list of channels a user is subscribed to.
@@ -323,16 +737,7 @@ class DatabaseManager:
             username (str): The username of the user.
             channel (str): The channel to be added.
         """
-        current_channels: set = self.retrieve_channels(username)
-
-        if channel not in current_channels:
-            current_channels.add(channel)
-
-        channels_str = json.dumps(list(current_channels))
-        self.update_query(
-            "UPDATE users SET channels = :channels WHERE username = :username",
-            {"channels": channels_str, "username": username},
-        )
+        self.insert_query(INSERT_SUBSCRIPTION_QUERY, {"username": username, "channel": channel})
 
     def remove_channel(self, username: str, channel: str) -> None:
         """
@@ -342,16 +747,37 @@ class DatabaseManager:
             username (str): The username of the user.
             channel (str): The channel to be removed.
         """
-        current_channels: set = self.retrieve_channels(username)
+        self.update_query(DELETE_SUBSCRIPTION_QUERY, {"username": username, "channel": channel})
 
-        if channel in current_channels:
-            current_channels.remove(channel)
+    @staticmethod
+    def apply_subscription_changes(cur: sqlite3.Cursor, changes: list[dict]) -> None:
+        """
+        Writes a batch of subscription changes. Does not commit.
 
-        channels_str = json.dumps(list(current_channels))
-        self.update_query(
-            "UPDATE users SET channels = :channels WHERE username = :username",
-            {"channels": channels_str, "username": username},
-        )
+        Args:
+            cur (sqlite3.Cursor): Cursor to write with.
+            changes (list[dict]): Changes with "username", "channel" and "subscribed" (bool) keys, at most one per user and channel.
+        """
+        cur.executemany(INSERT_SUBSCRIPTION_QUERY, [change for change in changes if change["subscribed"]])
+        cur.executemany(DELETE_SUBSCRIPTION_QUERY, [change for change in changes if not change["subscribed"]])
+
+    def replay_subscription_changes(self, changes: list[dict]) -> None:
+        """
+        Writes subscription changes recovered from the subscription journal on startup, in one transaction. Runs before the writer thread starts.
+
+        Args:
+            changes (list[dict]): Changes with "username", "channel" and "subscribed" (bool) keys, at most one per user and channel.
+
+        Raises:
+            sqlite3.Error: If the write fails, after rolling it back.
+        """
+        with self.get_cursor() as cur:
+            try:
+                self.apply_subscription_changes(cur, changes)
+                cur.connection.commit()
+            except Exception:
+                cur.connection.rollback()
+                raise
 
     def update_query(self, query: str, values: dict) -> None:
         """
@@ -469,6 +895,27 @@ class DatabaseManager:
         """
         return datetime.datetime.fromisoformat(val)  # .decode()
 
+    @staticmethod
+    def iso_to_microseconds(val: str | None) -> int | None:
+        """
+        Converts an ISO 8601 string to microseconds since the Unix epoch. Strings without a timezone are taken to be UTC.
+
+        Args:
+            val (str | None): The ISO 8601 string to convert.
+
+        Returns:
+            int | None: Microseconds since the Unix epoch, or None if the value is missing or can't be parsed.
+        """
+        if val is None:
+            return None
+        try:
+            timestamp = datetime.datetime.fromisoformat(val)
+        except (TypeError, ValueError):
+            return None
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+        return (timestamp - UNIX_EPOCH) // datetime.timedelta(microseconds=1)
+
 
 # Create instance to be imported
 db = DatabaseManager()
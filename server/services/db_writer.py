@@ -0,0 +1,186 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+from typing import Any, Callable
+
+# A write operation, run on the writer thread with a cursor inside the current group commit's transaction
+WriteOperation = Callable[[sqlite3.Cursor], Any]
+
+
+class DatabaseWriter:
+    """
+    Performs every write to the database on one dedicated thread, so the event loop never waits on SQLite or an fsync.
+
+    The thread owns its own connection in WAL mode, which lets the event loop thread keep reading while a write is in progress. Operations are submitted through a queue and the caller gets an asyncio future back. Each time the thread wakes it takes everything queued, up to max_batch operations, and runs them in a single transaction (group commit), so a burst of writes costs one commit rather than one each. Every operation runs inside its own savepoint, so one that fails is rolled back and reported to its caller without affecting the rest of the group.
+
+    Attributes:
+        db_filepath (str): Path to the database file.
+        synchronous (str): SQLite `synchronous` pragma. NORMAL only syncs the WAL at checkpoints, which is safe from corruption in WAL mode, FULL also syncs every commit.
+        mmap_size (int): SQLite `mmap_size` pragma, bytes of the database file to memory map.
+        cache_size (int): SQLite `cache_size` pragma, pages if positive or KiB if negative.
+        max_batch (int): Maximum number of operations committed together.
+        queue (queue.SimpleQueue): Pending (operation, future, loop) entries, None tells the thread to stop.
+        thread (threading.Thread | None): The writer thread.
+        commits (int): Number of transactions committed.
+        operations (int): Number of operations run.
+    """
+
+    def __init__(
+        self,
+        db_filepath: str,
+        synchronous: str = "NORMAL",
+        mmap_size: int = 0,
+        cache_size: int = -2000,
+        max_batch: int = 256,
+    ):
+        """
+        Initializes the DatabaseWriter. The thread is started by `start()`.
+
+        Args:
+            db_filepath (str): Path to the database file.
+            synchronous (str): SQLite `synchronous` pragma: OFF, NORMAL, FULL or EXTRA.
+            mmap_size (int): SQLite `mmap_size` pragma in bytes, 0 to disable memory mapping.
+            cache_size (int): SQLite `cache_size` pragma, pages if positive or KiB if negative.
+            max_batch (int): Maximum number of operations committed together.
+        """
+        self.db_filepath: str = db_filepath
+        self.synchronous: str = synchronous
+        self.mmap_size: int = mmap_size
+        self.cache_size: int = cache_size
+        self.max_batch: int = max_batch
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread: threading.Thread | None = None
+        self.commits: int = 0
+        self.operations: int = 0
+
+    def start(self):
+        """
+        Starts the writer thread, if it isn't already running.
+        """
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    async def stop(self):
+        """
+        Stops the writer thread once every operation already submitted has been committed.
+        """
+        if not self.thread:
+            return
+        self.queue.put(None)
+        await asyncio.to_thread(self.thread.join)
+        self.thread = None
+
+    def submit(self, operation: WriteOperation) -> asyncio.Future:
+        """
+        Queues a write operation. Must be called from the event loop thread.
+
+        Args:
+            operation (WriteOperation): Function called on the writer thread with a cursor. It must not commit or roll back.
+
+        Returns:
+            asyncio.Future: Resolves to the operation's return value once it has been committed, or raises the exception it failed with.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.thread or not self.thread.is_alive():
+            future.set_exception(RuntimeError("Database writer is not running"))
+            return future
+        self.queue.put((operation, future, loop))
+        return future
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Opens the writer's connection and applies the pragmas. Transactions are managed explicitly, so the connection is in autocommit mode.
+
+        Returns:
+            sqlite3.Connection: The connection.
+        """
+        connection = sqlite3.connect(self.db_filepath, isolation_level=None)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute(f"PRAGMA synchronous = {self.synchronous}")
+        connection.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        connection.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        return connection
+
+    def run(self):
+        """
+        Writer thread: waits for operations, then commits everything queued as one group until told to stop.
+        """
+        connection = self.connect()
+        stopping = False
+        try:
+            while not stopping:
+                entry = self.queue.get()
+                if entry is None:
+                    break
+                batch = [entry]
+                while len(batch) < self.max_batch:
+                    try:
+                        entry = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if entry is None:
+                        stopping = True
+                        break
+                    batch.append(entry)
+                self.commit_batch(connection, batch)
+        finally:
+            connection.close()
+
+    def commit_batch(self, connection: sqlite3.Connection, batch: list[tuple]):
+        """
+        Runs a group of operations in one transaction, each in its own savepoint, and resolves their futures once committed.
+
+        Args:
+            connection (sqlite3.Connection): The writer's connection.
+            batch (list[tuple]): (operation, future, loop) entries.
+        """
+        outcomes: list[tuple[Any, BaseException | None]] = []
+        cur = connection.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            for operation, _, _ in batch:
+                cur.execute("SAVEPOINT operation")
+                try:
+                    outcomes.append((operation(cur), None))
+                    cur.execute("RELEASE operation")
+                except Exception as e:
+                    cur.execute("ROLLBACK TO operation")
+                    cur.execute("RELEASE operation")
+                    outcomes.append((None, e))
+            cur.execute("COMMIT")
+            self.commits += 1
+            self.operations += len(batch)
+        except Exception as e:
+            if connection.in_transaction:
+                connection.rollback()
+            outcomes = [(None, e)] * len(batch)
+        finally:
+            cur.close()
+
+        for (_, future, loop), (result, exception) in zip(batch, outcomes):
+            try:
+                loop.call_soon_threadsafe(self.resolve, future, result, exception)
+            except RuntimeError:
+                # The event loop has already closed, nothing is waiting for the result
+                pass
+
+    @staticmethod
+    def resolve(future: asyncio.Future, result: Any, exception: BaseException | None):
+        """
+        Sets the outcome of an operation's future. Runs on the event loop thread.
+
+        Args:
+            future (asyncio.Future): The future returned by `submit()`.
+            result (Any): The operation's return value.
+            exception (BaseException | None): The exception the operation or its commit failed with.
+        """
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
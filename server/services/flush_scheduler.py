@@ -0,0 +1,213 @@
+import asyncio
+import time
+from logging import Logger
+from typing import Awaitable, Callable
+
+
+class FlushScheduler:
+    """
+    Decides when to write buffered changes to the database, by thresholds on how many rows and bytes are pending and how long the oldest has waited. It's told about each change as it's buffered, and sleeps until a threshold is crossed or the oldest change reaches max_age, rather than polling.
+
+    The flush function writes everything buffered at the time it's called. If it fails, the rows it was given are counted as pending again, and the next attempt waits for max_age so a failing database isn't retried in a tight loop.
+
+    Attributes:
+        name (str): Name used in log messages.
+        flush (Callable): Coroutine function that writes the buffered changes, returning False if the write failed.
+        logger (Logger): Logger instance.
+        max_rows (int): Flush once this many rows are pending, 0 for no limit.
+        max_bytes (int): Flush once this many bytes are pending, 0 for no limit.
+        max_age (float): Flush once the oldest pending row has waited this many seconds.
+        pending_rows (int): Rows buffered since the last flush started.
+        pending_bytes (int): Bytes buffered since the last flush started.
+        oldest_pending (float | None): time.monotonic() when the oldest pending row was buffered.
+        retry_at (float | None): time.monotonic() before which a failed flush isn't retried.
+        task (asyncio.Task | None): The scheduling task.
+        flushes (int): Number of flushes run.
+        failed_flushes (int): Number of flushes that failed.
+        rows_flushed (int): Total rows written.
+        bytes_flushed (int): Total bytes written.
+        last_flush_rows (int): Rows written by the last flush.
+        last_flush_bytes (int): Bytes written by the last flush.
+        last_flush_duration (float): Seconds the last flush took.
+        total_flush_duration (float): Seconds all flushes took.
+        max_flush_duration (float): Seconds the slowest flush took.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        flush: Callable[[], Awaitable[bool]],
+        logger: Logger,
+        max_rows: int = 0,
+        max_bytes: int = 0,
+        max_age: float = 1.0,
+    ):
+        """
+        Initializes the FlushScheduler. The scheduling task is started by `start()`.
+
+        Args:
+            name (str): Name used in log messages.
+            flush (Callable): Coroutine function that writes the buffered changes, returning False if the write failed.
+            logger (Logger): Logger instance.
+            max_rows (int): Flush once this many rows are pending, 0 for no limit.
+            max_bytes (int): Flush once this many bytes are pending, 0 for no limit.
+            max_age (float): Flush once the oldest pending row has waited this many seconds.
+        """
+        self.name: str = name
+        self.flush: Callable[[], Awaitable[bool]] = flush
+        self.logger: Logger = logger
+        self.max_rows: int = max_rows
+        self.max_bytes: int = max_bytes
+        self.max_age: float = max_age
+        self.pending_rows: int = 0
+        self.pending_bytes: int = 0
+        self.oldest_pending: float | None = None
+        self.retry_at: float | None = None
+        self.task: asyncio.Task | None = None
+        self._wake: asyncio.Event = asyncio.Event()
+        self.flushes: int = 0
+        self.failed_flushes: int = 0
+        self.rows_flushed: int = 0
+        self.bytes_flushed: int = 0
+        self.last_flush_rows: int = 0
+        self.last_flush_bytes: int = 0
+        self.last_flush_duration: float = 0.0
+        self.total_flush_duration: float = 0.0
+        self.max_flush_duration: float = 0.0
+
+    def add(self, rows: int = 1, size: int = 0):
+        """
+        Counts changes that have been buffered, waking the scheduling task if they start the age timer or cross a threshold.
+
+        Args:
+            rows (int): Number of rows buffered.
+            size (int): Their size in bytes.
+        """
+        self.pending_rows += rows
+        self.pending_bytes += size
+        if self.oldest_pending is None:
+            self.oldest_pending = time.monotonic()
+            self._wake.set()
+        elif self.threshold_crossed():
+            self._wake.set()
+
+    def threshold_crossed(self) -> bool:
+        """
+        Returns:
+            bool: Whether enough rows or bytes are pending to flush without waiting for max_age.
+        """
+        return (self.max_rows and self.pending_rows >= self.max_rows) or (
+            self.max_bytes and self.pending_bytes >= self.max_bytes
+        )
+
+    def seconds_until_due(self) -> float | None:
+        """
+        Returns:
+            float | None: Seconds until the pending rows should be flushed, 0 if they are due now, or None if nothing is pending.
+        """
+        if self.oldest_pending is None:
+            return None
+        now: float = time.monotonic()
+        if self.retry_at is not None and now < self.retry_at:
+            return self.retry_at - now
+        if self.threshold_crossed():
+            return 0
+        return max(0.0, self.oldest_pending + self.max_age - now)
+
+    def start(self):
+        """
+        Starts the scheduling task, if it isn't already running.
+        """
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Stops the scheduling task. Anything still pending is left for the caller to flush with `flush_now()`.
+        """
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        """
+        Scheduling task: sleeps until the pending rows are due, flushes them, and repeats.
+        """
+        while True:
+            delay: float | None = self.seconds_until_due()
+            if delay is None or delay > 0:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.flush_now()
+
+    async def flush_now(self) -> bool:
+        """
+        Flushes whatever is pending straight away, whether or not a threshold has been reached.
+
+        Returns:
+            bool: False if the flush failed.
+        """
+        rows: int = self.pending_rows
+        size: int = self.pending_bytes
+        oldest: float | None = self.oldest_pending
+        self.pending_rows = 0
+        self.pending_bytes = 0
+        self.oldest_pending = None
+        self.retry_at = None
+
+        start: float = time.perf_counter()
+        try:
+            succeeded: bool = await self.flush()
+        except Exception as e:
+            self.logger.warning(f"{self.name} flush failed: {type(e).__name__}: {e}")
+            succeeded = False
+        duration: float = time.perf_counter() - start
+
+        if not succeeded:
+            self.failed_flushes += 1
+            self.pending_rows += rows
+            self.pending_bytes += size
+            if oldest is not None:
+                self.oldest_pending = min(oldest, self.oldest_pending or oldest)
+            self.retry_at = time.monotonic() + self.max_age
+            return False
+
+        if rows:
+            self.flushes += 1
+            self.rows_flushed += rows
+            self.bytes_flushed += size
+            self.last_flush_rows = rows
+            self.last_flush_bytes = size
+            self.last_flush_duration = duration
+            self.total_flush_duration += duration
+            self.max_flush_duration = max(self.max_flush_duration, duration)
+            self.logger.debug(f"{self.name} flush: {rows} rows, {size} bytes in {duration * 1000:.1f} ms")
+        return True
+
+    def metrics(self) -> dict:
+        """
+        Returns:
+            dict: Flush counts, sizes and durations, and what's currently pending.
+        """
+        return {
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "rows_flushed": self.rows_flushed,
+            "bytes_flushed": self.bytes_flushed,
+            "last_flush_rows": self.last_flush_rows,
+            "last_flush_bytes": self.last_flush_bytes,
+            "last_flush_duration_ms": round(self.last_flush_duration * 1000, 3),
+            "mean_flush_duration_ms": round(self.total_flush_duration / self.flushes * 1000, 3) if self.flushes else 0,
+            "max_flush_duration_ms": round(self.max_flush_duration * 1000, 3),
+            "pending_rows": self.pending_rows,
+            "pending_bytes": self.pending_bytes,
+            "pending_age_ms": round((time.monotonic() - self.oldest_pending) * 1000, 3) if self.oldest_pending is not None else 0,
+        }
@@ -0,0 +1,158 @@
+import datetime
+
+from google.protobuf.message import DecodeError
+
+try:
+    import message_pb2
+    from services.codec import PROTOCOL_VERSION, encode_field_tag, encode_varint
+    from services.name_interner import NameInterner
+except:
+    from server import message_pb2
+    from server.services.codec import PROTOCOL_VERSION, encode_field_tag, encode_varint
+    from server.services.name_interner import NameInterner
+
+# Compatibility shim for clients that still speak the original protocol, where every frame is a ChatMessage and the event is a string.
+# The server only handles Envelopes internally. Frames from these clients are converted to an Envelope as they arrive, and Envelopes bound for them are converted back just before being queued, with interned ids replaced by the names they stand for
+
+LEGACY_PROTOCOL_VERSION = 1
+
+_legacy = message_pb2.ChatMessage()
+_envelope = message_pb2.Envelope()
+
+UNIX_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Event name used by the ChatMessage protocol for each event type
+EVENT_NAMES: dict[int, str] = {
+    message_pb2.EVENT_TYPE_MESSAGE: "message",
+    message_pb2.EVENT_TYPE_CHANNEL_SUBSCRIPTIONS: "channel_subscriptions",
+    message_pb2.EVENT_TYPE_ADD_CHANNEL: "add_channel",
+    message_pb2.EVENT_TYPE_LEAVE_CHANNEL: "leave_channel",
+    message_pb2.EVENT_TYPE_PERF_TEST: "perf_test",
+    message_pb2.EVENT_TYPE_BATCH: "batch",
+}
+EVENT_TYPES: dict[str, int] = {name: event_type for event_type, name in EVENT_NAMES.items()}
+
+# Serialized `event: "batch"` field, and the tag that precedes each message embedded in the `batch` field
+BATCH_EVENT_PREFIX: bytes = message_pb2.ChatMessage(event="batch").SerializeToString()
+BATCH_FIELD_TAG: bytes = encode_field_tag(message_pb2.ChatMessage.BATCH_FIELD_NUMBER)
+
+
+def encode_legacy_batch(messages: list[bytes]) -> bytes:
+    """
+    Wraps already serialized ChatMessages in a single "batch" ChatMessage, copying them in as they are.
+
+    Args:
+        messages (list[bytes]): Serialized ChatMessages.
+
+    Returns:
+        bytes: The serialized batch message.
+    """
+    parts = [BATCH_EVENT_PREFIX]
+    for message_bytes in messages:
+        parts.append(BATCH_FIELD_TAG)
+        parts.append(encode_varint(len(message_bytes)))
+        parts.append(message_bytes)
+    return b"".join(parts)
+
+
+def microseconds_to_iso(sent_at_us: int) -> str:
+    """
+    Converts a timestamp in microseconds since the Unix epoch to the UTC ISO 8601 string the ChatMessage protocol uses.
+
+    Args:
+        sent_at_us (int): Microseconds since the Unix epoch.
+
+    Returns:
+        str: The ISO 8601 formatted string.
+    """
+    return (UNIX_EPOCH + datetime.timedelta(microseconds=sent_at_us)).isoformat()
+
+
+def legacy_to_envelope(message_bytes: bytes) -> bytes:
+    """
+    Converts a ChatMessage received from a legacy client into the equivalent Envelope.
+
+    Args:
+        message_bytes (bytes): The serialized ChatMessage.
+
+    Returns:
+        bytes: The serialized Envelope.
+
+    Raises:
+        DecodeError: If the message can't be parsed or its event is not one a client can send.
+    """
+    _legacy.ParseFromString(message_bytes)
+    event_type = EVENT_TYPES.get(_legacy.event)
+    if event_type is None:
+        raise DecodeError(f"Unknown event: {_legacy.event!r}")
+
+    _envelope.Clear()
+    _envelope.version = PROTOCOL_VERSION
+    _envelope.type = event_type
+    if event_type == message_pb2.EVENT_TYPE_MESSAGE:
+        _envelope.chat.channel = _legacy.channel
+        _envelope.chat.content = _legacy.content
+    elif event_type in (message_pb2.EVENT_TYPE_ADD_CHANNEL, message_pb2.EVENT_TYPE_LEAVE_CHANNEL):
+        _envelope.channel_action.channel = _legacy.channel
+    elif event_type == message_pb2.EVENT_TYPE_PERF_TEST:
+        _envelope.perf_test.perf_test_id = _legacy.perf_test_id
+    return _envelope.SerializeToString()
+
+
+def copy_to_legacy(
+    envelope: message_pb2.Envelope,
+    legacy: message_pb2.ChatMessage,
+    channel_names: NameInterner,
+    usernames: NameInterner,
+):
+    """
+    Fills a ChatMessage with the event and payload of an Envelope, including every envelope in a batch.
+
+    Args:
+        envelope (message_pb2.Envelope): The envelope to copy from.
+        legacy (message_pb2.ChatMessage): An empty ChatMessage to copy into.
+        channel_names (NameInterner): Resolves channel ids to channel names.
+        usernames (NameInterner): Resolves username ids to usernames.
+    """
+    event_type = envelope.type
+    legacy.event = EVENT_NAMES.get(event_type, "")
+    if event_type == message_pb2.EVENT_TYPE_MESSAGE:
+        chat = envelope.chat
+        legacy.channel = chat.channel or channel_names.name(chat.channel_id) or ""
+        legacy.content = chat.content
+        legacy.username = chat.username or usernames.name(chat.username_id) or ""
+        legacy.sent_at = microseconds_to_iso(chat.sent_at_us)
+    elif event_type == message_pb2.EVENT_TYPE_CHANNEL_SUBSCRIPTIONS:
+        legacy.data.extend(envelope.channel_subscriptions.channels)
+    elif event_type in (message_pb2.EVENT_TYPE_ADD_CHANNEL, message_pb2.EVENT_TYPE_LEAVE_CHANNEL):
+        legacy.channel = envelope.channel_action.channel
+    elif event_type == message_pb2.EVENT_TYPE_PERF_TEST:
+        perf_test = envelope.perf_test
+        legacy.perf_test_id = perf_test.perf_test_id
+        legacy.cpu_load.extend(perf_test.cpu_load)
+        legacy.memory_usage = perf_test.memory_usage
+        legacy.active_connections = perf_test.active_connections
+        legacy.message_volume = perf_test.message_volume
+        legacy.mv_period = perf_test.mv_period
+        legacy.mv_adjusted = perf_test.mv_adjusted
+    elif event_type == message_pb2.EVENT_TYPE_BATCH:
+        for batched_envelope in envelope.batch.envelopes:
+            copy_to_legacy(batched_envelope, legacy.batch.add(), channel_names, usernames)
+
+
+def envelope_to_legacy(message_bytes: bytes, channel_names: NameInterner, usernames: NameInterner) -> bytes:
+    """
+    Converts an Envelope encoded by the server into the equivalent ChatMessage for a legacy client.
+
+    Args:
+        message_bytes (bytes): The serialized Envelope.
+        channel_names (NameInterner): Resolves channel ids to channel names.
+        usernames (NameInterner): Resolves username ids to usernames.
+
+    Returns:
+        bytes: The serialized ChatMessage.
+    """
+    _envelope.ParseFromString(message_bytes)
+    _legacy.Clear()
+    copy_to_legacy(_envelope, _legacy, channel_names, usernames)
+    return _legacy.SerializeToString()
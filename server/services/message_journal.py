@@ -0,0 +1,321 @@
+import asyncio
+import json
+import os
+import struct
+import zlib
+from logging import Logger
+from typing import Any, Callable
+
+try:
+    import message_pb2
+except:
+    from server import message_pb2
+
+# Each record is a header of payload length and CRC32 of the payload (both little-endian uint32), followed by the payload. The payload is encoded by the journal's record codec, a serialized Chat for messages
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".journal"
+
+_record = message_pb2.Chat()
+
+
+def encode_message_record(message: dict) -> bytes:
+    """
+    Encodes a cached message as a journal record payload.
+
+    Args:
+        message (dict): The message, in the format stored in `ConnectionManager.message_cache`.
+
+    Returns:
+        bytes: The serialized Chat.
+    """
+    _record.Clear()
+    _record.message_id = message["id"]
+    _record.seq = message["seq"]
+    _record.channel = message["channel"]
+    _record.content = message["content"]
+    _record.username = message["username"]
+    _record.sent_at_us = message["sent_at"]
+    return _record.SerializeToString()
+
+
+def decode_message_record(payload: bytes) -> dict:
+    """
+    Decodes a journal record payload written by `encode_message_record()`.
+
+    Args:
+        payload (bytes): The serialized Chat.
+
+    Returns:
+        dict: The message, in the format stored in `ConnectionManager.message_cache`.
+    """
+    _record.ParseFromString(payload)
+    return {
+        "id": _record.message_id,
+        "seq": _record.seq,
+        "channel": _record.channel,
+        "content": _record.content,
+        "username": _record.username,
+        "sent_at": _record.sent_at_us,
+    }
+
+
+def encode_subscription_record(change: dict) -> bytes:
+    """
+    Encodes a subscription change as a journal record payload.
+
+    Args:
+        change (dict): The change, with "username", "channel" and "subscribed" (bool) keys.
+
+    Returns:
+        bytes: The change as JSON.
+    """
+    return json.dumps(change).encode()
+
+
+def decode_subscription_record(payload: bytes) -> dict:
+    """
+    Decodes a journal record payload written by `encode_subscription_record()`.
+
+    Args:
+        payload (bytes): The change as JSON.
+
+    Returns:
+        dict: The change.
+    """
+    return json.loads(payload)
+
+
+def frame_record(payload: bytes) -> bytes:
+    """
+    Prefixes a record payload with its length and checksum.
+
+    Args:
+        payload (bytes): The encoded record.
+
+    Returns:
+        bytes: The record as written to a segment.
+    """
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_records(data: bytes, decode: Callable[[bytes], Any]) -> tuple[list, int]:
+    """
+    Decodes the records in a journal segment, stopping at the first incomplete or corrupt record, which is what a crash in the middle of a write leaves behind.
+
+    Args:
+        data (bytes): The contents of the segment.
+        decode (Callable): Decodes a record payload.
+
+    Returns:
+        tuple: The records decoded, and the number of bytes they were decoded from.
+    """
+    records: list = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, checksum = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        records.append(decode(payload))
+        offset = start + length
+    return records, offset
+
+
+class MessageJournal:
+    """
+    Append-only journal on local disk of changes held in memory until they are written to the database, so they survive the process dying. The server keeps one for the chat messages in `ConnectionManager.message_cache`, and one for subscription changes.
+
+    Records are appended before the change they record takes effect in memory. Each append is a single unbuffered write, so once it returns the record is in the OS page cache and survives a crash of the process. The file is fsynced every `fsync_interval` seconds to also survive a crash of the machine, or on every append if the interval is 0.
+
+    The journal is split into numbered segment files. Each upload to the database seals the current segment with `rotate()` and starts a new one for the records appended while it is in progress, and once the upload has committed `discard()` deletes the sealed segments. A failed upload leaves them in place, and they are deleted by the next upload that succeeds, which retries their records. On startup, `replay()` returns every record still in the journal so it can be written to the database.
+
+    Attributes:
+        directory (str): Directory the segment files are stored in.
+        fsync_interval (float): Seconds between fsyncs, 0 to fsync every append.
+        logger (Logger): Logger instance.
+        encode (Callable): Encodes a record to its payload.
+        decode (Callable): Decodes a record payload.
+        segment_number (int): Number of the segment currently being appended to.
+        file (io.FileIO | None): The open segment file.
+        dirty (bool): Whether anything has been appended since the last fsync.
+        fsync_task (asyncio.Task | None): Background task that fsyncs at the interval.
+        fsync_lock (asyncio.Lock): Held while a segment is fsynced or closed on a worker thread, so a segment isn't closed under a periodic fsync that's still using it.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fsync_interval: float,
+        logger: Logger,
+        encode: Callable[[Any], bytes] = encode_message_record,
+        decode: Callable[[bytes], Any] = decode_message_record,
+    ):
+        """
+        Initializes the MessageJournal. Call `replay()` to recover records from a previous run, which also opens the first segment.
+
+        Args:
+            directory (str): Directory the segment files are stored in, created if it doesn't exist. Each journal needs its own.
+            fsync_interval (float): Seconds between fsyncs, 0 to fsync every append.
+            logger (Logger): Logger instance.
+            encode (Callable): Encodes a record to its payload, chat messages by default.
+            decode (Callable): Decodes a record payload, chat messages by default.
+        """
+        self.directory: str = directory
+        self.fsync_interval: float = fsync_interval
+        self.logger: Logger = logger
+        self.encode: Callable[[Any], bytes] = encode
+        self.decode: Callable[[bytes], Any] = decode
+        self.segment_number: int = 0
+        self.file = None
+        self.dirty: bool = False
+        self.fsync_task: asyncio.Task | None = None
+        self.fsync_lock: asyncio.Lock = asyncio.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def segment_path(self, segment_number: int) -> str:
+        """
+        Args:
+            segment_number (int): The segment's number.
+
+        Returns:
+            str: Path of the segment's file.
+        """
+        return os.path.join(self.directory, f"{segment_number:012d}{SEGMENT_SUFFIX}")
+
+    def segment_numbers(self) -> list[int]:
+        """
+        Returns:
+            list[int]: Numbers of the segment files on disk, oldest first.
+        """
+        return sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX) and name[: -len(SEGMENT_SUFFIX)].isdigit()
+        )
+
+    def replay(self) -> list:
+        """
+        Reads every record left in the journal by a previous run, and opens a new segment after them. The old segments are kept until `discard()` is called once the records have been written to the database.
+
+        Returns:
+            list: The records, in the order they were appended.
+        """
+        records: list = []
+        segment_numbers = self.segment_numbers()
+        for segment_number in segment_numbers:
+            with open(self.segment_path(segment_number), "rb") as f:
+                data = f.read()
+            segment_records, valid_bytes = decode_records(data, self.decode)
+            if valid_bytes < len(data):
+                self.logger.warning(
+                    f"Journal segment {self.segment_path(segment_number)} has {len(data) - valid_bytes} bytes of incomplete or corrupt records after its last valid record, ignoring them"
+                )
+            records.extend(segment_records)
+        if segment_numbers:
+            self.segment_number = segment_numbers[-1] + 1
+        self.open_segment()
+        return records
+
+    def open_segment(self):
+        """
+        Opens the current segment for appending, unbuffered so each append is written to the OS immediately.
+        """
+        self.file = open(self.segment_path(self.segment_number), "ab", buffering=0)
+
+    def append(self, record: Any):
+        """
+        Writes a record to the journal.
+
+        Args:
+            record (Any): The record, in the format the journal's codec encodes.
+        """
+        self.file.write(frame_record(self.encode(record)))
+        if self.fsync_interval:
+            self.dirty = True
+        else:
+            os.fsync(self.file.fileno())
+
+    async def rotate(self) -> int:
+        """
+        Seals the current segment and starts a new one. Called when the in-memory changes are swapped out for upload, so the sealed segments hold only records in that upload or earlier ones. Records appended while the sealed segment is being fsynced go to the new segment.
+
+        The new segment is started straight away, but the sealed one is only closed once any periodic fsync in progress has finished with it. It is fsynced again if a periodic fsync was in progress, as that may not have covered every record, or may have failed.
+
+        Returns:
+            int: Number of the segment sealed, to pass to `discard()` once the upload has committed.
+        """
+        sealed = self.segment_number
+        sealed_file = self.file
+        dirty = self.dirty or self.fsync_lock.locked()
+        self.segment_number += 1
+        self.open_segment()
+        self.dirty = False
+        async with self.fsync_lock:
+            await asyncio.to_thread(self.close_segment, sealed_file, dirty)
+        return sealed
+
+    @staticmethod
+    def close_segment(file, dirty: bool):
+        """
+        Fsyncs a sealed segment if anything appended to it hasn't been synced yet, then closes it.
+
+        Args:
+            file (io.FileIO): The segment file.
+            dirty (bool): Whether it needs an fsync.
+        """
+        if dirty:
+            os.fsync(file.fileno())
+        file.close()
+
+    def discard(self, through_segment: int):
+        """
+        Deletes sealed segments whose records are all in the database.
+
+        Args:
+            through_segment (int): Segments numbered up to and including this one are deleted.
+        """
+        for segment_number in self.segment_numbers():
+            if segment_number > through_segment or segment_number == self.segment_number:
+                break
+            os.remove(self.segment_path(segment_number))
+
+    def start(self):
+        """
+        Starts the background fsync task, if an fsync interval is set.
+        """
+        if self.fsync_interval and not self.fsync_task:
+            self.fsync_task = asyncio.create_task(self.fsync_periodically())
+
+    async def fsync_periodically(self):
+        """
+        Fsyncs the current segment every `fsync_interval` seconds if anything has been appended to it. The fsync runs on a worker thread, as it can take milliseconds. If it fails, it is retried at the next interval.
+        """
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            if not self.dirty:
+                continue
+            async with self.fsync_lock:
+                file = self.file
+                self.dirty = False
+                try:
+                    await asyncio.to_thread(os.fsync, file.fileno())
+                except OSError as e:
+                    self.logger.warning(f"Journal fsync failed: {type(e).__name__}: {e}")
+                    if file is self.file:
+                        self.dirty = True
+
+    async def close(self):
+        """
+        Stops the fsync task, then fsyncs and closes the current segment. The task is only cancelled between fsyncs, so its worker thread isn't left using the file once it's closed.
+        """
+        async with self.fsync_lock:
+            if self.fsync_task:
+                self.fsync_task.cancel()
+                try:
+                    await self.fsync_task
+                except asyncio.CancelledError:
+                    pass
+                self.fsync_task = None
+            if self.file and not self.file.closed:
+                self.close_segment(self.file, True)
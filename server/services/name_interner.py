@@ -0,0 +1,48 @@
+class NameInterner:
+    """
+    Assigns small integer ids to names (channels or usernames), so frames can carry a varint in place of the full string.
+
+    Ids are assigned once for the lifetime of the server and never reused, which lets a broadcast frame be encoded once and shared by every subscriber. What differs per connection is only which ids the client has been told about, see `OutboundQueue.known_channels` and `OutboundQueue.known_users`.
+
+    Attributes:
+        ids (dict): Maps each name to its id.
+        names (list): Name for each id, indexed by id. Id 0 is never assigned, as it is the value of an unset protobuf field.
+    """
+
+    def __init__(self):
+        """
+        Initializes the NameInterner.
+        """
+        self.ids: dict[str, int] = {}
+        self.names: list[str] = [""]
+
+    def intern(self, name: str) -> int:
+        """
+        Returns the id of a name, assigning the next free id if it hasn't been seen before.
+
+        Args:
+            name (str): The channel name or username.
+
+        Returns:
+            int: The name's id.
+        """
+        name_id = self.ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.ids[name] = name_id
+            self.names.append(name)
+        return name_id
+
+    def name(self, name_id: int) -> str | None:
+        """
+        Looks up the name an id was assigned to.
+
+        Args:
+            name_id (int): The id.
+
+        Returns:
+            str | None: The name, or None if the id hasn't been assigned.
+        """
+        if 0 < name_id < len(self.names):
+            return self.names[name_id]
+        return None
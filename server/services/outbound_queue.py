@@ -0,0 +1,363 @@
+import asyncio
+from collections import deque
+from enum import Enum
+from logging import Logger
+from typing import Awaitable, Callable
+
+from fastapi import WebSocket, status
+from fastapi.websockets import WebSocketDisconnect
+
+try:
+    from services.codec import PROTOCOL_VERSION, encode_batch
+    from services.legacy_codec import encode_legacy_batch
+    from services.websocket_frames import encode_frame, get_raw_protocol, is_open
+except:
+    from server.services.codec import PROTOCOL_VERSION, encode_batch
+    from server.services.legacy_codec import encode_legacy_batch
+    from server.services.websocket_frames import encode_frame, get_raw_protocol, is_open
+
+
+class SlowConsumerPolicy(str, Enum):
+    """
+    What to do with a connection whose outbound backlog grows past its thresholds.
+
+    DROP_OLDEST: Discard the oldest queued chat messages until the backlog fits again. Messages without a key, such as channel subscriptions and intern frames, are never discarded, as the client's state depends on them, so the connection is closed if they alone exceed the thresholds.
+    COALESCE: Keep only the newest queued message per channel, so the client skips ahead to the latest activity. Falls back to dropping the oldest messages if that is not enough.
+    DISCONNECT: Close the connection with the configured close code.
+    """
+
+    DROP_OLDEST = "drop_oldest"
+    COALESCE = "coalesce"
+    DISCONNECT = "disconnect"
+
+
+class OutboundQueue:
+    """
+    Bounded queue of pre-encoded messages for a single websocket, drained by one long-lived writer task.
+
+    Broadcasting only enqueues bytes, so the cost of fanning a message out no longer depends on how quickly each subscriber's socket accepts data, and no task is created per subscriber per message. The backlog is measured both in messages and in bytes, and the slow consumer policy is applied as soon as either threshold would be exceeded.
+
+    Once woken, the writer waits for the flush window so that messages arriving close together can be sent together, which cuts the number of send calls under load.
+
+    Where the connection allows it, the writer skips the ASGI send path entirely and writes complete websocket frames to the transport. A broadcast frame is built once and the same bytes are written to every subscriber, see `websocket_frames.get_raw_protocol()` for when this applies. Runs of these frames are written in one call rather than combined into a "batch" frame, which is only built for messages without a shared frame, or on the ASGI send path.
+
+    Attributes:
+        websocket (WebSocket): The websocket the writer task sends to.
+        username (str): The username the connection belongs to.
+        logger (Logger): Logger instance for debugging and error reporting.
+        protocol_version (int): Protocol version negotiated with the client. Messages are queued already encoded for this version.
+        pending (deque): Pending (key, encoded message, websocket frame) entries waiting to be sent. The key is the channel for chat messages, and None for messages that must never be coalesced. The frame is the message already wrapped as a websocket frame, or None if it has not been built.
+        bytes_buffered (int): Total size of the pending messages.
+        keyless_messages (int): Number of pending messages without a key, which the policy never discards.
+        keyless_bytes (int): Total size of the pending messages without a key.
+        max_messages (int): Maximum number of pending messages before the policy is applied.
+        max_bytes (int): Maximum size of the pending messages before the policy is applied.
+        policy (SlowConsumerPolicy): What to do once a threshold is exceeded.
+        close_code (int): Websocket close code used when the connection is closed for being too slow.
+        flush_window (float): Seconds the writer waits after waking before sending, to collect messages into one frame.
+        max_batch_bytes (int): Maximum total size of the messages combined into one batch frame.
+        dropped_messages (int): Number of messages discarded by the policy.
+        writer_task (asyncio.Task | None): Task draining the queue into the websocket.
+        protocol (WebSocketCommonProtocol | None): Server protocol whose transport frames are written to directly, None if the normal send path is used.
+        known_channels (set): Interned channel ids the client has been told the names of.
+        known_users (set): Interned username ids the client has been told the names of.
+        closed (bool): Set once the connection has failed or been stopped, after which nothing more is queued.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        username: str,
+        logger: Logger,
+        on_closed: Callable[["OutboundQueue"], Awaitable[None]],
+        max_messages: int,
+        max_bytes: int,
+        policy: SlowConsumerPolicy = SlowConsumerPolicy.DROP_OLDEST,
+        close_code: int = status.WS_1013_TRY_AGAIN_LATER,
+        flush_window: float = 0,
+        max_batch_bytes: int = 256 * 1024,
+        protocol_version: int = PROTOCOL_VERSION,
+    ):
+        """
+        Initializes the OutboundQueue.
+
+        Args:
+            websocket (WebSocket): The websocket to send messages to.
+            username (str): The username the connection belongs to.
+            logger (Logger): Logger instance.
+            on_closed (Callable): Coroutine function called with this queue when the connection fails or is closed by the policy.
+            max_messages (int): Maximum number of pending messages before the policy is applied.
+            max_bytes (int): Maximum size in bytes of the pending messages before the policy is applied.
+            policy (SlowConsumerPolicy): What to do once a threshold is exceeded.
+            close_code (int): Websocket close code used when the policy disconnects the client.
+            flush_window (float): Seconds to wait after waking before sending, 0 to send immediately.
+            max_batch_bytes (int): Maximum total size of the messages combined into one batch frame, must stay under the 1 MB websocket message limit.
+            protocol_version (int): Protocol version negotiated with the client, which decides how batch frames are encoded.
+        """
+        self.websocket: WebSocket = websocket
+        self.username: str = username
+        self.logger: Logger = logger
+        self.protocol_version: int = protocol_version
+        self.encode_batch = encode_batch if protocol_version == PROTOCOL_VERSION else encode_legacy_batch
+        self.on_closed = on_closed
+        self.pending: deque[tuple[str | None, bytes, bytes | None]] = deque()
+        self.bytes_buffered: int = 0
+        self.keyless_messages: int = 0
+        self.keyless_bytes: int = 0
+        self.max_messages: int = max_messages
+        self.max_bytes: int = max_bytes
+        self.policy: SlowConsumerPolicy = policy
+        self.close_code: int = status.WS_1000_NORMAL_CLOSURE
+        self.slow_close_code: int = close_code
+        self.dropped_messages: int = 0
+        self.lagging: bool = False
+        self.flush_window: float = flush_window
+        self.max_batch_bytes: int = max_batch_bytes
+        self.writer_task: asyncio.Task | None = None
+        self.protocol = get_raw_protocol(websocket)
+        self.known_channels: set[int] = set()
+        self.known_users: set[int] = set()
+        self.closed: bool = False
+        self._ready: asyncio.Event = asyncio.Event()
+        self._room: asyncio.Event = asyncio.Event()
+
+    @property
+    def depth(self) -> int:
+        """Number of messages waiting to be sent."""
+        return len(self.pending)
+
+    def start(self):
+        """
+        Starts the writer task.
+        """
+        self.writer_task = asyncio.create_task(self.run_writer())
+
+    def put(
+        self, message_bytes: bytes, key: str | None = None, frame: bytes | None = None
+    ) -> bool:
+        """
+        Queues a message to be sent without waiting, applying the slow consumer policy if the backlog would exceed its thresholds.
+
+        Args:
+            message_bytes (bytes): The binary message data.
+            key (str | None): Channel the message belongs to, used for coalescing. None if the message must always be delivered.
+            frame (bytes | None): The message already wrapped by `encode_frame()`, shared between every subscriber it is broadcast to.
+
+        Returns:
+            bool: True if the message was queued, False otherwise.
+        """
+        if self.closed or message_bytes is None:
+            return False
+
+        size = len(message_bytes)
+        if (
+            len(self.pending) >= self.max_messages
+            or self.bytes_buffered + size > self.max_bytes
+        ):
+            if not self.apply_policy(size):
+                return False
+
+        self.pending.append((key, message_bytes, frame))
+        self.bytes_buffered += size
+        if key is None:
+            self.keyless_messages += 1
+            self.keyless_bytes += size
+        self._ready.set()
+        return True
+
+    async def wait_for_room(self, size: int):
+        """
+        Waits until a message can be queued without exceeding max_bytes, so that bulk senders such as channel history hold back instead of pushing the connection into the slow consumer policy. Returns at once if the queue is empty or closed.
+
+        Args:
+            size (int): Size in bytes of the message about to be queued.
+        """
+        while not self.closed and self.bytes_buffered and self.bytes_buffered + size > self.max_bytes:
+            self._room.clear()
+            await self._room.wait()
+
+    def apply_policy(self, incoming_size: int) -> bool:
+        """
+        Makes room for an incoming message according to the slow consumer policy. If the messages without a key alone exceed the thresholds, nothing can be discarded to make room, and the connection is closed.
+
+        Args:
+            incoming_size (int): Size in bytes of the message about to be queued.
+
+        Returns:
+            bool: True if the message can now be queued, False if the connection was closed.
+        """
+        if not self.lagging:
+            self.lagging = True
+            self.logger.warning(
+                f"Slow consumer {self.username}: {self.depth} messages, {self.bytes_buffered} bytes buffered, applying {self.policy.value}"
+            )
+
+        if self.policy is SlowConsumerPolicy.DISCONNECT or (
+            self.keyless_messages >= self.max_messages
+            or self.keyless_bytes + incoming_size > self.max_bytes
+        ):
+            self.close(self.slow_close_code)
+            return False
+
+        if self.policy is SlowConsumerPolicy.COALESCE:
+            self.coalesce()
+
+        # Messages without a key are set aside rather than dropped, and put back in their original order
+        kept: list[tuple[str | None, bytes, bytes | None]] = []
+        while self.pending and (
+            len(self.pending) + len(kept) >= self.max_messages
+            or self.bytes_buffered + incoming_size > self.max_bytes
+        ):
+            entry = self.pending.popleft()
+            if entry[0] is None:
+                kept.append(entry)
+                continue
+            self.bytes_buffered -= len(entry[1])
+            self.dropped_messages += 1
+        self.pending.extendleft(reversed(kept))
+        return True
+
+    def coalesce(self):
+        """
+        Reduces the backlog to the newest pending message for each channel. Messages without a key are always kept.
+        """
+        seen: set = set()
+        kept: deque[tuple[str | None, bytes, bytes | None]] = deque()
+        for entry in reversed(self.pending):
+            key = entry[0]
+            if key is not None:
+                if key in seen:
+                    self.bytes_buffered -= len(entry[1])
+                    self.dropped_messages += 1
+                    continue
+                seen.add(key)
+            kept.appendleft(entry)
+        self.pending = kept
+
+    async def run_writer(self):
+        """
+        Sends queued messages to the websocket in order until the connection fails or the task is cancelled.
+        """
+        while True:
+            if not self.pending:
+                self.lagging = False
+                self._ready.clear()
+                await self._ready.wait()
+                if self.flush_window:
+                    await asyncio.sleep(self.flush_window)
+                continue
+            message_bytes, frames = self.next_frame()
+            self._room.set()
+            try:
+                await self.send(message_bytes, frames)
+            except WebSocketDisconnect:
+                break
+            except Exception as e:
+                if str(e) != 'Cannot call "send" once a close message has been sent.':
+                    self.logger.warning(
+                        f"Exception sending message, closing connection: {self.username} {type(e).__name__}: {e}"
+                    )
+                break
+        self.close()
+
+    async def send(self, message_bytes: bytes | None, frames: list[bytes] | None):
+        """
+        Sends one message, or a run of pre-built frames, writing the websocket frames straight to the transport when the fast path is available.
+
+        Args:
+            message_bytes (bytes | None): The binary message data, None for a run of pre-built frames.
+            frames (list[bytes] | None): The websocket frames already built for the message or run, the frame is built here if None.
+
+        Raises:
+            WebSocketDisconnect: If a run of pre-built frames can't be written because the connection has closed.
+        """
+        if self.protocol is not None and is_open(self.protocol):
+            if frames is None:
+                self.protocol.transport.write(encode_frame(message_bytes))
+            else:
+                self.protocol.transport.writelines(frames)
+            # Wait for the transport's buffer to empty if it is above its high-water mark
+            await self.protocol.drain()
+        elif message_bytes is None:
+            raise WebSocketDisconnect(status.WS_1006_ABNORMAL_CLOSURE)
+        else:
+            await self.websocket.send_bytes(message_bytes)
+
+    def next_frame(self) -> tuple[bytes | None, list[bytes] | None]:
+        """
+        Removes pending messages from the queue, up to max_batch_bytes, and returns them to be sent together.
+
+        On the fast path, a run of messages whose frames were built once by the broadcast is returned as those frames, to be written to the transport in one call. Combining them into a batch message would mean encoding a new frame for this connection alone. The client still receives a websocket message for each of them. Other messages are combined into one batch message, stopping before the next message with a pre-built frame on the fast path. A single message is returned unchanged, along with its pre-built frame.
+
+        Returns:
+            tuple[bytes | None, list[bytes] | None]: The message to send, None for a run of pre-built frames, and the websocket frames to write if they have already been built.
+        """
+        key, message_bytes, frame = self.pending.popleft()
+        self.remove_sent(key, message_bytes)
+        if frame is not None and self.protocol is not None:
+            frames = [frame]
+            frames_size = len(frame)
+            while (
+                self.pending
+                and self.pending[0][2] is not None
+                and frames_size + len(self.pending[0][2]) <= self.max_batch_bytes
+            ):
+                key, pending_bytes, pending_frame = self.pending.popleft()
+                self.remove_sent(key, pending_bytes)
+                frames.append(pending_frame)
+                frames_size += len(pending_frame)
+            return (message_bytes if len(frames) == 1 else None), frames
+
+        batch = [message_bytes]
+        batch_size = len(message_bytes)
+        while self.pending and batch_size + len(self.pending[0][1]) <= self.max_batch_bytes:
+            if self.protocol is not None and self.pending[0][2] is not None:
+                break
+            key, message_bytes, _ = self.pending.popleft()
+            self.remove_sent(key, message_bytes)
+            batch.append(message_bytes)
+            batch_size += len(message_bytes)
+        if len(batch) == 1:
+            return batch[0], None if frame is None else [frame]
+        return self.encode_batch(batch), None
+
+    def remove_sent(self, key: str | None, message_bytes: bytes):
+        """
+        Takes a message removed from the queue to be sent out of the backlog totals.
+
+        Args:
+            key (str | None): The message's key.
+            message_bytes (bytes): The binary message data.
+        """
+        self.bytes_buffered -= len(message_bytes)
+        if key is None:
+            self.keyless_messages -= 1
+            self.keyless_bytes -= len(message_bytes)
+
+    def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        """
+        Marks the queue as closed and schedules the owner's cleanup for this connection.
+
+        Args:
+            code (int): Websocket close code to close the connection with.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.close_code = code
+        self._room.set()
+        asyncio.create_task(self.on_closed(self))
+
+    def stop(self):
+        """
+        Stops the writer task and discards anything still queued. Safe to call from within the writer task itself.
+        """
+        self.closed = True
+        self.pending.clear()
+        self.bytes_buffered = 0
+        self.keyless_messages = 0
+        self.keyless_bytes = 0
+        self._room.set()
+        if self.writer_task and self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
+        self.writer_task = None
@@ -0,0 +1,204 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from os import getenv
+
+from dotenv import load_dotenv
+from fastapi import status, HTTPException
+from passlib.context import CryptContext
+
+load_dotenv()
+
+CRYPTCONTEXT_SCHEME = getenv("CRYPTCONTEXT_SCHEME")
+# Number of processes passwords are hashed and verified on. Defaults to half the CPUs, leaving the rest for the event loop and database threads
+PASSWORD_HASH_WORKERS = int(getenv("PASSWORD_HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+# Most hashes and verifications running or waiting for a process at once. Past this, logins and account creation are turned away with a 503 rather than queueing behind a backlog that would time out anyway
+PASSWORD_HASH_MAX_PENDING = int(getenv("PASSWORD_HASH_MAX_PENDING", 256))
+# Seconds clients turned away are told to wait before retrying, in the Retry-After header
+PASSWORD_HASH_RETRY_AFTER = int(getenv("PASSWORD_HASH_RETRY_AFTER", 1))
+
+pwd_context = CryptContext(schemes=[CRYPTCONTEXT_SCHEME], deprecated="auto")
+
+
+def hash_password(plaintext_password: str) -> str:
+    """
+    Hashes a password. Runs on a worker process.
+
+    Args:
+        plaintext_password (str): The plaintext password to hash.
+
+    Returns:
+        str: The hashed password.
+    """
+    return pwd_context.hash(plaintext_password)
+
+
+def verify_password(plaintext_password: str, password_hashed: str) -> bool:
+    """
+    Verifies a password against its hash. Runs on a worker process.
+
+    Args:
+        plaintext_password (str): The plaintext password to verify.
+        password_hashed (str): The hashed password to compare against.
+
+    Returns:
+        bool: True if the password matches, False otherwise.
+    """
+    return pwd_context.verify(plaintext_password, password_hashed)
+
+
+def init_worker():
+    """
+    Runs once on each worker process as it starts. The server pins its own process to core 0, see main_server.py, which the workers would otherwise inherit, so they are moved to the other cores.
+    """
+    cpu_count: int = os.cpu_count() or 1
+    if hasattr(os, "sched_setaffinity") and cpu_count > 1:
+        os.sched_setaffinity(0, range(1, cpu_count))
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords on a pool of worker processes, so that a storm of logins or account creations doesn't hold the event loop, and with it message fan-out, for the tens of milliseconds of CPU each argon2 hash takes.
+
+    Admission is bounded: once `max_pending` hashes are running or queued, further requests are refused straight away with a 503 and a Retry-After header.
+
+    Workers are started with the forkserver method where it's available, rather than forked from the server process and its database threads, and run on every core but the event loop's.
+
+    Attributes:
+        workers (int): Number of worker processes.
+        max_pending (int): Most hashes running or queued at once.
+        retry_after (int): Seconds refused clients are told to wait.
+        executor (ProcessPoolExecutor | None): The worker processes, started by `start()` or the first hash.
+        pending (int): Hashes running or queued.
+        completed (int): Hashes and verifications completed.
+        rejected (int): Requests refused because `max_pending` were already pending.
+    """
+
+    def __init__(
+        self,
+        workers: int = PASSWORD_HASH_WORKERS,
+        max_pending: int = PASSWORD_HASH_MAX_PENDING,
+        retry_after: int = PASSWORD_HASH_RETRY_AFTER,
+    ):
+        """
+        Initializes the PasswordHasher. The worker processes are started by `start()`.
+
+        Args:
+            workers (int): Number of worker processes.
+            max_pending (int): Most hashes running or queued at once.
+            retry_after (int): Seconds refused clients are told to wait.
+        """
+        self.workers: int = workers
+        self.max_pending: int = max_pending
+        self.retry_after: int = retry_after
+        self.executor: ProcessPoolExecutor | None = None
+        self.pending: int = 0
+        self.completed: int = 0
+        self.rejected: int = 0
+
+    def start(self):
+        """
+        Starts the worker processes, if they aren't already running.
+        """
+        if self.executor is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(start_method),
+                initializer=init_worker,
+            )
+
+    async def close(self):
+        """
+        Waits for any hashes in progress, then stops the worker processes.
+        """
+        if self.executor is not None:
+            executor, self.executor = self.executor, None
+            await asyncio.to_thread(executor.shutdown, wait=True)
+
+    def admit(self):
+        """
+        Checks there is room in the admission queue for another hash. Called by `run()`, and by request handlers before they do any other work for a request that will need a hash.
+
+        Raises:
+            HTTPException: 503 if `max_pending` hashes are already pending.
+        """
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, try again shortly",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+
+    async def run(self, function, *args):
+        """
+        Runs a hash function on a worker process, if there is room in the admission queue.
+
+        Args:
+            function (Callable): `hash_password` or `verify_password`.
+            *args: Arguments to call it with.
+
+        Returns:
+            Any: The function's return value.
+
+        Raises:
+            HTTPException: 503 if `max_pending` hashes are already pending.
+        """
+        self.admit()
+        self.start()
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    async def hash(self, plaintext_password: str) -> str:
+        """
+        Hashes a password on a worker process.
+
+        Args:
+            plaintext_password (str): The plaintext password to hash.
+
+        Returns:
+            str: The hashed password.
+
+        Raises:
+            HTTPException: 503 if too many hashes are already pending.
+        """
+        return await self.run(hash_password, plaintext_password)
+
+    async def verify(self, plaintext_password: str, password_hashed: str) -> bool:
+        """
+        Verifies a password against its hash on a worker process.
+
+        Args:
+            plaintext_password (str): The plaintext password to verify.
+            password_hashed (str): The hashed password to compare against.
+
+        Returns:
+            bool: True if the password matches, False otherwise.
+
+        Raises:
+            HTTPException: 503 if too many hashes are already pending.
+        """
+        return await self.run(verify_password, plaintext_password, password_hashed)
+
+    def metrics(self) -> dict:
+        """
+        Returns:
+            dict: Number of worker processes, and hashes pending, completed and refused.
+        """
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+# Create instance to be imported
+password_hasher = PasswordHasher()
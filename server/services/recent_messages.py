@@ -0,0 +1,214 @@
+from collections import OrderedDict, deque
+
+# Approximate bytes each buffered message costs on top of its content and username, for the tuple, its ints and the deque slot
+MESSAGE_OVERHEAD_BYTES = 200
+# Approximate bytes each channel's buffer costs while empty
+CHANNEL_OVERHEAD_BYTES = 1024
+
+# Positions of the fields in a buffered message
+ID, SEQ, USERNAME, CONTENT, SENT_AT = range(5)
+
+
+def parse_channel_sizes(value: str | None) -> dict[str, int]:
+    """
+    Parses per-channel buffer sizes from a setting like "welcome:500,announcements:50".
+
+    Args:
+        value (str | None): Comma separated channel:size pairs.
+
+    Returns:
+        dict[str, int]: Maps channel names to the number of messages to keep for them.
+
+    Raises:
+        ValueError: If a pair isn't a channel name and an integer.
+    """
+    sizes: dict[str, int] = {}
+    for pair in (value or "").split(","):
+        if not pair.strip():
+            continue
+        channel, _, size = pair.rpartition(":")
+        if not channel.strip():
+            raise ValueError(f"Invalid channel size {pair!r}, expected channel:size")
+        sizes[channel.strip()] = int(size)
+    return sizes
+
+
+class RecentMessages:
+    """
+    Ring buffer of each channel's latest messages, so the history clients ask for most, the latest page of a channel when they connect, join it or reconnect, is served from memory rather than SQLite.
+
+    Each channel's buffer holds every message of the channel from its oldest entry up to the latest one, with no gaps, as it's filled from the database when the server starts and then appended to as messages are sent. Messages are stored as tuples rather than dicts to keep them small. Channels are kept in least recently used order, and when the buffers together pass `max_bytes` the channels used least recently are dropped whole. A channel dropped this way starts a new buffer from its next message.
+
+    Attributes:
+        default_size (int): Number of messages kept for each channel.
+        channel_sizes (dict[str, int]): Number of messages kept for particular channels, in place of default_size.
+        max_bytes (int): Approximate memory all buffers together may use.
+        channels (OrderedDict): Maps channel names to their buffer, least recently used first.
+        complete (set[str]): Channels whose buffer holds every message the channel has ever had, so a page reaching past its oldest entry can still be served.
+        channel_bytes (dict[str, int]): Approximate memory used by each channel's buffer.
+        total_bytes (int): Approximate memory used by all buffers.
+        hits (int): Pages served from the buffers.
+        misses (int): Pages that had to be read from the database.
+    """
+
+    def __init__(self, default_size: int, channel_sizes: dict[str, int] | None = None, max_bytes: int = 64 * 1024 * 1024):
+        """
+        Initializes RecentMessages with no channels buffered. Call `warm()` to fill it from the database.
+
+        Args:
+            default_size (int): Number of messages kept for each channel, 0 to keep none.
+            channel_sizes (dict[str, int] | None): Number of messages kept for particular channels.
+            max_bytes (int): Approximate memory all buffers together may use.
+        """
+        self.default_size: int = default_size
+        self.channel_sizes: dict[str, int] = channel_sizes or {}
+        self.max_bytes: int = max_bytes
+        self.channels: OrderedDict[str, deque] = OrderedDict()
+        self.complete: set[str] = set()
+        self.channel_bytes: dict[str, int] = {}
+        self.total_bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @property
+    def max_channel_size(self) -> int:
+        """
+        Returns:
+            int: The most messages kept for any channel.
+        """
+        return max([self.default_size, *self.channel_sizes.values()])
+
+    def channel_size(self, channel: str) -> int:
+        """
+        Args:
+            channel (str): The channel name.
+
+        Returns:
+            int: Number of messages kept for the channel.
+        """
+        return self.channel_sizes.get(channel, self.default_size)
+
+    @staticmethod
+    def message_bytes(entry: tuple) -> int:
+        """
+        Args:
+            entry (tuple): A buffered message.
+
+        Returns:
+            int: Approximate memory the message uses.
+        """
+        return len(entry[CONTENT]) + len(entry[USERNAME]) + MESSAGE_OVERHEAD_BYTES
+
+    def warm(self, messages: list[dict]):
+        """
+        Fills the buffers with the latest messages of each channel, read from the database when the server starts.
+
+        Args:
+            messages (list[dict]): Up to `max_channel_size` of the latest messages of each channel, oldest first within each channel, with "id", "seq", "username", "channel", "content" and "sent_at" keys.
+        """
+        for message in messages:
+            self.append(message)
+
+    def append(self, message: dict):
+        """
+        Adds a new message to its channel's buffer, dropping the channel's oldest message if the buffer is full.
+
+        Args:
+            message (dict): The message, with "id", "seq", "username", "channel", "content" and "sent_at" keys.
+        """
+        channel: str = message["channel"]
+        size: int = self.channel_size(channel)
+        if size <= 0:
+            return
+        buffer: deque | None = self.channels.get(channel)
+        if buffer is None:
+            buffer = self.channels[channel] = deque(maxlen=size)
+            self.channel_bytes[channel] = CHANNEL_OVERHEAD_BYTES
+            self.total_bytes += CHANNEL_OVERHEAD_BYTES
+            # Only the first message of a channel has seq 1
+            if message["seq"] == 1:
+                self.complete.add(channel)
+        else:
+            # Messages replayed from the journal may already have been read from the database
+            if buffer and message["id"] <= buffer[-1][ID]:
+                return
+            self.channels.move_to_end(channel)
+        if len(buffer) == buffer.maxlen:
+            dropped: int = self.message_bytes(buffer[0])
+            self.channel_bytes[channel] -= dropped
+            self.total_bytes -= dropped
+            self.complete.discard(channel)
+        entry: tuple = (
+            message["id"],
+            message["seq"],
+            message["username"],
+            message["content"],
+            message["sent_at"],
+        )
+        buffer.append(entry)
+        added: int = self.message_bytes(entry)
+        self.channel_bytes[channel] += added
+        self.total_bytes += added
+        self.evict()
+
+    def evict(self):
+        """
+        Drops the buffers of the least recently used channels until all of them together are within `max_bytes`. The most recently used channel is always kept.
+        """
+        while self.total_bytes > self.max_bytes and len(self.channels) > 1:
+            channel, _ = self.channels.popitem(last=False)
+            self.total_bytes -= self.channel_bytes.pop(channel)
+            self.complete.discard(channel)
+
+    def page(
+        self, channel: str, before_id: int | None, after_id: int | None, limit: int
+    ) -> tuple[list[dict], bool] | None:
+        """
+        Serves one page of a channel's history from its buffer, with the same results as `ConnectionManager.get_channel_history()`, if the buffer holds all of it.
+
+        Args:
+            channel (str): The channel name.
+            before_id (int | None): Return the messages just before this id. If neither bound is given, the latest messages are returned.
+            after_id (int | None): Return the messages just after this id, with before_id still applied as an upper bound.
+            limit (int): Maximum number of messages to return.
+
+        Returns:
+            tuple | None: The messages oldest first and whether there are further messages in the direction requested, or None if the page has to be read from the database.
+        """
+        buffer: deque | None = self.channels.get(channel)
+        if buffer is None:
+            self.misses += 1
+            return None
+        complete: bool = channel in self.complete
+        lower: int = after_id or 0
+        upper: int | None = before_id
+        # The buffer holds every message after its oldest entry, so a page after a point it covers is always served, as is any page of a channel it holds completely
+        if after_id is not None and not complete and buffer and after_id + 1 < buffer[0][ID]:
+            self.misses += 1
+            return None
+        entries: list[tuple] = [
+            entry for entry in buffer if entry[ID] > lower and (upper is None or entry[ID] < upper)
+        ]
+        if after_id is not None:
+            has_more: bool = len(entries) > limit
+            entries = entries[:limit]
+        else:
+            if len(entries) < limit and not complete:
+                self.misses += 1
+                return None
+            # Older messages may have been dropped from the buffer, in which case there are more
+            has_more = len(entries) > limit or not complete
+            entries = entries[-limit:] if limit else []
+        self.hits += 1
+        self.channels.move_to_end(channel)
+        return [
+            {
+                "id": entry[ID],
+                "seq": entry[SEQ],
+                "username": entry[USERNAME],
+                "channel": channel,
+                "content": entry[CONTENT],
+                "sent_at": entry[SENT_AT],
+            }
+            for entry in entries
+        ], has_more
@@ -0,0 +1,63 @@
+import time
+from collections import OrderedDict
+
+
+class TokenBuckets:
+    """
+    A token bucket for each source, such as a client's IP address, limiting how often it may make a request while allowing short bursts.
+
+    Each bucket holds up to `burst` tokens and refills at `rate` tokens per second. A request takes one token, and is refused if the bucket is empty. Buckets are kept in least recently used order, and once `max_sources` are tracked the least recently used is dropped. A source that's been idle that long has a full bucket anyway, so dropping it only forgets a source that's since been busy if there are more than `max_sources` busier ones.
+
+    Attributes:
+        rate (float): Tokens added to each bucket per second.
+        burst (float): Most tokens a bucket holds.
+        max_sources (int): Most buckets kept.
+        buckets (OrderedDict): Maps sources to their tokens and the time.monotonic() they were last counted, least recently used first.
+        admitted (int): Requests that took a token.
+        refused (int): Requests refused because their bucket was empty.
+    """
+
+    def __init__(self, rate: float, burst: float, max_sources: int = 10000):
+        """
+        Initializes TokenBuckets with no sources tracked.
+
+        Args:
+            rate (float): Tokens added to each bucket per second, 0 for no limit.
+            burst (float): Most tokens a bucket holds.
+            max_sources (int): Most buckets kept.
+        """
+        self.rate: float = rate
+        self.burst: float = burst
+        self.max_sources: int = max_sources
+        self.buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self.admitted: int = 0
+        self.refused: int = 0
+
+    def take(self, source: str) -> float:
+        """
+        Takes a token from a source's bucket, if it has one.
+
+        Args:
+            source (str): The source making the request.
+
+        Returns:
+            float: 0 if the request is admitted, otherwise the seconds until the bucket next has a token.
+        """
+        if self.rate <= 0:
+            self.admitted += 1
+            return 0
+        now: float = time.monotonic()
+        tokens, last = self.buckets.get(source, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait: float = 0
+            self.admitted += 1
+        else:
+            wait = (1 - tokens) / self.rate
+            self.refused += 1
+        self.buckets[source] = (tokens, now)
+        self.buckets.move_to_end(source)
+        while len(self.buckets) > self.max_sources:
+            self.buckets.popitem(last=False)
+        return wait
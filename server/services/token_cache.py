@@ -0,0 +1,94 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class TokenCache:
+    """
+    Bounded cache of access tokens whose signature has been verified, so a client reconnecting with the same token, as every client does in a reconnect storm, skips the HMAC verification and JSON parsing of `jwt.decode()`.
+
+    Tokens are keyed by their SHA-256 digest, so the cache doesn't hold usable tokens and every key is the same size. Each entry holds the username the token was issued to and the token's expiry, and is dropped once the token expires, after which the token is decoded again and rejected as expired. Tokens are kept in least recently used order, and the least recently used is dropped once `max_size` are cached.
+
+    Only the signature check is skipped. The account is still looked up on every connect, so tokens of an account that has been disabled are refused as soon as the account cache sees the change.
+
+    Attributes:
+        max_size (int): Maximum number of tokens cached, 0 to cache none.
+        tokens (OrderedDict): Maps token digests to the username and the expiry as a Unix timestamp, least recently used first.
+        hits (int): Tokens found in the cache.
+        misses (int): Tokens that had to be decoded.
+    """
+
+    def __init__(self, max_size: int):
+        """
+        Initializes an empty TokenCache.
+
+        Args:
+            max_size (int): Maximum number of tokens cached, 0 to cache none.
+        """
+        self.max_size: int = max_size
+        self.tokens: OrderedDict[bytes, tuple[str, float]] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        """
+        Args:
+            token (str): The encoded token.
+
+        Returns:
+            bytes: The token's SHA-256 digest.
+        """
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> str | None:
+        """
+        Args:
+            token (str): The encoded token.
+
+        Returns:
+            str | None: The username the token was issued to, or None if it isn't cached or has expired.
+        """
+        key: bytes = self.key(token)
+        entry: tuple[str, float] | None = self.tokens.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        username, expires = entry
+        if time.time() >= expires:
+            del self.tokens[key]
+            self.misses += 1
+            return None
+        self.tokens.move_to_end(key)
+        self.hits += 1
+        return username
+
+    def put(self, token: str, username: str, expires: float):
+        """
+        Caches a token whose signature has been verified, dropping the least recently used token if the cache is full.
+
+        Args:
+            token (str): The encoded token.
+            username (str): The username the token was issued to.
+            expires (float): The token's expiry as a Unix timestamp.
+        """
+        if self.max_size <= 0:
+            return
+        key: bytes = self.key(token)
+        self.tokens[key] = (username, expires)
+        self.tokens.move_to_end(key)
+        while len(self.tokens) > self.max_size:
+            self.tokens.popitem(last=False)
+
+    def metrics(self) -> dict:
+        """
+        Returns:
+            dict: Number of tokens cached, hits, misses and the hit rate.
+        """
+        lookups: int = self.hits + self.misses
+        return {
+            "cached_tokens": len(self.tokens),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+        }
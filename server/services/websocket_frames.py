@@ -0,0 +1,81 @@
+from fastapi import WebSocket
+from starlette.types import ASGIApp, Receive, Scope, Send
+from websockets.legacy.protocol import State, WebSocketCommonProtocol
+
+# Key in the websocket connection scope that holds the server's protocol object for the connection
+PROTOCOL_SCOPE_KEY = "chattr.websocket_protocol"
+
+# FIN bit set, binary opcode
+BINARY_FRAME_FIRST_BYTE = 0x82
+
+
+class RawTransportMiddleware:
+    """
+    ASGI middleware that stores uvicorn's websocket protocol object in the connection scope.
+
+    Starlette wraps the ASGI send callable before it reaches the endpoint, so this has to be captured on the way in. It is what allows outbound queues to write pre-built frames directly to the connection's transport.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "websocket":
+            # uvicorn passes its protocol's bound asgi_send method as send
+            scope[PROTOCOL_SCOPE_KEY] = getattr(send, "__self__", None)
+        await self.app(scope, receive, send)
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """
+    Builds a complete, unmasked server to client binary websocket frame.
+
+    Args:
+        payload (bytes): The binary message data.
+
+    Returns:
+        bytes: The frame header followed by the payload.
+    """
+    length = len(payload)
+    if length < 126:
+        header = bytes((BINARY_FRAME_FIRST_BYTE, length))
+    elif length < 65536:
+        header = bytes((BINARY_FRAME_FIRST_BYTE, 126)) + length.to_bytes(2, "big")
+    else:
+        header = bytes((BINARY_FRAME_FIRST_BYTE, 127)) + length.to_bytes(8, "big")
+    return header + payload
+
+
+def get_raw_protocol(websocket: WebSocket) -> WebSocketCommonProtocol | None:
+    """
+    Returns the protocol object of a websocket if pre-built frames can be written directly to its transport.
+
+    The fast path is only used when the connection is served by uvicorn's websockets implementation, no extensions such as permessage-deflate were negotiated (the frame would need compressing per connection), and the transport is not TLS.
+
+    Args:
+        websocket (WebSocket): An accepted websocket connection.
+
+    Returns:
+        WebSocketCommonProtocol | None: The protocol to write frames through, or None if the normal send path must be used.
+    """
+    protocol = websocket.scope.get(PROTOCOL_SCOPE_KEY)
+    if not isinstance(protocol, WebSocketCommonProtocol):
+        return None
+    if protocol.extensions or protocol.transport is None:
+        return None
+    if protocol.transport.get_extra_info("sslcontext") is not None:
+        return None
+    return protocol
+
+
+def is_open(protocol: WebSocketCommonProtocol) -> bool:
+    """
+    Checks that frames can still be written to a connection's transport.
+
+    Args:
+        protocol (WebSocketCommonProtocol): The connection's protocol object.
+
+    Returns:
+        bool: True if the connection is open and its transport is not closing.
+    """
+    return protocol.state is State.OPEN and not protocol.transport.is_closing()